@@ -0,0 +1,384 @@
+import numpy as np
+import pandas as pd
+import h5py
+import os
+import re
+import gc
+import hashlib
+import subprocess
+import time
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from plotter import (get_directory, get_paths, open_file, parse_snapshot_fname, get_particle_count, get_manifest, get_dfs, get_quotas,
+					 get_particle_distribution, get_total_mass_in_particles_with_redshift, reduce_snapshots, get_shared_bin_edges, get_histogram_df,
+					 plot_particle_distribution, plot_total_mass_in_particles_with_redshift, plot_mass_distribution, plot_mass_distribution_with_redshift)
+
+# ===================================== User-defined function definitions ===============================
+
+# ----------------------- Synthetic snapshot functions --------------------
+
+def get_snapshot_fname(snapshot, redshift):
+	'''
+	Returns filename of a snapshot, of the form star_particles_NNN_zXXXpYYY.hdf5 (see parse_snapshot_fname()).
+	Parameters	:
+	snapshot 	- snapshot number.
+	redshift 	- redshift of snapshot, rounded to 3 decimals.
+	'''
+	milli 	= int(round(redshift*1000))
+	return 'star_particles_%03d_z%03dp%03d.hdf5' % (snapshot, milli//1000, milli%1000)
+
+def get_synthetic_redshifts(snapshots=24, z_max=7.05):
+	'''
+	Returns redshifts of synthetic snapshots, from z_max down to 0, evenly spaced in log(1+z) as snapshots of simulations usually are.
+	Parameters	:
+	snapshots 	- number of snapshots.
+	z_max 		- redshift of first snapshot.
+	'''
+	return np.round(np.geomspace(1+z_max, 1, snapshots)-1, 3)
+
+def get_synthetic_counts(total, redshifts):
+	'''
+	Returns number of particles of each synthetic snapshot, adding up to total. As in the sample data, counts rise steeply until redshift ~2.5 and slowly afterwards.
+	Parameters	:
+	total 		- total number of particles over all snapshots.
+	redshifts 	- redshifts of snapshots.
+	'''
+	weights 	= 1/(1+np.exp((np.asarray(redshifts)-2.5)/0.3))+0.02*np.exp(-np.asarray(redshifts))
+	return get_quotas(np.round(weights*1e9).astype(np.int64), total)
+
+def generate_particles(rng, n, scale_radius=1e-3, max_radius=3e-2):
+	'''
+	Returns (coordinates, velocities, masses) arrays of n synthetic star particles of a galaxy, in units of the sample data : coordinates (Mpc) relative to centre of galaxy, with a Hernquist profile truncated at max_radius, isotropic Gaussian velocities (km/s) and masses (solar masses) with a sharp peak and a tail to large masses.
+	Parameters	:
+	rng 			- numpy random number generator.
+	n 				- number of particles.
+	scale_radius 	- scale radius of Hernquist profile, in Mpc.
+	max_radius 		- radius of truncation, in Mpc (30 kpc, as NumStars_30kpc).
+	'''
+	root 		= np.sqrt(rng.uniform(0, (max_radius/(max_radius+scale_radius))**2, n))	# Inverse of Hernquist cumulative mass profile, M(<r) ~ (r/(r+a))^2
+	radius 		= scale_radius*root/(1-root)
+	direction 	= rng.standard_normal((n,3))
+	direction 	/= np.linalg.norm(direction, axis=1)[:,None]
+	coordinates = radius[:,None]*direction
+	velocities 	= rng.normal(0, 90, (n,3))
+	masses 		= 10**(5.63+np.minimum(rng.exponential(0.12, n), 1.5))
+	return coordinates, velocities, masses
+
+def write_snapshot(path, n, seed=0, chunks=None, compression=None, compression_opts=None, shuffle=False, rows_per_write=2**22):
+	'''
+	Writes a synthetic snapshot with the dataset layout of sample hdf5 files : Coordinates (n,3), Velocity (n,3) and Mass (n,) float64 datasets and a Header group with NumStars_30kpc attribute. Particles are generated and written in blocks of rows, so that memory use is bounded by rows_per_write irrespective of n.
+	Parameters	:
+	path 				- Path of hdf5 file.
+	n 					- number of particles.
+	seed 				- seed of random number generator. Combined with snapshot number, so that files do not depend on order or process in which they are written.
+	chunks 				- number of rows per hdf5 chunk, or None for contiguous datasets (as in sample files). Compression needs chunked datasets, and h5py picks chunks if None.
+	compression 		- hdf5 compression filter (eg. 'gzip', 'lzf'), or None.
+	compression_opts	- options of compression filter (eg. gzip level).
+	shuffle 			- apply byte shuffle filter before compression.
+	rows_per_write		- Maximum number of rows generated and written at once.
+	'''
+	rng 		= np.random.default_rng([seed, parse_snapshot_fname(path)[0]])
+	kwargs 		= dict(dtype=np.float64, compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+	with h5py.File(path, 'w') as fname:
+		datasets 	= {name : fname.create_dataset(name, shape=(n,)+shape, chunks=(min(chunks,max(n,1)),)+shape if chunks else None, **kwargs)
+					   for name, shape in [('Coordinates',(3,)), ('Velocity',(3,)), ('Mass',())]}
+		for lo in range(0, n, rows_per_write):
+			hi 			= min(lo+rows_per_write, n)
+			for name, values in zip(['Coordinates','Velocity','Mass'], generate_particles(rng, hi-lo)):
+				datasets[name][lo:hi] 	= values
+		fname.create_group('Header').attrs['NumStars_30kpc'] = np.int32(n)
+	return path
+
+def generate_snapshots(directory, total, snapshots=24, z_max=7.05, seed=0, chunks=None, compression=None, compression_opts=None, shuffle=False, workers=1, overwrite=False):
+	'''
+	Writes a directory of synthetic snapshots holding total particles, shared among snapshots as in the sample data (see get_synthetic_counts()), and returns their paths. Snapshots already present with the expected number of particles are kept unless overwrite is set.
+	Parameters	:
+	directory 		- Path to directory of hdf5 files, created if missing.
+	total 			- total number of particles over all snapshots (eg. 10**4 to 10**8).
+	snapshots 		- number of snapshots, numbered from 5 as in the sample data.
+	z_max 			- redshift of first snapshot.
+	seed 			- seed of random number generator.
+	chunks, compression, compression_opts, shuffle	- hdf5 storage options (see write_snapshot()).
+	workers 		- number of worker processes. Snapshots are written serially if 1.
+	overwrite 		- rewrite snapshots already present.
+	'''
+	os.makedirs(directory, exist_ok=True)
+	redshifts 	= get_synthetic_redshifts(snapshots, z_max)
+	counts 		= get_synthetic_counts(total, redshifts)
+	paths 		= [os.path.join(directory, get_snapshot_fname(snapshot, redshift)) for snapshot, redshift in zip(range(5, 5+snapshots), redshifts)]
+	pending 	= list()
+	for path, n in zip(paths, counts):
+		if not overwrite and os.path.exists(path):
+			with open_file(path) as fname:
+				if get_particle_count(fname) == n:
+					continue
+		pending.append((path, int(n)))
+	options 	= (seed, chunks, compression, compression_opts, shuffle)
+	if workers <= 1:
+		for path, n in pending:
+			write_snapshot(path, n, *options)
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			list(executor.map(write_snapshot, *zip(*pending), *zip(*[options]*len(pending))))
+	return paths
+
+# ----------------------- Memory measurement functions --------------------
+
+def get_proc_status(field):
+	'''
+	Returns a memory field (eg. VmRSS, VmHWM) of /proc/self/status in bytes, or None where it is unavailable.
+	Parameters	:
+	field 	- name of field.
+	'''
+	try:
+		with open('/proc/self/status') as status:
+			match 	= re.search(r'^'+field+r':\s+(\d+) kB', status.read(), re.MULTILINE)
+	except OSError:
+		return None
+	return int(match.group(1))*1024 if match else None
+
+def reset_peak_rss():
+	'''
+	Resets peak resident set size of this process to its current resident set size (Linux only) and returns True if it could be reset. Otherwise, peak RSS is the peak since start of the process.
+	'''
+	try:
+		with open('/proc/self/clear_refs', 'w') as clear_refs:
+			clear_refs.write('5')
+		return True
+	except OSError:
+		return False
+
+def get_peak_rss():
+	'''
+	Returns peak resident set size of this process, in bytes, since start of process or last reset_peak_rss().
+	'''
+	peak 	= get_proc_status('VmHWM')
+	return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+# ----------------------- Benchmark functions -----------------------------
+
+# ------- Resolution of figures rendered by benchmarks.
+
+benchmark_dpi = 150
+
+def get_manifests(directories):
+	'''
+	Returns snapshot manifests of directories, named after them.
+	Parameters	:
+	directories	- list of paths to directories of hdf5 files.
+	'''
+	return [get_manifest(directory, os.path.basename(os.path.normpath(directory))) for directory in directories]
+
+def get_named_dfs(directories, params_list, workers=1):
+	'''
+	Returns particle dataframes of directories, named after them.
+	Parameters	:
+	directories	- list of paths to directories of hdf5 files.
+	params_list	- list of columns to be extracted from hdf5 file datasets.
+	workers 	- number of worker processes (see get_dfs()).
+	'''
+	df_list 	= get_dfs([get_paths(directory) for directory in directories], params_list, workers)
+	for df, directory in zip(df_list, directories):
+		df.name 	= os.path.basename(os.path.normpath(directory))
+	return df_list
+
+def render_plot(function, df_list, plots_dir, plot_name, **kwargs):
+	'''
+	Draws a figure with a plotter function and saves it to plots_dir instead of plots directory of the repository. Matplotlib is only imported here, with the non-interactive Agg backend, so that data-only stages do not pay for it.
+	Parameters	:
+	function 	- plotter function taking a list of dataframes (or manifests) and show.
+	df_list 	- list of dataframes or manifests.
+	plots_dir 	- directory of saved figures.
+	plot_name 	- filename of figure, without extension.
+	kwargs 		- keyword arguments of function.
+	'''
+	import matplotlib.pyplot as plt
+	plt.switch_backend('Agg')					# Benchmarks render figures headlessly, without a display.
+	function(df_list, show=None, **kwargs)
+	plt.savefig(os.path.join(plots_dir, plot_name+'.png'), dpi=benchmark_dpi, bbox_inches='tight')
+	plt.close('all')
+
+# ------- Pipeline stages benchmarked, mapped to their input ('directories', 'dfs' or 'manifests') and to a function running them on it.
+# ------- Stage functions take (inputs, params_list, workers, plots_dir); inputs are prepared before timing starts.
+
+benchmark_stages = {
+	'get_manifest'										: ('directories', lambda directories, params_list, workers, plots_dir : get_manifests(directories)),
+	'get_df'											: ('directories', lambda directories, params_list, workers, plots_dir : get_named_dfs(directories, params_list, workers)),
+	'get_particle_distribution'							: ('dfs', lambda df_list, params_list, workers, plots_dir : get_particle_distribution(df_list)),
+	'get_total_mass_in_particles_with_redshift'			: ('dfs', lambda df_list, params_list, workers, plots_dir : get_total_mass_in_particles_with_redshift(df_list)),
+	'reduce_snapshots'									: ('manifests', lambda manifest_list, params_list, workers, plots_dir : [reduce_snapshots(manifest, ['mass']) for manifest in manifest_list]),
+	'get_histogram_df'									: ('manifests', lambda manifest_list, params_list, workers, plots_dir : get_histogram_df(manifest_list, get_shared_bin_edges(manifest_list, 'mass', 150), 'mass', workers=workers)),
+	'plot_particle_distribution'						: ('dfs', lambda df_list, params_list, workers, plots_dir : render_plot(plot_particle_distribution, df_list, plots_dir, 'particle_distribution_wrt_redshift')),
+	'plot_total_mass_in_particles_with_redshift'		: ('dfs', lambda df_list, params_list, workers, plots_dir : render_plot(plot_total_mass_in_particles_with_redshift, df_list, plots_dir, 'total_mass_wrt_redshift')),
+	'plot_mass_distribution'							: ('dfs', lambda df_list, params_list, workers, plots_dir : render_plot(plot_mass_distribution, df_list, plots_dir, 'particle_mass_distribution')),
+	'plot_mass_distribution_manifests'					: ('manifests', lambda manifest_list, params_list, workers, plots_dir : render_plot(plot_mass_distribution, manifest_list, plots_dir, 'particle_mass_distribution_manifests')),
+	'plot_mass_distribution_with_redshift'				: ('dfs', lambda df_list, params_list, workers, plots_dir : render_plot(plot_mass_distribution_with_redshift, df_list[:1], plots_dir, 'mass_distribution_wrt_redshift')),
+	'plot_mass_distribution_with_redshift_manifests'	: ('manifests', lambda manifest_list, params_list, workers, plots_dir : render_plot(plot_mass_distribution_with_redshift, manifest_list[:1], plots_dir, 'mass_distribution_wrt_redshift_manifests'))
+	}
+
+def get_data_size(directories):
+	'''
+	Returns (particles, bytes) : number of particles and bytes of datasets of all hdf5 files of directories, from hdf5 metadata only.
+	Parameters	:
+	directories	- list of paths to directories of hdf5 files.
+	'''
+	particles, nbytes 	= 0, 0
+	for manifest in get_manifests(directories):
+		particles 		+= int(manifest['counts'].sum())
+		for col in manifest.columns:
+			if col.endswith('_shape'):
+				itemsize 	= manifest[col[:-len('_shape')]+'_dtype'].map(lambda dtype : np.dtype(dtype).itemsize)
+				nbytes 		+= int((manifest[col].map(np.prod)*itemsize).sum())
+	return particles, nbytes
+
+def run_stage(stage, directories, params_list=['mass','redshift'], workers=1, plots_dir=None, start_method=None):
+	'''
+	Runs a pipeline stage once and returns a dictionary of wall time (s), peak resident set size of this process during the stage (bytes, also relative to its start) and peak resident set size of worker processes (bytes). Meant to run in a fresh process (see benchmark()), so that caches of earlier runs do not hide costs of reading files and peak memory is not inherited.
+	Parameters	:
+	stage 		- name of stage (see benchmark_stages).
+	directories	- list of paths to directories of hdf5 files (eg. one per assembly mode).
+	params_list	- list of columns read by get_df.
+	workers 	- number of worker processes used by the stage.
+	plots_dir 	- directory of figures rendered by plotting stages.
+	start_method- start method of worker processes (eg. 'fork'). Processes started by spawn default to spawn for their own workers, which would add interpreter start-up and imports to every worker pool of the stage.
+	'''
+	if start_method is not None:
+		multiprocessing.set_start_method(start_method, force=True)
+	kind, function 	= benchmark_stages[stage]
+	if kind == 'dfs':
+		inputs 		= get_named_dfs(directories, params_list, workers=1)
+	elif kind == 'manifests':
+		inputs 		= get_manifests(directories)
+	else:
+		inputs 		= directories
+	gc.collect()
+	reset 			= reset_peak_rss()
+	start_rss 		= get_proc_status('VmRSS')
+	start 			= time.perf_counter()
+	function(inputs, params_list, workers, plots_dir)
+	wall_time 		= time.perf_counter()-start
+	peak_rss 		= get_peak_rss()
+	return {'wall_time'				: wall_time,
+			'peak_rss'				: peak_rss,
+			'peak_rss_increase'		: peak_rss-start_rss if reset and start_rss is not None else np.nan,
+			'workers_peak_rss'		: resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024}
+
+def benchmark(directories, stages=None, params_list=['mass','redshift'], workers=1, repeat=3, plots_dir=None):
+	'''
+	Returns a dataframe with one row per stage and repeat, holding wall time, throughput (particles/s and dataset MB/s read or processed) and peak memory of each stage on hdf5 files of directories. Every run happens in a freshly started process.
+	Parameters	:
+	directories	- list of paths to directories of hdf5 files (eg. written by generate_snapshots()).
+	stages 		- list of stages (see benchmark_stages), all if None.
+	params_list	- list of columns read by get_df.
+	workers 	- number of worker processes used by stages.
+	repeat 		- number of runs of each stage.
+	plots_dir 	- directory of figures rendered by plotting stages, a benchmarks subdirectory of plots directory if None.
+	'''
+	stages 				= list(benchmark_stages) if stages is None else stages
+	plots_dir 			= os.path.join(get_directory('plots'), 'benchmarks') if plots_dir is None else plots_dir
+	os.makedirs(plots_dir, exist_ok=True)
+	particles, nbytes 	= get_data_size(directories)
+	rows 				= list()
+	context 			= multiprocessing.get_context('spawn')
+	for stage in stages:
+		for run in range(repeat):
+			with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+				result 	= executor.submit(run_stage, stage, directories, params_list, workers, plots_dir, multiprocessing.get_start_method()).result()
+			rows.append(dict({'stage':stage, 'run':run, 'particles':particles, 'bytes':nbytes, 'workers':workers}, **result))
+	df 					= pd.DataFrame(rows)
+	df['particles_per_s']	= df['particles']/df['wall_time']
+	df['MB_per_s'] 			= df['bytes']/df['wall_time']/1024**2
+	return df
+
+def summarize_benchmarks(df, by=['particles','chunks','compression','workers','stage']):
+	'''
+	Returns median wall time and throughput, and largest peak memory, over repeats of each stage of a benchmark dataframe (see benchmark()), in MB.
+	Parameters	:
+	df 	- dataframe returned by benchmark(), with storage options added as columns.
+	by 	- columns identifying a benchmark.
+	'''
+	by 			= [col for col in by if col in df]
+	summary 	= df.groupby(by, dropna=False, sort=False).agg(wall_time=('wall_time','median'),
+															  particles_per_s=('particles_per_s','median'),
+															  MB_per_s=('MB_per_s','median'),
+															  peak_rss=('peak_rss','max'),
+															  peak_rss_increase=('peak_rss_increase','max'),
+															  workers_peak_rss=('workers_peak_rss','max')).reset_index()
+	for col in ['peak_rss','peak_rss_increase','workers_peak_rss']:
+		summary[col] 	= summary[col]/1024**2
+	return summary.rename(columns={'peak_rss':'peak_rss_MB','peak_rss_increase':'peak_rss_increase_MB','workers_peak_rss':'workers_peak_rss_MB'})
+
+# ----------------------- Result file functions --------------------------
+
+def get_code_version():
+	'''
+	Returns (revision, code_hash) identifying the benchmarked code : git revision of the repository, suffixed with -dirty if it has uncommitted changes (None outside a git checkout), and sha1 digest of the plotting and benchmark scripts, which tells apart runs on uncommitted edits.
+	'''
+	scripts_dir 	= os.path.dirname(os.path.abspath(__file__))
+	try:
+		revision 	= subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=scripts_dir, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		revision 	= None
+	digest 			= hashlib.sha1()
+	for path in [os.path.join(scripts_dir, 'plotter.py'), os.path.abspath(__file__), os.path.join(os.path.dirname(os.path.dirname(scripts_dir)), 'pipeline_tools.py')]:
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				digest.update(f.read())
+	return revision, digest.hexdigest()[:12]
+
+def append_results(df, fname):
+	'''
+	Appends benchmark results to a csv file, created if missing. If columns of the file differ from those of df (eg. after a column was added to benchmark()), the file is rewritten with the union of columns, earlier rows getting NaN in new columns, so that rows never end up under a header they do not match.
+	Parameters	:
+	df 		- dataframe of benchmark results.
+	fname 	- path of csv file.
+	'''
+	os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+	if not os.path.exists(fname):
+		df.to_csv(fname, index=False)
+	elif list(pd.read_csv(fname, nrows=0).columns) == list(df.columns):
+		df.to_csv(fname, mode='a', header=False, index=False)
+	else:
+		pd.concat([pd.read_csv(fname), df], ignore_index=True).to_csv(fname, index=False)
+
+# ============================================ Main program =============================================
+
+if __name__ == '__main__' :
+
+	# ------- Total number of particles of synthetic datasets. Each dataset is a directory of snapshots, written once and reused by later runs.
+	# ------- 10**8 particles take about 5.6 GB on disk when uncompressed.
+
+	sizes 				= [10**4, 10**5, 10**6]
+	# sizes 			= [10**4, 10**5, 10**6, 10**7, 10**8]
+
+	# ------- hdf5 storage options, as (chunks, compression) pairs : chunks is a number of rows per chunk, or None for contiguous datasets (as in sample files).
+
+	layouts 			= [(None, None), (2**16, 'gzip')]
+
+	# ------- Stages to benchmark (see benchmark_stages), columns read by get_df, worker processes and runs per stage.
+
+	stages 				= None
+	cols 				= ['mass', 'redshift']
+	workers 			= os.cpu_count()
+	repeat 				= 3
+
+	results 			= list()
+	for size in sizes:
+		for chunks, compression in layouts:
+			directory 	= os.path.join(get_directory('synthetic'), '%d_%s_%s' % (size, chunks or 'contiguous', compression or 'raw'))
+			generate_snapshots(directory, size, chunks=chunks, compression=compression, shuffle=compression is not None, workers=workers)
+			df 			= benchmark([directory], stages, cols, workers, repeat)
+			df.insert(0, 'chunks', chunks or 0)
+			df.insert(1, 'compression', compression or 'none')
+			results.append(df)
+			print(summarize_benchmarks(df).to_string(index=False))
+
+	# ------- Results of all runs are appended to a csv file, with the code they ran on, so that runs on different revisions of the code can be compared.
+
+	results 			= pd.concat(results, ignore_index=True)
+	revision, code_hash = get_code_version()
+	results.insert(0, 'timestamp', pd.Timestamp.now().isoformat(timespec='seconds'))
+	results.insert(1, 'revision', revision)
+	results.insert(2, 'code_hash', code_hash)
+	append_results(results, os.path.join(get_directory('benchmarks'), 'benchmarks.csv'))
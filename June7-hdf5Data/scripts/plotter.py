@@ -1,197 +1,2114 @@
 import numpy as np 
 import pandas as pd
 import h5py
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
+import sys
 import re 
 import itertools
+import collections
+import hashlib
+import json
 import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))	# Repository root, holding pipeline_tools shared with the May25 plotter.
+from pipeline_tools import lazy_import, write_table, get_function_sources, start_profiling, instrument, write_profile_report
 
 # ===================================== User-defined function definitions ===============================
 
 # ----------------------- General-purpose functions -----------------------
 
-def capitalize_first_letter(string):
+def capitalize_first_letter(string):
+	'''
+	Returns a string with capitalized first letter.
+	Parameters	:
+	string	- a string whose first words is to be capitalized. This does not return string in camelcase, for which we might need to call this function repeated on split string.
+	'''
+	return string[0].capitalize()+string[1:]
+
+def add_assembly_column(df_list):
+	'''
+	Returns a list of dataframes with an extra column added, which signifies mode of assembly of data. This is denoted by name of dataframe.
+	Assembly column is categorical, with names of all dataframes of the list as categories, so that it takes a single byte per row and stays categorical when dataframes are concatenated.
+	Parameters	:
+	df_list	- a list of dataframes with their name attributes already set.
+	'''
+	categories 	= list(dict.fromkeys(df.name for df in df_list))
+	for df in df_list :
+		df['assembly']	= pd.Categorical.from_codes(np.full(len(df), categories.index(df.name), dtype=np.int8), categories=categories)
+	return df_list
+
+# ------- Plotting libraries are imported on first use, so that data-only runs start fast and do not need a display.
+
+matplotlib 	= lazy_import('matplotlib')
+plt 		= lazy_import('matplotlib.pyplot')
+sns 		= lazy_import('seaborn')
+
+# ----------------------- Getter functions --------------------------------
+
+def get_directory(directory):
+	'''
+	Sets up directory structure. Returns directory path for root, data, scripts, plots, etc.
+	Parameters :
+	directory - Identifier for the directory label, eg. root, data, scripts, plots, cache, synthetic, benchmarks, summaries, gm_early_data, organic_data, gm_late_data, catalogue_data.
+	'''
+	dir_dict 						= dict()
+	dir_dict['scripts_dir'] 		= os.path.dirname(os.path.abspath(__file__))
+	dir_dict['root_dir'] 			= os.path.dirname(dir_dict['scripts_dir'])
+	dir_dict['data_dir'] 			= os.path.join(dir_dict['root_dir'], 'data')
+	dir_dict['gm_early_data_dir']	= os.path.join(dir_dict['data_dir'], 'gm_early')
+	dir_dict['organic_data_dir']	= os.path.join(dir_dict['data_dir'], 'organic')
+	dir_dict['gm_late_data_dir']	= os.path.join(dir_dict['data_dir'], 'gm_late')
+	dir_dict['plots_dir']			= os.path.join(dir_dict['root_dir'], 'plots')
+	dir_dict['cache_dir']			= os.path.join(dir_dict['root_dir'], 'cache')
+	dir_dict['synthetic_dir']		= os.path.join(dir_dict['root_dir'], 'synthetic')
+	dir_dict['benchmarks_dir']		= os.path.join(dir_dict['root_dir'], 'benchmarks')
+	dir_dict['summaries_dir']		= os.path.join(dir_dict['root_dir'], 'summaries')
+	dir_dict['catalogue_data_dir']	= os.path.join(os.path.dirname(dir_dict['root_dir']), 'May25-GalaxyCataloguesData', 'data_updated')
+	return dir_dict[directory+'_dir']
+
+@instrument
+def get_files(directory, mode='r'):
+	'''
+	Returns hdf5 file handles for all files in a directory, sorted by filename (i.e. by snapshot number).
+	All files are held open until closed by the caller. Use iter_snapshots() to stream through a directory with a bounded number of open files instead.
+	TODO : Test for no hdf5 files
+	Parameters :
+	directory 	- Path to directory for reading hdf5 files
+	mode		- Mode of opening the file; defaults to read mode.
+	'''
+	return [h5py.File(os.path.join(directory,fname),mode) for fname in sorted(os.listdir(directory))]
+
+# ------- Size of raw data chunk cache of each open hdf5 file, in bytes (1 MiB is the hdf5 library default).
+
+chunk_cache_nbytes = 1024**2
+
+@instrument
+def get_paths(files):
+	'''
+	Returns a list of paths of hdf5 files.
+	Parameters :
+	files 	- Path to a directory (all .hdf5 files in it are listed, sorted by filename), or a list of paths or open hdf5 file handles.
+	'''
+	if isinstance(files, str):
+		return [os.path.join(files,fname) for fname in sorted(os.listdir(files)) if fname.endswith('.hdf5')]
+	return [fname if isinstance(fname, str) else fname.filename for fname in files]
+
+def open_file(path, mode='r', rdcc_nbytes=None):
+	'''
+	Returns an open hdf5 file handle with an explicit chunk cache size. The handle can be used as a context manager to close it.
+	Parameters :
+	path 		- Path to an hdf5 file.
+	mode		- Mode of opening the file; defaults to read mode.
+	rdcc_nbytes	- Size of chunk cache in bytes. Defaults to chunk_cache_nbytes if None.
+	'''
+	if rdcc_nbytes is None:
+		rdcc_nbytes 	= chunk_cache_nbytes
+	return h5py.File(path, mode, rdcc_nbytes=rdcc_nbytes)
+
+def iter_snapshots(files, mode='r', max_open=1, rdcc_nbytes=None):
+	'''
+	Generator yielding open hdf5 file handles one snapshot at a time. Files are opened lazily, only when the next snapshot is requested, and at most max_open of them are open at once: a handle is closed once max_open newer handles have been opened. Remaining handles are closed when the generator is exhausted or closed (eg. on break out of a for loop).
+	Handles passed in by the caller are yielded as they are and never closed.
+	Parameters :
+	files 		- Path to a directory, or a list of paths or open hdf5 file handles.
+	mode		- Mode of opening the file; defaults to read mode.
+	max_open 	- Maximum number of files opened by the generator at once. Defaults to 1, i.e. a handle is valid only until the next one is requested.
+	rdcc_nbytes	- Size of chunk cache of each file in bytes. Defaults to chunk_cache_nbytes if None.
+	'''
+	if not isinstance(files, str) and all(not isinstance(fname, str) for fname in files):
+		yield from files
+		return
+	handles 	= collections.deque()
+	try:
+		for path in get_paths(files):
+			if len(handles) >= max_open:
+				handles.popleft().close()
+			handles.append(open_file(path, mode, rdcc_nbytes))
+			yield handles[-1]
+	finally:
+		while handles:
+			handles.popleft().close()
+
+# ++++++++++++++++++++ Getter functions for hdf5 files dataset columns 
+
+def get_coords_x(fname):
+	'''
+	Returns x-coordinates from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Coordinates"][:,0]
+
+def get_coords_y(fname):
+	'''
+	Returns y-coordinates from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Coordinates"][:,1]
+
+def get_coords_z(fname):
+	'''
+	Returns z-coordinates from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Coordinates"][:,2]
+
+def get_vel_x(fname):
+	'''
+	Returns velocities along x-axis from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Velocity"][:,0]
+
+def get_vel_y(fname):
+	'''
+	Returns velocities along y-axis from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Velocity"][:,1]
+
+def get_vel_z(fname):
+	'''
+	Returns velocities along z-axis from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Velocity"][:,2]
+
+def get_mass(fname):
+	'''
+	Returns star particle masses from an hdf5 file.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname["Mass"]
+
+# ------- Snapshot filenames are of the form star_particles_NNN_zXXXpYYY.hdf5, with snapshot number NNN and redshift XXX.YYY
+
+snapshot_fname_pattern = re.compile(r'_(\d+)_z(\d+)p(\d+)\.hdf5$')
+
+def parse_snapshot_fname(path):
+	'''
+	Returns snapshot number and redshift parsed from name of an hdf5 file.
+	Parameters	:
+	path 	- Path (or name) of an hdf5 file.
+	'''
+	snapshot, integer, fraction 	= snapshot_fname_pattern.search(os.path.basename(path)).groups()
+	return int(snapshot), float(integer+'.'+fraction)
+
+def get_redshift(fname):
+	'''
+	Returns redshift value for an hdf5 file. Uses regex to find redshift value from filename.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return parse_snapshot_fname(fname.filename)[1]
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# ++++++++++++++++++++ Memory-mapped access to hdf5 files datasets
+
+def get_dataset_array(fname, dataset, memmap=False):
+	'''
+	Returns a dataset of an hdf5 file as an array. If memmap is set and the dataset is stored contiguously and uncompressed (not chunked, hence not filtered) in a file opened with the default driver, a read-only np.memmap view at the file offset of the dataset is returned, so that only parts of the dataset actually used are paged in. Other datasets are read into memory.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	dataset 	- Name of dataset, eg. Coordinates, Velocity or Mass.
+	memmap 		- Return a memory-mapped view where possible.
+	'''
+	source 		= get_dataset_source(fname, dataset, memmap)
+	return source if isinstance(source, np.ndarray) else source[...]
+
+def get_dataset_source(fname, dataset, memmap=False):
+	'''
+	Returns a np.memmap view of a dataset of an hdf5 file where possible (see get_dataset_array()), or else the h5py dataset itself, to be read from.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	dataset 	- Name of dataset.
+	memmap 		- Return a memory-mapped view where possible.
+	'''
+	dataset 	= fname[dataset]
+	if memmap and dataset.chunks is None and dataset.size > 0 and fname.driver in ('sec2','stdio'):
+		offset 	= dataset.id.get_offset()
+		if offset is not None:						# No offset if storage of the dataset is not allocated.
+			return np.memmap(fname.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+	return dataset
+
+def read_rows(source, lo, hi, buffer):
+	'''
+	Returns rows lo:hi of a dataset, either as a view of a memory-mapped array or read into first rows of buffer.
+	Parameters	:
+	source 	- np.memmap view or h5py dataset (see get_dataset_source()).
+	lo, hi 	- range of rows.
+	buffer 	- array with at least hi-lo rows, of the shape and dtype of source otherwise.
+	'''
+	if isinstance(source, np.ndarray):
+		return source[lo:hi]
+	block 	= buffer[:hi-lo]
+	source.read_direct(block, np.s_[lo:hi])
+	return block
+
+def get_snapshot_views(fname, params_list):
+	'''
+	Returns a dictionary mapping each requested column of an hdf5 file to an array, without copying where possible : columns of contiguous datasets are (strided) views of read-only memory-mapped datasets (see get_dataset_array()), so only columns and particles actually used are paged in from disk. Chunked or compressed datasets are read into memory, derived columns are computed and memoized (see get_derived_column()), and redshift is returned as a scalar.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file. Views stay valid after it is closed.
+	params_list	- List of columns, raw or derived.
+	'''
+	arrays 		= dict()
+	columns 	= dict()
+	for param in params_list:
+		if param == 'redshift':
+			columns[param] 	= get_redshift(fname)
+		elif param in derived_columns:
+			columns[param] 	= get_derived_column(fname, param)
+		else:
+			dataset, col 	= dataset_columns[param]
+			if dataset not in arrays:
+				arrays[dataset] 	= get_dataset_array(fname, dataset, memmap=True)
+			columns[param] 	= arrays[dataset] if col is None else arrays[dataset][:,col]
+	return columns
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# ++++++++++++++++++++ Single-pass reader for hdf5 files datasets
+
+# ------- Dataframe columns mapped to the hdf5 dataset holding them and their column index within that dataset (None for 1D datasets).
+
+dataset_columns = {
+	'coords_x'	: ('Coordinates', 0),
+	'coords_y'	: ('Coordinates', 1),
+	'coords_z'	: ('Coordinates', 2),
+	'vel_x'		: ('Velocity', 0),
+	'vel_y'		: ('Velocity', 1),
+	'vel_z'		: ('Velocity', 2),
+	'mass'		: ('Mass', None)
+	}
+
+def get_particle_count(fname):
+	'''
+	Returns number of star particles in an hdf5 file. Only the shape of Mass dataset is read, not the data itself.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	return fname['Mass'].shape[0]
+
+def get_columns_dtype(fname, params_list):
+	'''
+	Returns a common dtype able to hold all requested columns of an hdf5 file (at least float64, as redshift is a float).
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	params_list	- List of columns from hdf5 file.
+	'''
+	dtypes 	= [fname[dataset_columns[param][0]].dtype for param in params_list if param in dataset_columns]
+	return np.result_type(np.float64, *dtypes)
+
+def read_columns(fname, params_list, out, start=0, chunk_rows=2**20, memmap=False):
+	'''
+	Reads columns of a single hdf5 file into a preallocated array and returns the number of rows read. Each dataset is read once, in contiguous blocks of rows, and split into columns using views of the block (no intermediate copies). If memmap is set, contiguous datasets are sliced from memory-mapped views instead of being read through hdf5; rows are still copied into out (see get_snapshot_views() for access without copies).
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	params_list	- List of columns from hdf5 file, in the order of rows of out.
+	out 		- Preallocated array of shape (number of columns, number of particles). Columns of fname are written to out[:,start:start+n].
+	start 		- Offset in out at which particles of fname are written.
+	chunk_rows	- Maximum number of rows read from a dataset at once. Bounds the size of temporary read buffer.
+	memmap 		- Slice contiguous datasets from memory-mapped views.
+	Derived columns (see derived_columns) are filled from get_derived_column(), which memoizes them per snapshot.
+	'''
+	n 			= get_particle_count(fname)
+	datasets 	= dict()						# Requested columns grouped by hdf5 dataset, so that each dataset is read only once.
+	for row, param in enumerate(params_list):
+		if param == 'redshift':
+			out[row,start:start+n] = get_redshift(fname)
+		elif param in derived_columns:
+			out[row,start:start+n] = get_derived_column(fname, param, chunk_rows)
+		else:
+			dataset, col 	= dataset_columns[param]
+			datasets.setdefault(dataset,[]).append((row,col))
+	for dataset, targets in datasets.items():
+		source 		= get_dataset_source(fname, dataset, memmap)
+		buffer 		= None if isinstance(source, np.ndarray) else np.empty((min(chunk_rows,n),)+source.shape[1:], dtype=source.dtype)
+		for lo in range(0, n, chunk_rows):
+			hi 		= min(lo+chunk_rows, n)
+			block 	= read_rows(source, lo, hi, buffer)
+			for row, col in targets:
+				out[row,start+lo:start+hi] = block if col is None else block[:,col]
+	return n
+
+def iter_column_chunks(fname, params_list, chunk_rows=2**20, memmap=False):
+	'''
+	Generator yielding (start row, block) pairs covering all particles of a single hdf5 file, where block is an array of shape (number of columns, at most chunk_rows) holding requested columns of successive rows. Each dataset is read once per chunk, so memory use is bounded by chunk_rows irrespective of file size. Block buffers are reused for every chunk; copy a block to keep it beyond the next iteration. If memmap is set, contiguous datasets are sliced from memory-mapped views, so only chunks actually iterated are paged in. Derived columns (see derived_columns) are computed chunk by chunk by iter_derived_chunks().
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	params_list	- List of columns from hdf5 file, in the order of rows of each block.
+	chunk_rows	- Maximum number of rows in a chunk.
+	memmap 		- Slice contiguous datasets from memory-mapped views.
+	'''
+	if any(param in derived_columns for param in params_list):
+		yield from iter_derived_chunks(fname, params_list, chunk_rows, memmap)
+		return
+	n 			= get_particle_count(fname)
+	out 		= np.empty((len(params_list), min(chunk_rows,n)), dtype=get_columns_dtype(fname,params_list))
+	datasets 	= dict()						# Requested columns grouped by hdf5 dataset, so that each dataset is read only once per chunk.
+	for row, param in enumerate(params_list):
+		if param == 'redshift':
+			out[row] 		= get_redshift(fname)
+		else:
+			dataset, col 	= dataset_columns[param]
+			datasets.setdefault(dataset,[]).append((row,col))
+	sources 	= {dataset : get_dataset_source(fname, dataset, memmap) for dataset in datasets}
+	buffers 	= {dataset : None if isinstance(source, np.ndarray) else np.empty((min(chunk_rows,n),)+source.shape[1:], dtype=source.dtype) for dataset, source in sources.items()}
+	for lo in range(0, n, chunk_rows):
+		hi 		= min(lo+chunk_rows, n)
+		for dataset, targets in datasets.items():
+			block 	= read_rows(sources[dataset], lo, hi, buffers[dataset])
+			for row, col in targets:
+				out[row,:hi-lo] = block if col is None else block[:,col]
+		yield lo, out[:,:hi-lo]
+
+# ++++++++++++++++++++ Derived columns, computed lazily from hdf5 files dataset columns
+
+def get_speed(vel_x, vel_y, vel_z):
+	'''
+	Returns norm of peculiar velocity of particles (as subhalo_peculiar_velocity of halo catalogues).
+	'''
+	return np.sqrt(vel_x**2+vel_y**2+vel_z**2)
+
+def get_radius(coords_x, coords_y, coords_z):
+	'''
+	Returns galactocentric radius of particles, whose coordinates are relative to centre of their galaxy.
+	'''
+	return np.sqrt(coords_x**2+coords_y**2+coords_z**2)
+
+def get_radial_velocity(coords_x, coords_y, coords_z, vel_x, vel_y, vel_z, radius):
+	'''
+	Returns velocity of particles along their galactocentric radius (positive outwards). Undefined (NaN) at the centre.
+	'''
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (coords_x*vel_x+coords_y*vel_y+coords_z*vel_z)/radius
+
+def get_angular_momentum_z(coords_x, coords_y, vel_x, vel_y):
+	'''
+	Returns z component of specific angular momentum of particles about centre of their galaxy.
+	'''
+	return coords_x*vel_y-coords_y*vel_x
+
+def get_specific_angular_momentum(coords_x, coords_y, coords_z, vel_x, vel_y, vel_z):
+	'''
+	Returns norm of specific angular momentum (r x v) of particles about centre of their galaxy.
+	'''
+	return np.sqrt((coords_y*vel_z-coords_z*vel_y)**2+(coords_z*vel_x-coords_x*vel_z)**2+(coords_x*vel_y-coords_y*vel_x)**2)
+
+# ------- Derived columns mapped to the columns they are computed from (hdf5 dataset columns, redshift or other derived columns) and to a function computing them, vectorized over arrays of these columns passed in order.
+
+derived_columns = {
+	'speed'						: (['vel_x','vel_y','vel_z'], get_speed),
+	'radius'					: (['coords_x','coords_y','coords_z'], get_radius),
+	'radial_velocity'			: (['coords_x','coords_y','coords_z','vel_x','vel_y','vel_z','radius'], get_radial_velocity),
+	'angular_momentum_z'		: (['coords_x','coords_y','vel_x','vel_y'], get_angular_momentum_z),
+	'specific_angular_momentum'	: (['coords_x','coords_y','coords_z','vel_x','vel_y','vel_z'], get_specific_angular_momentum)
+	}
+
+# ------- Memory budget, in bytes, of derived columns memoized per snapshot (see get_derived_column()). Least recently used columns are evicted beyond it.
+
+derived_cache_nbytes = 256*1024**2
+
+derived_cache = collections.OrderedDict()		# Memoized derived columns, keyed by path, size and modification time of hdf5 file and name of column, in order of last use.
+
+def register_derived_column(name, dependencies, function):
+	'''
+	Adds a column to derived_columns, or replaces one, dropping its memoized values.
+	Parameters	:
+	name 			- name of derived column.
+	dependencies	- list of columns it is computed from (hdf5 dataset columns, redshift or other derived columns).
+	function 		- function returning derived column from arrays of dependencies, passed in order. It must be vectorized, as it is called on chunks of particles.
+	'''
+	derived_columns[name] 	= (list(dependencies), function)
+	for key in [key for key in derived_cache if key[-1] == name]:
+		del derived_cache[key]
+
+def get_dependencies(params_list, available=()):
+	'''
+	Returns (raw, derived) : columns to be read from hdf5 file to compute requested columns, and derived columns to be computed, in an order in which every derived column follows its own dependencies.
+	Parameters	:
+	params_list	- list of columns, raw or derived.
+	available 	- derived columns already at hand (eg. memoized), whose dependencies are not needed.
+	'''
+	raw, derived 	= list(), list()
+	visiting 		= set()						# Derived columns whose dependencies are being listed, i.e. ancestors in depth-first traversal.
+	stack 			= [(param, False) for param in reversed(params_list)]
+	while stack:								# Depth-first traversal, a derived column is listed once all its dependencies are.
+		param, expanded 	= stack.pop()
+		if expanded:
+			visiting.discard(param)
+			derived.append(param)
+		elif param in raw or param in derived or param in available:
+			continue
+		elif param not in derived_columns:
+			raw.append(param)
+		elif param in visiting:
+			raise ValueError('Circular dependencies of derived column '+param)
+		else:
+			visiting.add(param)
+			stack.append((param, True))
+			stack.extend((dependency, False) for dependency in reversed(derived_columns[param][0]))
+	return raw, derived
+
+def compute_derived_columns(columns, derived):
+	'''
+	Adds derived columns to a dictionary of column arrays, in place, and returns it. Columns already present are not recomputed.
+	Parameters	:
+	columns 	- dictionary mapping column names to arrays (eg. a chunk of particles), holding all dependencies of derived columns.
+	derived 	- list of derived columns in order of computation (see get_dependencies()).
+	'''
+	for param in derived:
+		if param not in columns:
+			dependencies, function 	= derived_columns[param]
+			columns[param] 			= function(*[columns[dependency] for dependency in dependencies])
+	return columns
+
+def get_snapshot_key(fname):
+	'''
+	Returns path, size and modification time of an hdf5 file, identifying its contents.
+	Parameters	:
+	fname 	- Open handle for an hdf5 file.
+	'''
+	stat 	= os.stat(fname.filename)
+	return (os.path.abspath(fname.filename), stat.st_size, stat.st_mtime_ns)
+
+def memoize_derived_column(key, values):
+	'''
+	Stores a derived column in derived_cache, evicting least recently used columns until all fit in derived_cache_nbytes. Columns larger than the budget are not stored.
+	Parameters	:
+	key 	- key of column (see derived_cache).
+	values 	- array of column.
+	'''
+	if values.nbytes > derived_cache_nbytes:
+		return
+	derived_cache[key] 	= values
+	derived_cache.move_to_end(key)
+	nbytes 				= sum(cached.nbytes for cached in derived_cache.values())
+	while nbytes > derived_cache_nbytes:
+		nbytes 	-= derived_cache.popitem(last=False)[1].nbytes
+
+def iter_derived_chunks(fname, params_list, chunk_rows=2**20, memmap=False):
+	'''
+	Generator yielding (start row, block) pairs like iter_column_chunks(), for a list of columns including derived columns. Memoized derived columns of the file are sliced, and other derived columns are computed chunk by chunk from their dependencies, so memory use stays bounded by chunk_rows. Block buffers are reused for every chunk.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	params_list	- List of columns, raw or derived, in the order of rows of each block.
+	chunk_rows	- Maximum number of rows in a chunk.
+	memmap 		- Slice contiguous datasets from memory-mapped views (see iter_column_chunks()).
+	'''
+	snapshot 		= get_snapshot_key(fname)
+	memoized 		= {key[-1] : values for key, values in derived_cache.items() if key[:-1] == snapshot}
+	raw, derived 	= get_dependencies(params_list, memoized)
+	used 			= [param for param in memoized if param in params_list or any(param in derived_columns[other][0] for other in derived)]
+	for param in used:
+		derived_cache.move_to_end(snapshot+(param,))
+	out 			= np.empty((len(params_list), min(chunk_rows,get_particle_count(fname))), dtype=get_columns_dtype(fname,raw))
+	for lo, block in iter_column_chunks(fname, raw, chunk_rows, memmap):
+		hi 			= lo+block.shape[1]
+		columns 	= dict(zip(raw, block))
+		columns.update((param, memoized[param][lo:hi]) for param in used)
+		compute_derived_columns(columns, derived)
+		for row, param in enumerate(params_list):
+			out[row,:hi-lo] = columns[param]
+		yield lo, out[:,:hi-lo]
+
+def get_derived_column(fname, param, chunk_rows=2**20):
+	'''
+	Returns a derived column (see derived_columns) for all particles of an hdf5 file. It is computed chunk by chunk on first request and memoized per snapshot, so later plots and reductions asking for it (or for columns depending on it) do not recompute it while it stays within derived_cache_nbytes.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	param 		- name of derived column.
+	chunk_rows	- Maximum number of rows computed at once.
+	'''
+	key 	= get_snapshot_key(fname)+(param,)
+	if key in derived_cache:
+		derived_cache.move_to_end(key)
+		return derived_cache[key]
+	values 	= np.empty(get_particle_count(fname))
+	for lo, block in iter_derived_chunks(fname, [param], chunk_rows):
+		values[lo:lo+block.shape[1]] = block[0]
+	memoize_derived_column(key, values)
+	return values
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def get_subdf(fname,params_list):
+	'''
+	Returns a sub-dataframe containing a subset of columns available in a single hdf5 file.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	param_list 	- List of columns from hdf5 file to include in a dataframe.
+	'''
+	out 	= np.empty((len(params_list), get_particle_count(fname)), dtype=get_columns_dtype(fname,params_list))
+	read_columns(fname, params_list, out)
+	return pd.DataFrame(out.T, columns=params_list, copy=False)	# Transposed view, columns of dataframe share memory with rows of out.
+
+def read_file_columns(path, params_list, memmap=False):
+	'''
+	Returns an array of shape (number of columns, number of particles) holding columns of a single hdf5 file. The file is opened (and closed) by path, so that this can run in a worker process, to which open hdf5 file handles cannot be passed.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	params_list	- List of columns from hdf5 file, in the order of rows of returned array.
+	memmap 		- Slice contiguous datasets from memory-mapped views (see read_columns()).
+	'''
+	with open_file(path) as fname:
+		out 	= np.empty((len(params_list), get_particle_count(fname)), dtype=get_columns_dtype(fname,params_list))
+		read_columns(fname, params_list, out, memmap=memmap)
+	return out
+
+# ++++++++++++++++++++ On-disk cache of columns read from hdf5 files
+
+def get_cache_key(path, params_list):
+	'''
+	Returns a pair of hex digests identifying a cache entry : the first one from absolute path of hdf5 file and requested columns, the second one from size and modification time of the file. Any change to the file changes the second digest, and so invalidates the entry.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	params_list	- List of columns from hdf5 file, in order.
+	'''
+	stat 		= os.stat(path)
+	source 		= hashlib.sha1((os.path.abspath(path)+'|'+','.join(params_list)).encode()).hexdigest()
+	identity 	= hashlib.sha1('{}|{}'.format(stat.st_size,stat.st_mtime_ns).encode()).hexdigest()
+	return source, identity
+
+def read_cached_columns(path, params_list, cache_dir, memmap=False):
+	'''
+	Returns columns of a single hdf5 file as an array of shape (number of columns, number of particles), memory-mapped from a .npy file in cache_dir. On a cache miss, the hdf5 file is read, stale entries for the same file and columns are removed and a new entry is written.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	params_list	- List of columns from hdf5 file, in the order of rows of returned array.
+	cache_dir 	- Directory holding cache entries. Created if it does not exist.
+	memmap 		- Slice contiguous datasets of hdf5 file from memory-mapped views on a cache miss (see read_columns()).
+	'''
+	source, identity 	= get_cache_key(path, params_list)
+	cache_fname 		= os.path.join(cache_dir, source+'_'+identity+'.npy')
+	if not os.path.exists(cache_fname):
+		os.makedirs(cache_dir, exist_ok=True)
+		for stale in os.listdir(cache_dir):
+			if stale.startswith(source+'_'):
+				os.remove(os.path.join(cache_dir,stale))
+		tmp_fname 		= cache_fname+'.'+str(os.getpid())+'.tmp'		# Write to a temporary file first, so that an interrupted run never leaves a partial entry.
+		with open(tmp_fname,'wb') as f:
+			np.save(f, read_file_columns(path, params_list, memmap))
+		os.replace(tmp_fname, cache_fname)
+	return np.load(cache_fname, mmap_mode='r')
+
+def get_cached_df(fname_list, params_list, cache_dir, dtype=None, memmap=False):
+	'''
+	Returns the same dataframe as get_df(), built from cached columns. Only files without a valid cache entry (new or modified files) are read from hdf5.
+	Parameters	:
+	fname_list	- path to a directory, or list of several hdf5 file paths or handles.
+	params_list	- list of columns to be extracted from hdf5 file datasets.
+	cache_dir 	- Directory holding cache entries.
+	dtype 		- dtype of returned columns. Defaults to a common dtype of cached columns if None.
+	memmap 		- Slice contiguous datasets of hdf5 files from memory-mapped views on cache misses (see read_columns()).
+	'''
+	blocks 			= [read_cached_columns(path, params_list, cache_dir, memmap) for path in get_paths(fname_list)]
+	if dtype is None:
+		dtype 		= np.result_type(np.float64, *[block.dtype for block in blocks])
+	out 			= np.empty((len(params_list), sum(block.shape[1] for block in blocks)), dtype=dtype)
+	start 			= 0
+	for block in blocks:
+		out[:,start:start+block.shape[1]] 	= block
+		start 		+= block.shape[1]
+	return pd.DataFrame(out.T, columns=params_list, copy=False)
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def get_layout(fname_list, params_list):
+	'''
+	Returns number of particles in each hdf5 file and a common dtype for requested columns of all files, read from dataset shapes and dtypes only.
+	Parameters	:
+	fname_list	- Path to a directory, or a list of paths or open hdf5 file handles, streamed through iter_snapshots().
+	params_list	- list of columns to be extracted from hdf5 file datasets.
+	'''
+	counts 			= list()
+	dtype 			= np.dtype(np.float64)
+	for fname in iter_snapshots(fname_list):
+		counts.append(get_particle_count(fname))
+		dtype 		= np.result_type(dtype, get_columns_dtype(fname,params_list))
+	return counts, dtype
+
+# ------- Compact particle tables : physical columns are stored in float32 and redshift as a categorical column whose codes are snapshot indices.
+
+compact_dtype = np.float32
+
+def get_read_list(params_list, compact=False):
+	'''
+	Returns list of columns to be read from hdf5 file datasets. Redshift is not read in compact mode, where it is added afterwards by add_snapshot_column().
+	Parameters	:
+	params_list	- list of columns of dataframe.
+	compact 	- True for compact particle tables.
+	'''
+	return [param for param in params_list if param != 'redshift'] if compact else params_list
+
+def get_snapshot_column(fname_list):
+	'''
+	Returns a categorical redshift column for all particles of a list of hdf5 files. Codes are indices of files in fname_list (i.e. rows of the snapshot manifest of a directory) stored in the smallest integer type that holds them (int8 for up to 127 snapshots), and categories are redshifts of files. Only filenames and dataset shapes are read.
+	Parameters	:
+	fname_list	- path to a directory, or list of several hdf5 file paths or handles.
+	'''
+	redshifts 	= list()
+	counts 		= list()
+	for fname in iter_snapshots(fname_list):
+		redshifts.append(get_redshift(fname))
+		counts.append(get_particle_count(fname))
+	codes 		= np.repeat(np.arange(len(counts), dtype=np.min_scalar_type(max(len(counts)-1,0))), counts)
+	return pd.Categorical.from_codes(codes, categories=redshifts)
+
+def add_snapshot_column(df, fname_list, params_list):
+	'''
+	Returns a compact dataframe with categorical redshift column added (see get_snapshot_column()), with columns in the order of params_list.
+	Parameters	:
+	df 			- dataframe holding all columns of params_list except redshift.
+	fname_list	- path to a directory, or list of several hdf5 file paths or handles, from which df was read.
+	params_list	- list of columns of dataframe, including redshift.
+	'''
+	df['redshift'] 	= get_snapshot_column(fname_list)
+	if list(df.columns) != params_list:
+		df 			= df[params_list]
+	return df
+
+def get_column(df, col):
+	'''
+	Returns a column of a dataframe, with categorical columns (eg. redshift of compact particle tables) decoded to values of their categories.
+	Parameters	:
+	df 		- a dataframe.
+	col 	- name of column.
+	'''
+	if isinstance(df[col].dtype, pd.CategoricalDtype):
+		return df[col].astype(df[col].cat.categories.dtype)
+	return df[col]
+
+def get_memory_usage(df_list):
+	'''
+	Returns a dataframe containing memory used (in bytes) by each dataframe of a list, along with its number of rows.
+	Parameters	:
+	df_list	- a list of dataframes with their name attributes already set.
+	'''
+	return pd.DataFrame({'assembly' : [df.name for df in df_list],
+						 'rows' 	: [len(df) for df in df_list],
+						 'bytes'	: [df.memory_usage(index=True, deep=True).sum() for df in df_list]})
+
+@instrument
+def get_df(fname_list, params_list=['coords_x', 'coords_y', 'coords_z', 'vel_x', 'vel_y', 'vel_z', 'mass', 'redshift'], workers=None, cache_dir=None, compact=False, memmap=False):
+	'''
+	Returns a concatenated dataframe (of a single assembly type) of all sub-dataframes constructed using individual hdf5 files.
+	Output is allocated once, sized from dataset shapes of all files, and each file is read directly into its slice. This avoids building and concatenating one dataframe per file.
+	Parameters	:
+	fname_list	- path to a directory, or list of several hdf5 file paths or handles. Paths are opened one at a time through iter_snapshots().
+	params_list	- list of columns to be extracted from hdf5 file datasets, defaults to complete dataset.
+	workers 	- number of worker processes reading files in parallel. Files are read serially if None or 1. See get_dfs().
+	cache_dir 	- directory of on-disk cache of columns (eg. get_directory('cache')). Columns are read from hdf5 files, and not cached, if None. See get_cached_df().
+	compact 	- if True, returns a compact particle table : columns read from hdf5 datasets are stored as compact_dtype (float32) and redshift as a categorical column, whose codes are snapshot indices into the manifest.
+	memmap 		- if True, contiguous datasets of files read from hdf5 are sliced from memory-mapped views instead of being read through hdf5 (see read_columns()). Rows are still copied into the dataframe; get_snapshot_views() returns columns of a snapshot without copies.
+	'''
+	params_list 	= list(params_list)
+	if 'redshift' not in params_list:			# Compulsorily add redshift in list of columns.
+		params_list.append('redshift')
+	if workers is not None and workers > 1:
+		return get_dfs([fname_list], params_list, workers, cache_dir, compact, memmap)[0]
+	read_list 		= get_read_list(params_list, compact)
+	if cache_dir is not None:
+		df 			= get_cached_df(fname_list, read_list, cache_dir, compact_dtype if compact else None, memmap)
+	else:
+		counts, dtype 	= get_layout(fname_list, read_list)
+		out 		= np.empty((len(read_list), sum(counts)), dtype=compact_dtype if compact else dtype)
+		start 		= 0
+		for fname in iter_snapshots(fname_list):
+			start 	+= read_columns(fname, read_list, out, start, memmap=memmap)
+		df 			= pd.DataFrame(out.T, columns=read_list, copy=False)
+	if compact:
+		df 			= add_snapshot_column(df, fname_list, params_list)
+	return df
+
+@instrument
+def get_dfs(fname_lists, params_list=['coords_x', 'coords_y', 'coords_z', 'vel_x', 'vel_y', 'vel_z', 'mass', 'redshift'], workers=None, cache_dir=None, compact=False, memmap=False):
+	'''
+	Returns a list of concatenated dataframes, one for each list of hdf5 files (eg. one for each assembly mode), identical to calling get_df() on every list.
+	Files of all lists are spread over a single pool of worker processes. Each result is copied into its slice of a preallocated output as soon as it arrives, so row order follows order of files in each list irrespective of which worker finishes first.
+	Parameters	:
+	fname_lists	- list of directory paths, or of lists of hdf5 file paths or handles.
+	params_list	- list of columns to be extracted from hdf5 file datasets, defaults to complete dataset.
+	workers 	- number of worker processes. Defaults to number of CPUs if None. Files are read serially in this process if set to 1.
+	cache_dir 	- directory of on-disk cache of columns. Workers read only files without a valid cache entry, and write entries for them. No caching if None.
+	compact 	- if True, returns compact particle tables. See get_df().
+	memmap 		- if True, contiguous datasets are sliced from memory-mapped views. See get_df().
+	'''
+	params_list 	= list(params_list)
+	if 'redshift' not in params_list:			# Compulsorily add redshift in list of columns.
+		params_list.append('redshift')
+	if workers is None:
+		workers 	= os.cpu_count()
+	if workers <= 1:
+		return [get_df(fname_list, params_list, cache_dir=cache_dir, compact=compact, memmap=memmap) for fname_list in fname_lists]
+	read_list 		= get_read_list(params_list, compact)
+	outs 			= list()
+	slots 			= list()					# (index of output, start, stop) for every file, in order of submission.
+	for i, fname_list in enumerate(fname_lists):
+		counts, dtype 	= get_layout(fname_list, read_list)
+		outs.append(np.empty((len(read_list), sum(counts)), dtype=compact_dtype if compact else dtype))
+		starts 		= np.cumsum([0]+counts)
+		slots 		+= [(i, starts[j], starts[j+1]) for j in range(len(counts))]
+	paths 			= [path for fname_list in fname_lists for path in get_paths(fname_list)]
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		if cache_dir is None:
+			futures = {executor.submit(read_file_columns, path, read_list, memmap) : slot for path, slot in zip(paths, slots)}
+		else:
+			futures = {executor.submit(read_cached_columns, path, read_list, cache_dir, memmap) : slot for path, slot in zip(paths, slots)}
+		for future in as_completed(futures):
+			i, start, stop 			= futures.pop(future)
+			outs[i][:,start:stop] 	= future.result()
+	df_list 		= [pd.DataFrame(out.T, columns=read_list, copy=False) for out in outs]
+	if compact:
+		df_list 	= [add_snapshot_column(df, fname_list, params_list) for df, fname_list in zip(df_list, fname_lists)]
+	return df_list
+
+# ++++++++++++++++++++ Snapshot manifest (hdf5 metadata only)
+
+manifests = dict()								# Manifests already built, keyed by directory and identity (size, modification time) of its files.
+
+@instrument
+def get_manifest(directory, name=None):
+	'''
+	Returns a manifest dataframe with one row per hdf5 file of a directory, sorted by snapshot number. Columns are path, snapshot, redshift, counts (number of particles), shape and dtype of every dataset (eg. Mass_shape, Mass_dtype) and attributes of Header group (eg. NumStars_30kpc).
+	Only filenames and hdf5 metadata are read, no particle data. A manifest is built once per directory and rebuilt only if its files change.
+	Parameters	:
+	directory 	- Path to directory of hdf5 files.
+	name 		- Plot-friendly name of assembly mode, set as name attribute of the manifest.
+	'''
+	paths 		= get_paths(directory)
+	key 		= (os.path.abspath(directory),)+tuple((path,os.stat(path).st_size,os.stat(path).st_mtime_ns) for path in paths)
+	if key not in manifests:
+		rows 	= list()
+		for fname in iter_snapshots(paths):
+			snapshot, redshift 	= parse_snapshot_fname(fname.filename)
+			row 				= {'path':fname.filename, 'snapshot':snapshot, 'redshift':redshift, 'counts':get_particle_count(fname)}
+			for dataset, item in fname.items():
+				if isinstance(item, h5py.Dataset):
+					row[dataset+'_shape'] 	= item.shape
+					row[dataset+'_dtype'] 	= str(item.dtype)
+			if 'Header' in fname:
+				row.update(fname['Header'].attrs)		# Header attributes, eg. NumStars_30kpc
+			rows.append(row)
+		manifests[key] 	= pd.DataFrame(rows, columns=['path','snapshot','redshift','counts'] if not rows else None).sort_values('snapshot',ignore_index=True)
+	manifest 				= manifests[key].copy()
+	manifest.attrs['kind'] 	= 'manifest'
+	manifest.name 			= name
+	return manifest
+
+def is_manifest(df):
+	'''
+	Returns True if a dataframe is a snapshot manifest built by get_manifest().
+	Parameters	:
+	df 	- a dataframe.
+	'''
+	return df.attrs.get('kind') == 'manifest'
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+@instrument
+def get_particle_distribution(df_list,col='redshift'):
+	'''
+	Returns a single dataframe containing value counts of different values of column "col".
+	Parameters	:
+	df_list	- a list of dataframes to be concatenated. Snapshot manifests (see get_manifest()) or summary dataframes (see read_summary()) can be passed instead of particle dataframes, in which case counts are taken from them without reading particle data.
+	col 	- column which acts as index vor value counts.
+	'''
+	df 		= pd.DataFrame()
+	for subdf in df_list:
+		if is_manifest(subdf) or is_summary(subdf):
+			count 			= subdf.groupby(col)['counts'].sum().sort_index(ascending=True).to_frame(name='counts')
+		else:
+			count			= get_column(subdf,col).value_counts().sort_index(ascending=True).to_frame(name='counts')
+		count['assembly']	= subdf.name
+		count[col]			= count.index
+		df 					= pd.concat([df,count])
+	return df
+
+@instrument
+def get_total_mass_in_particles_with_redshift(df_list):
+	'''
+	Returns a concatenated dataframe containing redshift, sum of particle masses at a given redshift and assembly mode.
+	Parameters	:
+	df_list 	- List of dataframes (presumably, with different assembly modes) for which distribution is to be plotted. Snapshot manifests, reductions returned by reduce_snapshots() or summary dataframes (see read_summary()) can be passed instead of particle dataframes; masses of manifests are then summed out-of-core.
+	'''
+	subdf_list 	= list()
+	for subdf in df_list:
+		if is_manifest(subdf):
+			subdf 			= reduce_snapshots(subdf, ['mass'])
+		if subdf.attrs.get('kind') in ('reduction','summary'):
+			grouped_df 		= subdf.groupby(['redshift'],as_index=False).agg({'mass':'sum'})
+		else:									# Masses are summed in float64 irrespective of dtype of mass column (float32 in compact particle tables).
+			grouped_df 		= get_column(subdf,'mass').astype(np.float64).groupby(get_column(subdf,'redshift')).sum().reset_index()
+		grouped_df.name 	= subdf.name
+		subdf_list.append(grouped_df)
+	add_assembly_column(subdf_list)
+	return pd.concat(subdf_list)
+
+# ----------------------- Out-of-core reduction functions ----------------
+
+def add_compensated(total, compensation, values):
+	'''
+	Returns updated (total, compensation) after adding values to total using Neumaier's compensated summation. Works element-wise on arrays; the true sum is total + compensation.
+	Parameters	:
+	total 			- running sum.
+	compensation	- running compensation of rounding errors of total.
+	values 			- values to be added.
+	'''
+	new_total 		= total + values
+	compensation 	= compensation + np.where(np.abs(total) >= np.abs(values), (total-new_total)+values, (values-new_total)+total)
+	return new_total, compensation
+
+def get_reduction(columns):
+	'''
+	Returns empty running aggregates of columns (see update_reduction()).
+	Parameters	:
+	columns 	- number of columns.
+	'''
+	return {'sum':np.zeros(columns), 'compensation':np.zeros(columns), 'min':np.full(columns, np.inf), 'max':np.full(columns, -np.inf), 'counts':0}
+
+def update_reduction(reduction, block):
+	'''
+	Adds a block of rows (eg. a chunk of a file) to running aggregates, in place, and returns them. The block is summed in float64 and accumulated across blocks with compensated summation.
+	Parameters	:
+	reduction 	- running aggregates (see get_reduction()).
+	block 		- array of shape (number of columns, number of rows).
+	'''
+	reduction['sum'], reduction['compensation'] 	= add_compensated(reduction['sum'], reduction['compensation'], block.sum(axis=1, dtype=np.float64))
+	if block.shape[1]:
+		reduction['min'] 	= np.minimum(reduction['min'], block.min(axis=1))
+		reduction['max'] 	= np.maximum(reduction['max'], block.max(axis=1))
+	reduction['counts'] 	+= block.shape[1]
+	return reduction
+
+def finish_reduction(reduction):
+	'''
+	Returns a dictionary of per-column aggregates from running aggregates : sum, mean, min and max of each column (as float64 arrays) and number of rows.
+	Parameters	:
+	reduction 	- running aggregates (see update_reduction()).
+	'''
+	total 	= reduction['sum']+reduction['compensation']
+	count 	= reduction['counts']
+	return {'sum':total, 'mean':total/count if count else np.full(len(total), np.nan), 'min':reduction['min'], 'max':reduction['max'], 'counts':count}
+
+def reduce_file(fname, params_list, chunk_rows=2**20):
+	'''
+	Returns a dictionary of per-column aggregates of a single hdf5 file : sum, mean, min and max of each column (as float64 arrays in the order of params_list) and number of particles. Columns are streamed in chunks of chunk_rows rows, summed in float64 within a chunk and accumulated across chunks with compensated summation.
+	Parameters	:
+	fname 		- Open handle for an hdf5 file.
+	params_list	- List of columns from hdf5 file to be reduced.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	reduction 	= get_reduction(len(params_list))
+	for lo, block in iter_column_chunks(fname, params_list, chunk_rows):
+		update_reduction(reduction, block)
+	return finish_reduction(reduction)
+
+def get_reduction_df(manifest, aggregates_list, params_list):
+	'''
+	Returns a tidy dataframe with one row per snapshot of a manifest and columns snapshot, redshift, counts and, for each column col in params_list, col (sum over particles), col_mean, col_min and col_max.
+	Parameters	:
+	manifest 		- Snapshot manifest of an assembly mode. Its name is carried over to the returned dataframe.
+	aggregates_list	- per-column aggregates of each snapshot (see reduce_file()), in manifest order.
+	params_list		- List of reduced columns.
+	'''
+	rows 		= list()
+	for aggregates, snapshot, redshift in zip(aggregates_list, manifest['snapshot'], manifest['redshift']):
+		row 			= {'snapshot':snapshot, 'redshift':redshift, 'counts':aggregates['counts']}
+		for i, param in enumerate(params_list):
+			row[param] 			= aggregates['sum'][i]
+			row[param+'_mean'] 	= aggregates['mean'][i]
+			row[param+'_min'] 	= aggregates['min'][i]
+			row[param+'_max'] 	= aggregates['max'][i]
+		rows.append(row)
+	df 				= pd.DataFrame(rows, columns=['snapshot','redshift','counts']+[param+suffix for param in params_list for suffix in ('','_mean','_min','_max')])
+	df.attrs['kind'] 	= 'reduction'
+	df.name 		= manifest.name
+	return df
+
+@instrument
+def reduce_snapshots(manifest, params_list=['mass'], chunk_rows=2**20):
+	'''
+	Returns a tidy dataframe with one row per snapshot of a manifest and columns snapshot, redshift, counts and, for each column col in params_list, col (sum over particles), col_mean, col_min and col_max (see get_reduction_df()). Files are streamed one at a time in chunks, so memory use does not depend on size of snapshots.
+	Parameters	:
+	manifest 	- Snapshot manifest of an assembly mode (see get_manifest()). Its name is carried over to the returned dataframe.
+	params_list	- List of columns from hdf5 files to be reduced, defaults to particle mass.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	return get_reduction_df(manifest, [reduce_file(fname, params_list, chunk_rows) for fname in iter_snapshots(list(manifest['path']))], params_list)
+
+# ----------------------- Histogram functions ----------------------------
+
+def get_bin_edges(lo, hi, bins=150, log=False):
+	'''
+	Returns bins+1 bin edges spanning [lo, hi], spaced linearly or logarithmically. Histograms sharing the same edges can be merged by adding their counts.
+	Parameters	:
+	lo, hi 	- lowest and highest edge. For log spacing, lo must be positive.
+	bins 	- number of bins.
+	log 	- log spaced edges if True, else linearly spaced edges.
+	'''
+	if hi <= lo:								# Widen a degenerate range (eg. all particles with equal mass) to a single finite width.
+		lo, hi 	= (lo/2, lo*2) if log else (lo-0.5, lo+0.5)
+	return np.geomspace(lo, hi, bins+1) if log else np.linspace(lo, hi, bins+1)
+
+@instrument
+def get_shared_bin_edges(manifest_list, col='mass', bins=150, log=False):
+	'''
+	Returns bin edges shared by all snapshots of all manifests, spanning range of values of col. Range is found by an out-of-core reduction (see reduce_snapshots()). For summary dataframes, edges of stored histograms are returned instead, coarsened to bins bins if possible (see get_summary_edges()).
+	Parameters	:
+	manifest_list	- list of snapshot manifests (eg. one per assembly mode), or of summary dataframes of the same summary file.
+	col 			- column from hdf5 file datasets.
+	bins 			- number of bins.
+	log 			- log spaced edges if True, else linearly spaced edges.
+	'''
+	if manifest_list and all(is_summary(manifest) for manifest in manifest_list):
+		return get_summary_edges(manifest_list[0], col, bins)
+	reductions 	= [reduce_snapshots(manifest, [col]) for manifest in manifest_list]
+	lo 			= min(reduction[col+'_min'].min() for reduction in reductions)
+	hi 			= max(reduction[col+'_max'].max() for reduction in reductions)
+	return get_bin_edges(lo, hi, bins, log)
+
+def add_to_histogram(counts, values, edges, log=False):
+	'''
+	Adds counts of values falling in each bin to counts, in place, and returns counts. Bins are found arithmetically for linear or log spaced edges (see get_bin_edges()), with last bin including the highest edge as in np.histogram. Values outside edges, or not finite, are ignored.
+	Parameters	:
+	counts 	- integer array of length len(edges)-1.
+	values 	- array of values.
+	edges 	- linear or log spaced bin edges.
+	log 	- True if edges are log spaced.
+	'''
+	bins 		= len(edges)-1
+	if log:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			values 	= np.log10(values)
+		edges 	= np.log10(edges)
+	values 		= values[(values >= edges[0]) & (values <= edges[-1])]
+	index 		= ((values-edges[0])*(bins/(edges[-1]-edges[0]))).astype(np.intp)
+	np.minimum(index, bins-1, out=index)
+	counts 		+= np.bincount(index, minlength=bins)
+	return counts
+
+def histogram_file(path, edges, col='mass', log=False, chunk_rows=2**20):
+	'''
+	Returns histogram counts of a column of a single hdf5 file, accumulated chunk by chunk. The file is opened by path, so that this can run in a worker process.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	edges 		- linear or log spaced bin edges.
+	col 		- column from hdf5 file datasets.
+	log 		- True if edges are log spaced.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	counts 		= np.zeros(len(edges)-1, dtype=np.int64)
+	with open_file(path) as fname:
+		for lo, block in iter_column_chunks(fname, [col], chunk_rows):
+			add_to_histogram(counts, block[0], edges, log)
+	return counts
+
+def get_histograms(manifest, edges, col='mass', log=False, workers=1):
+	'''
+	Returns an array of shape (number of snapshots, number of bins) holding histogram counts of col for each snapshot of a manifest, in manifest order. Snapshots can be spread over worker processes; counts of any subset of particles sharing the same edges add up, so histograms are mergeable across processes and assembly modes.
+	Counts of a summary dataframe are read from its summary file instead (see get_summary_histograms()).
+	Parameters	:
+	manifest 	- snapshot manifest of an assembly mode (see get_manifest()), or summary dataframe (see read_summary()).
+	edges 		- linear or log spaced bin edges.
+	col 		- column from hdf5 file datasets.
+	log 		- True if edges are log spaced.
+	workers 	- number of worker processes. Snapshots are histogrammed serially if 1.
+	'''
+	if is_summary(manifest):
+		return get_summary_histograms(manifest, col, edges)[1]
+	paths 		= list(manifest['path'])
+	if workers <= 1:
+		counts 	= [histogram_file(path, edges, col, log) for path in paths]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			counts 	= list(executor.map(histogram_file, paths, *zip(*[(edges, col, log)]*len(paths))))
+	return np.array(counts, dtype=np.int64).reshape(len(paths), len(edges)-1)
+
+@instrument
+def get_histogram_df(manifest_list, edges, col='mass', log=False, workers=1):
+	'''
+	Returns a tidy dataframe of pre-binned counts with one row per assembly mode, snapshot and bin. Columns are assembly, snapshot, redshift, col (bin centre, geometric for log spaced edges), bin_left, bin_right and counts.
+	Parameters	:
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	edges 			- linear or log spaced bin edges, shared by all manifests.
+	col 			- column from hdf5 file datasets.
+	log 			- True if edges are log spaced.
+	workers 		- number of worker processes. See get_histograms().
+	'''
+	centres 	= np.sqrt(edges[:-1]*edges[1:]) if log else (edges[:-1]+edges[1:])/2
+	bins 		= len(edges)-1
+	subdf_list 	= list()
+	for manifest in manifest_list:
+		counts 				= get_histograms(manifest, edges, col, log, workers)
+		subdf 				= pd.DataFrame({'snapshot'	: np.repeat(manifest['snapshot'].to_numpy(), bins),
+											'redshift'	: np.repeat(manifest['redshift'].to_numpy(), bins),
+											col 		: np.tile(centres, len(manifest)),
+											'bin_left'	: np.tile(edges[:-1], len(manifest)),
+											'bin_right'	: np.tile(edges[1:], len(manifest)),
+											'counts'	: counts.ravel()})
+		subdf.name 			= manifest.name
+		subdf_list.append(subdf)
+	add_assembly_column(subdf_list)
+	return pd.concat(subdf_list, ignore_index=True)
+
+def merge_histogram_dfs(hist_df_list, by=['assembly','snapshot','redshift']):
+	'''
+	Returns a single histogram dataframe adding up counts of several histogram dataframes (eg. computed by different processes for different subsets of particles) sharing the same bin edges.
+	Parameters	:
+	hist_df_list	- list of dataframes returned by get_histogram_df().
+	by 				- columns identifying a histogram, in addition to bin edges. Leave out snapshot and redshift to merge over all snapshots.
+	'''
+	df 			= pd.concat(hist_df_list, ignore_index=True)
+	keys 		= list(by)+[col for col in df.columns if col not in by and col not in ('assembly','snapshot','redshift','counts')]
+	return df.groupby(keys, as_index=False, observed=True, sort=False)['counts'].sum()
+
+# ----------------------- Quantile sketch functions -----------------------
+
+# ------- Quantile sketches (KLL) summarize a column with a bounded number of items, answering quantiles to within a rank error of about 1.7/k (99% confidence), irrespective of number of particles.
+# ------- A sketch is a dictionary : k (accuracy parameter), n (number of values), min and max (exact), seed and compactions (state of random compactions) and levels, a list of arrays of items where items at level h stand for 2**h values each.
+
+sketch_k = 200
+
+def get_sketch(k=None, seed=0):
+	'''
+	Returns an empty quantile sketch (see sketch_k).
+	Parameters	:
+	k 		- accuracy parameter, sketch_k if None. Size of a sketch grows as about 3k items.
+	seed 	- seed of random compactions, so that sketches are reproducible.
+	'''
+	return {'k':sketch_k if k is None else k, 'n':0, 'min':np.inf, 'max':-np.inf, 'seed':seed, 'compactions':0, 'levels':[np.empty(0)]}
+
+def get_level_capacity(k, height, level):
+	'''
+	Returns largest number of items kept at a level of a sketch with height levels before it is compacted. Capacities shrink geometrically (by 2/3) from top level down.
+	Parameters	:
+	k 		- accuracy parameter of sketch.
+	height 	- number of levels of sketch.
+	level 	- level, 0 at bottom.
+	'''
+	return max(2, int(np.ceil(k*(2/3)**(height-1-level))))
+
+def compress_sketch(sketch):
+	'''
+	Compacts levels of a sketch holding more items than their capacity, in place, and returns it. A compaction sorts the items of a level and promotes every other item (starting from a random offset) to the level above, where it stands for twice as many values; an odd item is left behind.
+	Parameters	:
+	sketch 	- quantile sketch.
+	'''
+	levels 		= sketch['levels']
+	while True:
+		over 		= [level for level, items in enumerate(levels) if len(items) > get_level_capacity(sketch['k'], len(levels), level)]
+		if not over:
+			return sketch
+		level 		= over[0]
+		if level+1 == len(levels):
+			levels.append(np.empty(0))
+		items 		= np.sort(levels[level])
+		odd 		= len(items)%2
+		offset 		= np.random.default_rng([sketch['seed'], sketch['compactions']]).integers(2)
+		levels[level] 		= items[:odd]
+		levels[level+1] 	= np.concatenate((levels[level+1], items[odd+offset::2]))
+		sketch['compactions'] += 1
+
+def update_sketch(sketch, values):
+	'''
+	Adds an array of values (eg. a chunk of a column) to a sketch, in place, and returns it. Values are added in bulk and compacted as a whole, so cost per chunk is that of sorting it. Values which are not finite are ignored.
+	Parameters	:
+	sketch 	- quantile sketch.
+	values 	- array of values.
+	'''
+	values 				= np.asarray(values, dtype=np.float64)
+	values 				= values[np.isfinite(values)]
+	if len(values):
+		sketch['n'] 		+= len(values)
+		sketch['min'] 		= min(sketch['min'], values.min())
+		sketch['max'] 		= max(sketch['max'], values.max())
+		sketch['levels'][0] = np.concatenate((sketch['levels'][0], values))
+		compress_sketch(sketch)
+	return sketch
+
+def merge_sketches(sketches):
+	'''
+	Returns a sketch of all values summarized by several sketches (eg. of different snapshots, or computed by different processes), with accuracy of the sketch with smallest k. Sketches are not modified.
+	Parameters	:
+	sketches 	- list of quantile sketches.
+	'''
+	merged 		= get_sketch(min(sketch['k'] for sketch in sketches), sketches[0]['seed'])
+	height 		= max(len(sketch['levels']) for sketch in sketches)
+	merged['levels'] 		= [np.concatenate([sketch['levels'][level] for sketch in sketches if level < len(sketch['levels'])]) for level in range(height)]
+	merged['n'] 			= sum(sketch['n'] for sketch in sketches)
+	merged['min'] 			= min(sketch['min'] for sketch in sketches)
+	merged['max'] 			= max(sketch['max'] for sketch in sketches)
+	merged['compactions'] 	= sum(sketch['compactions'] for sketch in sketches)
+	return compress_sketch(merged)
+
+def get_weighted_items(sketch):
+	'''
+	Returns (items, weights) of a sketch, sorted by item, where weight of an item is number of values it stands for.
+	Parameters	:
+	sketch 	- quantile sketch.
+	'''
+	items 		= np.concatenate(sketch['levels'])
+	weights 	= np.concatenate([np.full(len(items), 2**level, dtype=np.int64) for level, items in enumerate(sketch['levels'])])
+	order 		= np.argsort(items, kind='stable')
+	return items[order], weights[order]
+
+def get_sketch_quantiles(sketch, quantiles):
+	'''
+	Returns estimated values at quantiles (eg. 0.5 for median) of values summarized by a sketch, NaN for an empty sketch. Quantiles 0 and 1 are exact (minimum and maximum).
+	Parameters	:
+	sketch 		- quantile sketch.
+	quantiles 	- quantile or array of quantiles, between 0 and 1.
+	'''
+	quantiles 	= np.asarray(quantiles, dtype=np.float64)
+	if sketch['n'] == 0:
+		return np.full(quantiles.shape, np.nan)
+	items, weights 	= get_weighted_items(sketch)
+	cumulative 		= np.cumsum(weights)
+	index 			= np.minimum(np.searchsorted(cumulative, quantiles*cumulative[-1], side='left'), len(items)-1)
+	return np.where(quantiles <= 0, sketch['min'], np.where(quantiles >= 1, sketch['max'], items[index]))
+
+def get_sketch_ranks(sketch, values):
+	'''
+	Returns estimated fraction of values summarized by a sketch which are not larger than each of values (empirical cumulative distribution function), NaN for an empty sketch.
+	Parameters	:
+	sketch 	- quantile sketch.
+	values 	- value or array of values.
+	'''
+	values 			= np.asarray(values, dtype=np.float64)
+	if sketch['n'] == 0:
+		return np.full(values.shape, np.nan)
+	items, weights 	= get_weighted_items(sketch)
+	cumulative 		= np.concatenate(([0], np.cumsum(weights)))
+	return cumulative[np.searchsorted(items, values, side='right')]/cumulative[-1]
+
+def sketch_to_arrays(sketch):
+	'''
+	Returns a dictionary of numpy arrays holding a sketch (header of k, n, seed and compactions, min and max, number of items per level and items of all levels), eg. to be saved with np.savez or as hdf5 datasets.
+	Parameters	:
+	sketch 	- quantile sketch.
+	'''
+	return {'header'	: np.array([sketch['k'], sketch['n'], sketch['seed'], sketch['compactions']], dtype=np.int64),
+			'range'		: np.array([sketch['min'], sketch['max']]),
+			'sizes'		: np.array([len(items) for items in sketch['levels']], dtype=np.int64),
+			'items'		: np.concatenate(sketch['levels'])}
+
+def sketch_from_arrays(arrays):
+	'''
+	Returns a sketch from arrays returned by sketch_to_arrays().
+	Parameters	:
+	arrays 	- dictionary (or npz file, or hdf5 group) of arrays.
+	'''
+	k, n, seed, compactions 	= (int(value) for value in arrays['header'][()])
+	lo, hi 						= (float(value) for value in arrays['range'][()])
+	bounds 						= np.cumsum(np.concatenate(([0], arrays['sizes'][()])))
+	items 						= np.asarray(arrays['items'][()], dtype=np.float64)
+	return {'k':k, 'n':n, 'min':lo, 'max':hi, 'seed':seed, 'compactions':compactions, 'levels':[items[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]}
+
+def sketch_file(path, params_list=['mass'], k=None, seed=0, chunk_rows=2**20):
+	'''
+	Returns a dictionary mapping each requested column of a single hdf5 file to a quantile sketch of its values, filled chunk by chunk in one pass. The file is opened by path, so that this can run in a worker process.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	params_list	- List of columns, raw or derived (see derived_columns).
+	k 			- accuracy parameter of sketches, sketch_k if None.
+	seed 		- seed of random compactions.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	sketches 	= {param : get_sketch(k, seed) for param in params_list}
+	with open_file(path) as fname:
+		for lo, block in iter_column_chunks(fname, params_list, chunk_rows):
+			for param, values in zip(params_list, block):
+				update_sketch(sketches[param], values)
+	return sketches
+
+@instrument
+def get_sketches(manifest, params_list=['mass'], k=None, seed=0, workers=1):
+	'''
+	Returns a list of dictionaries, one per snapshot of a manifest in manifest order, mapping each requested column to a quantile sketch of its values (see sketch_file()). Snapshots can be spread over worker processes. Sketches of a summary dataframe are read from its summary file instead (see get_summary_sketches()).
+	Parameters	:
+	manifest 	- snapshot manifest of an assembly mode (see get_manifest()), or summary dataframe (see read_summary()).
+	params_list	- List of columns, raw or derived.
+	k 			- accuracy parameter of sketches, sketch_k if None.
+	seed 		- seed of random compactions.
+	workers 	- number of worker processes. Snapshots are sketched serially if 1.
+	'''
+	if is_summary(manifest):
+		return get_summary_sketches(manifest, params_list)
+	paths 		= list(manifest['path'])
+	if workers <= 1:
+		return [sketch_file(path, params_list, k, seed) for path in paths]
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(sketch_file, paths, *zip(*[(params_list, k, seed)]*len(paths))))
+
+@instrument
+def get_quantile_df(manifest_list, params_list=['mass'], quantiles=[0.05,0.16,0.25,0.5,0.75,0.84,0.95], k=None, workers=1, merge_snapshots=False):
+	'''
+	Returns a tidy dataframe of quantiles of columns for each assembly mode and snapshot, estimated from quantile sketches without holding particles in memory. Columns are assembly, snapshot, redshift, field, counts, one column per quantile (eg. q0.5 for median) and iqr (interquartile range, q0.75-q0.25).
+	Parameters	:
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	params_list		- list of columns, raw or derived.
+	quantiles 		- list of quantiles, between 0 and 1.
+	k 				- accuracy parameter of sketches, sketch_k if None.
+	workers 		- number of worker processes (see get_sketches()).
+	merge_snapshots	- merge sketches of all snapshots of an assembly mode, one row per assembly mode and field (snapshot and redshift are then NaN).
+	'''
+	rows 		= list()
+	for manifest in manifest_list:
+		sketches 	= get_sketches(manifest, params_list, k, workers=workers)
+		if merge_snapshots:
+			entries 	= [(np.nan, np.nan, {param : merge_sketches([sketch[param] for sketch in sketches]) for param in params_list})] if sketches else []
+		else:
+			entries 	= zip(manifest['snapshot'], manifest['redshift'], sketches)
+		for snapshot, redshift, sketch in entries:
+			for param in params_list:
+				values 	= get_sketch_quantiles(sketch[param], [0.25,0.75]+list(quantiles))
+				row 	= {'assembly':manifest.name, 'snapshot':snapshot, 'redshift':redshift, 'field':param, 'counts':sketch[param]['n']}
+				row.update(('q'+format(quantile,'g'), value) for quantile, value in zip(quantiles, values[2:]))
+				row['iqr'] 	= values[1]-values[0]
+				rows.append(row)
+	df 				= pd.DataFrame(rows)
+	df['assembly'] 	= pd.Categorical(df['assembly'], categories=list(dict.fromkeys(manifest.name for manifest in manifest_list)))
+	return df
+
+# ----------------------- Summary file functions --------------------------
+
+# ------- Reduced products of a run are written to a single hdf5 summary file (see write_summary()), with one group per assembly mode holding one row per snapshot in each dataset, chunked one snapshot per chunk. Histograms are stored at summary_bins bins, which divide evenly into the bins used by plotters (150, 60) so that they can be coarsened exactly (see get_summary_histograms()).
+
+summary_bins = 600
+
+# ------- Compression of datasets of summary files.
+
+summary_compression = dict(compression='gzip', compression_opts=4, shuffle=True)
+
+def get_file_digest(path, block_bytes=2**20):
+	'''
+	Returns sha256 hex digest of contents of a file, read in blocks.
+	Parameters	:
+	path 		- Path to a file.
+	block_bytes	- Number of bytes read at once.
+	'''
+	digest 		= hashlib.sha256()
+	with open(path,'rb') as f:
+		for block in iter(lambda : f.read(block_bytes), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+# ------- Grid histograms : counts on bins of width 2**exponent aligned to zero (of log10 of values for log spaced bins), coarsened by merging pairs of bins whenever values span more than bins bins. Range of values need not be known in advance, and histograms on the same grid add up.
+
+def get_grid_histogram(bins):
+	'''
+	Returns an empty grid histogram of at most bins bins.
+	Parameters	:
+	bins 	- largest number of bins.
+	'''
+	return {'bins':bins, 'exponent':None, 'start':0, 'counts':np.zeros(0, dtype=np.int64)}
+
+def coarsen_grid_histogram(histogram, exponent, start=None, stop=None):
+	'''
+	Moves counts of a grid histogram onto bins of width 2**exponent (not finer than its own) spanning bin indices start to stop (excluded), in place, and returns it. Bins span at least its counts if start and stop are None.
+	Parameters	:
+	histogram 	- grid histogram (see get_grid_histogram()).
+	exponent 	- exponent of width of bins.
+	start, stop	- range of bin indices of width 2**exponent, which must include all non-empty bins.
+	'''
+	factor 		= 2**(exponent-histogram['exponent']) if histogram['exponent'] is not None else 1
+	index 		= (histogram['start']+np.arange(len(histogram['counts']))) // factor
+	start 		= int(index[0]) if start is None and len(index) else (0 if start is None else start)
+	stop 		= int(index[-1])+1 if stop is None and len(index) else (start if stop is None else stop)
+	counts 		= np.zeros(stop-start, dtype=np.int64)
+	np.add.at(counts, index-start, histogram['counts'])
+	histogram.update({'exponent':exponent, 'start':start, 'counts':counts})
+	return histogram
+
+def get_grid_exponent(lo, hi, bins, exponent=None):
+	'''
+	Returns smallest exponent, not below exponent, such that bins of width 2**exponent aligned to zero hold values from lo to hi in at most bins bins.
+	Parameters	:
+	lo, hi 		- lowest and highest value.
+	bins 		- largest number of bins.
+	exponent 	- smallest exponent, or None to start from the width of (hi-lo)/bins (or of lo/bins if hi equals lo).
+	'''
+	if exponent is None:
+		span 		= hi-lo if hi > lo else max(abs(lo), 1.)
+		exponent 	= int(np.floor(np.log2(span/bins)))
+	while np.floor(np.ldexp(hi, -exponent))-np.floor(np.ldexp(lo, -exponent)) >= bins:
+		exponent 	+= 1
+	return exponent
+
+def update_grid_histogram(histogram, values, log=False):
+	'''
+	Adds an array of values (eg. a chunk of a column) to a grid histogram, in place, and returns it. Values which are not finite (or not positive, for log spaced bins) are ignored.
+	Parameters	:
+	histogram 	- grid histogram (see get_grid_histogram()).
+	values 		- array of values.
+	log 		- bins of log10 of values if True.
+	'''
+	values 		= np.asarray(values, dtype=np.float64)
+	if log:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			values 	= np.log10(values)
+	values 		= values[np.isfinite(values)]
+	if not len(values):
+		return histogram
+	lo, hi 		= values.min(), values.max()
+	if len(histogram['counts']):
+		lo 		= min(lo, np.ldexp(float(histogram['start']), histogram['exponent']))
+		hi 		= max(hi, np.ldexp(float(histogram['start']+len(histogram['counts'])-1), histogram['exponent']))
+	exponent 	= get_grid_exponent(lo, hi, histogram['bins'], histogram['exponent'])
+	start 		= int(np.floor(np.ldexp(lo, -exponent)))
+	coarsen_grid_histogram(histogram, exponent, start, int(np.floor(np.ldexp(hi, -exponent)))+1)
+	histogram['counts'] 	+= np.bincount((np.floor(np.ldexp(values, -exponent))-start).astype(np.intp), minlength=len(histogram['counts']))
+	return histogram
+
+def align_grid_histograms(histograms, bins, log=False):
+	'''
+	Returns (edges, counts) of grid histograms (eg. of different snapshots) moved onto exactly bins shared bins, with counts an array of shape (number of histograms, bins). Bins are the finest ones of the grid holding values of all histograms, so that values span more than half of them; bins past the highest value are left empty.
+	Parameters	:
+	histograms 	- list of grid histograms with at most bins bins each.
+	bins 		- number of bins.
+	log 		- True if histograms are of log10 of values (see update_grid_histogram()), so that edges are log spaced.
+	'''
+	filled 		= [histogram for histogram in histograms if len(histogram['counts'])]
+	if not filled:
+		return get_bin_edges(1., 10., bins, log) if log else get_bin_edges(0., 1., bins), np.zeros((len(histograms), bins), dtype=np.int64)
+	exponent 	= max(histogram['exponent'] for histogram in filled)
+	lo 			= min(np.ldexp(float(histogram['start']), histogram['exponent']) for histogram in filled)
+	hi 			= max(np.ldexp(float(histogram['start']+len(histogram['counts'])-1), histogram['exponent']) for histogram in filled)
+	exponent 	= get_grid_exponent(lo, hi, bins, exponent)
+	start 		= int(np.floor(np.ldexp(lo, -exponent)))
+	counts 		= np.array([coarsen_grid_histogram(dict(histogram), exponent, start, start+bins)['counts'] for histogram in histograms], dtype=np.int64).reshape(len(histograms), bins)
+	edges 		= np.ldexp(np.arange(start, start+bins+1, dtype=np.float64), exponent)
+	return (10**edges if log else edges), counts
+
+def summarize_file(path, params_list, bins, log=False, k=None, seed=0, chunk_rows=2**20):
+	'''
+	Returns (aggregates, histograms, sketches, digest) of a single hdf5 file, accumulated in one pass over its columns : per-column aggregates (see reduce_file()), a list of grid histograms (see get_grid_histogram()) and of quantile sketches (see get_sketch()) in the order of params_list, and sha256 digest of the file, read right after its columns. The file is opened by path, so that this can run in a worker process.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	params_list	- List of columns, raw or derived.
+	bins 		- largest number of bins of histograms.
+	log 		- log spaced bins if True.
+	k 			- accuracy parameter of sketches, sketch_k if None.
+	seed 		- seed of random compactions.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	reduction 	= get_reduction(len(params_list))
+	histograms 	= [get_grid_histogram(bins) for param in params_list]
+	sketches 	= [get_sketch(k, seed) for param in params_list]
+	with open_file(path) as fname:
+		for lo, block in iter_column_chunks(fname, params_list, chunk_rows):
+			update_reduction(reduction, block)
+			for i, values in enumerate(block):
+				update_grid_histogram(histograms[i], values, log)
+				update_sketch(sketches[i], values)
+	return finish_reduction(reduction), histograms, sketches, get_file_digest(path)
+
+def create_summary_dataset(group, name, data):
+	'''
+	Creates a compressed dataset of a summary file, chunked along its first axis (snapshots) with one row per chunk, or 2**14 items per chunk for 1D datasets. Returns the dataset.
+	Parameters	:
+	group 	- hdf5 group.
+	name 	- name of dataset, relative to group.
+	data 	- array.
+	'''
+	data 		= np.asarray(data)
+	if data.size == 0:
+		return group.create_dataset(name, data=data)
+	chunks 		= (min(len(data), 2**14),) if data.ndim == 1 else (1,)+data.shape[1:]
+	return group.create_dataset(name, data=data, chunks=chunks, **summary_compression)
+
+@instrument
+def write_summary(path, manifest_list, params_list=['mass'], bins=None, log=False, k=None, workers=1):
+	'''
+	Writes reduced products of snapshot manifests to a single hdf5 summary file and returns its path. Each assembly mode is a group holding, with one row per snapshot :
+		reductions 			- counts, sum, mean, min and max of each column (see reduce_snapshots()), with column names in its columns attribute.
+		histograms/<col> 	- histogram counts of each column, on bin edges shared by all assembly modes and stored in edges/<col> at the root. Edges are bins of a grid aligned to zero (see align_grid_histograms()), so that histograms are built in the same pass as reductions, without knowing range of values in advance; values span more than half of bins.
+		sketches/<col> 		- quantile sketches of each column (see sketch_to_arrays()), with items of all snapshots concatenated and delimited by offsets.
+	Snapshot numbers, redshifts, source file paths and their sha256 digests are attributes (snapshot, redshift, source, sha256) of each group. Each snapshot is read once (see summarize_file()). The file is written to a temporary file first and moved in place, so that an interrupted run never leaves a partial summary.
+	Parameters	:
+	path 			- Path of summary file. Its directory is created if it does not exist.
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	params_list		- list of columns, raw or derived.
+	bins 			- number of bins of histograms, summary_bins if None.
+	log 			- log spaced bins if True, else linearly spaced bins.
+	k 				- accuracy parameter of sketches, sketch_k if None.
+	workers 		- number of worker processes. Snapshots are summarized serially if 1.
+	'''
+	bins 			= summary_bins if bins is None else bins
+	k 				= sketch_k if k is None else k
+	paths_list 		= [list(manifest['path']) for manifest in manifest_list]
+	paths 			= [path for paths_ in paths_list for path in paths_]
+	if workers <= 1:
+		results 	= [summarize_file(path, params_list, bins, log, k) for path in paths]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			results 	= list(executor.map(summarize_file, paths, *zip(*[(params_list, bins, log, k)]*len(paths))))
+	aligned 		= [align_grid_histograms([histograms[i] for aggregates, histograms, sketches, digest in results], bins, log) for i in range(len(params_list))]
+	os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+	tmp_fname 		= path+'.'+str(os.getpid())+'.tmp'
+	with h5py.File(tmp_fname, 'w') as summary:
+		summary.attrs.update({'kind':'summary', 'columns':list(params_list), 'assemblies':[manifest.name for manifest in manifest_list], 'bins':bins, 'log':log, 'k':k, 'created':time.strftime('%Y-%m-%dT%H:%M:%S')})
+		for param, (edges, counts) in zip(params_list, aligned):
+			summary.create_dataset('edges/'+param, data=edges)
+		offsets 		= np.cumsum([0]+[len(paths_) for paths_ in paths_list])
+		for j, (manifest, paths) in enumerate(zip(manifest_list, paths_list)):
+			rows 		= slice(offsets[j], offsets[j+1])
+			reduction 	= get_reduction_df(manifest, [aggregates for aggregates, histograms, sketches, digest in results[rows]], params_list)
+			group 		= summary.create_group(manifest.name)
+			group.attrs.update({'snapshot':manifest['snapshot'].to_numpy(), 'redshift':manifest['redshift'].to_numpy(), 'source':[os.path.abspath(path) for path in paths], 'sha256':[digest for aggregates, histograms, sketches, digest in results[rows]]})
+			columns 	= [col for col in reduction.columns if col not in ('snapshot','redshift')]
+			create_summary_dataset(group, 'reductions', reduction[columns].to_numpy(np.float64).reshape(len(reduction),len(columns))).attrs['columns'] 	= columns
+			for i, param in enumerate(params_list):
+				create_summary_dataset(group, 'histograms/'+param, aligned[i][1][rows])
+				arrays 		= [sketch_to_arrays(sketches[i]) for aggregates, histograms, sketches, digest in results[rows]]
+				sizes 		= [np.trim_zeros(arrays_['sizes'],'b') for arrays_ in arrays]	# Empty levels above the top one (there are none but for empty sketches) are not stored.
+				levels 		= max((len(size) for size in sizes), default=0)
+				create_summary_dataset(group, 'sketches/'+param+'/header', np.array([arrays_['header'] for arrays_ in arrays], dtype=np.int64).reshape(len(paths),4))
+				create_summary_dataset(group, 'sketches/'+param+'/range', np.array([arrays_['range'] for arrays_ in arrays]).reshape(len(paths),2))
+				create_summary_dataset(group, 'sketches/'+param+'/sizes', np.array([np.pad(size,(0,levels-len(size))) for size in sizes], dtype=np.int64).reshape(len(paths),levels))
+				create_summary_dataset(group, 'sketches/'+param+'/offsets', np.cumsum([0]+[len(arrays_['items']) for arrays_ in arrays]))
+				create_summary_dataset(group, 'sketches/'+param+'/items', np.concatenate([arrays_['items'] for arrays_ in arrays]+[np.empty(0)]))
+	os.replace(tmp_fname, path)
+	return path
+
+@instrument
+def read_summary(path, assemblies=None):
+	'''
+	Returns a list of summary dataframes, one per assembly mode of a summary file (see write_summary()), with their name attributes set. Each has one row per snapshot and columns snapshot, redshift, counts, reductions of each column (col, col_mean, col_min and col_max), path (of source file) and sha256 (of source file when summarized).
+	Summary dataframes can be passed to plotting functions instead of snapshot manifests : histograms and quantiles are then read from the summary file, which is only a few kilobytes per snapshot, instead of being computed from snapshots.
+	Parameters	:
+	path 		- Path of summary file.
+	assemblies 	- list of plot-friendly names of assembly modes, in the order of returned dataframes. Assembly modes missing from the file are skipped. All assembly modes of the file if None.
+	'''
+	summary_list 	= list()
+	with h5py.File(path, 'r') as summary:
+		if summary.attrs.get('kind') != 'summary':
+			raise ValueError(path+' is not a summary file, see write_summary().')
+		names 		= list(summary.attrs['assemblies'])
+		for name in names if assemblies is None else [name for name in assemblies if name in names]:
+			group 			= summary[name]
+			reductions 		= group['reductions']
+			df 				= pd.DataFrame(reductions[()], columns=list(reductions.attrs['columns']))
+			df.insert(0, 'snapshot', group.attrs['snapshot'])
+			df.insert(1, 'redshift', group.attrs['redshift'])
+			df['counts'] 	= df['counts'].astype(np.int64)
+			df['path'] 		= list(group.attrs['source'])
+			df['sha256'] 	= list(group.attrs['sha256'])
+			df.attrs['kind'] 		= 'summary'
+			df.attrs['summary'] 	= os.path.abspath(path)
+			df.name 		= name
+			summary_list.append(df)
+	return summary_list
+
+def is_summary(df):
+	'''
+	Returns True if a dataframe is a summary dataframe returned by read_summary().
+	Parameters	:
+	df 	- a dataframe.
+	'''
+	return df.attrs.get('kind') == 'summary'
+
+def get_summary_edges(summary, col='mass', bins=None):
+	'''
+	Returns bin edges of histograms of a column stored in a summary file, coarsened to bins bins if they divide evenly into stored bins.
+	Parameters	:
+	summary 	- summary dataframe (see read_summary()).
+	col 		- column of summary file.
+	bins 		- number of bins. Stored edges are returned as they are if None, or if bins does not divide evenly into stored bins.
+	'''
+	with h5py.File(summary.attrs['summary'], 'r') as fname:
+		edges 		= fname['edges/'+col][()]
+	stored 			= len(edges)-1
+	if bins is not None and stored%bins == 0:
+		edges 		= edges[::stored//bins]
+	return edges
+
+def get_summary_histograms(summary, col='mass', edges=None):
 	'''
-	Returns a string with capitalized first letter.
+	Returns (edges, counts) of histograms of a column stored in a summary file, with counts an array of shape (number of snapshots, number of bins) in the order of rows of the summary dataframe. Counts of stored bins are added up into edges, which must be a subset of stored edges (eg. returned by get_summary_edges()); as for snapshots, counts of stored bins outside edges are left out.
 	Parameters	:
-	string	- a string whose first words is to be capitalized. This does not return string in camelcase, for which we might need to call this function repeated on split string.
+	summary 	- summary dataframe (see read_summary()).
+	col 		- column of summary file.
+	edges 		- bin edges. Stored edges if None.
 	'''
-	return string[0].capitalize()+string[1:]
+	with h5py.File(summary.attrs['summary'], 'r') as fname:
+		stored 		= fname['edges/'+col][()]
+		counts 		= fname[summary.name]['histograms/'+col][()]
+	if edges is None:
+		return stored, counts
+	index 			= np.minimum(np.searchsorted(stored, edges), len(stored)-1)
+	if not np.allclose(stored[index], edges, rtol=1e-12, atol=0):
+		raise ValueError('Bin edges of '+col+' are not a subset of edges stored in '+summary.attrs['summary']+', see get_summary_edges().')
+	counts 			= counts[:,:index[-1]]
+	return np.asarray(edges), np.add.reduceat(counts, index[:-1], axis=1) if counts.size else np.zeros((len(counts),len(edges)-1), dtype=np.int64)
 
-def add_assembly_column(df_list):
+def get_summary_sketches(summary, params_list=['mass']):
 	'''
-	Returns a list of dataframes with an extra column added, which signifies mode of assembly of data. This is denoted by name of dataframe.
+	Returns a list of dictionaries, one per snapshot of a summary dataframe in row order, mapping each requested column to its quantile sketch stored in the summary file (see get_sketches()).
 	Parameters	:
-	df_list	- a list of dataframes with their name attributes already set.
+	summary 	- summary dataframe (see read_summary()).
+	params_list	- list of columns of summary file.
 	'''
-	for df in df_list :
-		df['assembly']	= df.name
-	return df_list
+	sketches 	= [dict() for i in range(len(summary))]
+	with h5py.File(summary.attrs['summary'], 'r') as fname:
+		for param in params_list:
+			group 		= fname[summary.name]['sketches/'+param]
+			header, ranges, sizes, offsets, items 	= (group[name][()] for name in ('header','range','sizes','offsets','items'))
+			for i, sketch in enumerate(sketches):
+				sketch[param] 	= sketch_from_arrays({'header':header[i], 'range':ranges[i], 'sizes':np.trim_zeros(sizes[i],'b'), 'items':items[offsets[i]:offsets[i+1]]})
+	return sketches
 
-# ----------------------- Getter functions --------------------------------
+# ----------------------- Downsampling functions -------------------------
 
-def get_directory(directory):
+# ------- Layers drawing one mark per particle (eg. rugplots, scatterplots) are downsampled to at most this many points per plot.
+
+max_layer_points = 20000
+
+def get_quotas(sizes, max_points):
 	'''
-	Sets up directory structure. Returns directory path for root, data, scripts, plots, etc.
-	Parameters :
-	directory - Identifier for the directory label, eg. root, data, scripts, plots, gm_early_data, organic_data, gm_late_data.
+	Returns number of points to keep from each group, proportional to group sizes (largest remainder rounding) and adding up to min(max_points, total size). Every non-empty group keeps at least one point, so sparse snapshots are not dropped from a downsampled layer; this may exceed max_points by at most one point per group.
+	Parameters	:
+	sizes 		- integer array of group sizes.
+	max_points 	- number of points to keep from all groups together.
 	'''
-	dir_dict 						= dict()
-	dir_dict['scripts_dir'] 		= os.path.dirname(os.path.abspath(__file__))
-	dir_dict['root_dir'] 			= os.path.dirname(dir_dict['scripts_dir'])
-	dir_dict['data_dir'] 			= os.path.join(dir_dict['root_dir'], 'data')
-	dir_dict['gm_early_data_dir']	= os.path.join(dir_dict['data_dir'], 'gm_early')
-	dir_dict['organic_data_dir']	= os.path.join(dir_dict['data_dir'], 'organic')
-	dir_dict['gm_late_data_dir']	= os.path.join(dir_dict['data_dir'], 'gm_late')
-	dir_dict['plots_dir']			= os.path.join(dir_dict['root_dir'], 'plots')
-	return dir_dict[directory+'_dir']
+	sizes 		= np.asarray(sizes, dtype=np.int64)
+	total 		= sizes.sum()
+	if total <= max_points:
+		return sizes.copy()
+	exact 		= sizes*(max_points/total)
+	quotas 		= np.floor(exact).astype(np.int64)
+	remainder 	= int(max_points-quotas.sum())
+	quotas[np.argsort(quotas-exact, kind='stable')[:remainder]] += 1
+	return np.minimum(np.maximum(quotas, sizes > 0), sizes)
 
-def get_files(directory, mode='r'):
+def subsample_stratified(df, max_points=None, by='redshift', seed=0):
 	'''
-	Returns hdf5 file handles for all files in a directory.
-	TODO : Test for no hdf5 files
-	Parameters :
-	directory 	- Path to directory for reading hdf5 files
-	mode		- Mode of opening the file; defaults to read mode.
+	Returns a uniform random subset of rows of a dataframe, stratified by a column (eg. one stratum per snapshot), with at most about max_points rows in original row order. Every stratum keeps a share of rows proportional to its size (see get_quotas()). Rows are ranked within each stratum by seeded random keys, so subsets are reproducible for a given seed and nested for increasing max_points.
+	Parameters	:
+	df 			- a particle dataframe.
+	max_points 	- number of rows to keep. Defaults to max_layer_points. The dataframe is returned as it is if it has no more rows.
+	by 			- column defining strata, or None for a single stratum.
+	seed 		- seed of random number generator.
 	'''
-	return [h5py.File(os.path.join(directory,fname),mode) for fname in os.listdir(directory)]
+	max_points 	= max_layer_points if max_points is None else max_points
+	if len(df) <= max_points:
+		return df
+	codes 		= np.zeros(len(df), dtype=np.intp) if by is None else pd.factorize(df[by])[0]
+	sizes 		= np.bincount(codes)
+	quotas 		= get_quotas(sizes, max_points)
+	keys 		= np.random.default_rng(seed).random(len(df))
+	order 		= np.lexsort((keys, codes))		# Rows grouped by stratum, in random order within each stratum.
+	ranks 		= np.arange(len(df))-(np.cumsum(sizes)-sizes)[codes[order]]
+	return df.iloc[np.sort(order[ranks < quotas[codes[order]]])]
 
-# ++++++++++++++++++++ Getter functions for hdf5 files dataset columns 
+def reservoir_sample_file(path, k, col='mass', seed=0, chunk_rows=2**20):
+	'''
+	Returns a uniform random sample (without replacement) of k values of a column of a single hdf5 file, drawn in one pass chunk by chunk. Each value gets a random key and the k values with smallest keys are kept (bottom-k reservoir), so memory use is bounded by k and chunk_rows irrespective of file size. The file is opened by path, so that this can run in a worker process.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	k 			- number of values to keep.
+	col 		- column from hdf5 file datasets.
+	seed 		- seed of random number generator. Combined with snapshot number, so that samples of a file do not depend on order or process in which files are sampled.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	rng 		= np.random.default_rng([seed, parse_snapshot_fname(path)[0]])
+	keys 		= np.empty(0)
+	values 		= np.empty(0)
+	with open_file(path) as fname:
+		for lo, block in iter_column_chunks(fname, [col], chunk_rows):
+			keys 	= np.concatenate((keys, rng.random(block.shape[1])))
+			values 	= np.concatenate((values, block[0]))
+			if len(keys) > k:
+				keep 			= np.argpartition(keys, k)[:k]
+				keys, values 	= keys[keep], values[keep]
+	return values[np.argsort(keys)]
 
-def get_coords_x(fname):
+def get_reservoir_samples(manifest_list, col='mass', max_points=None, seed=0, workers=1):
 	'''
-	Returns x-coordinates from an hdf5 file.
+	Returns a tidy dataframe of randomly sampled particles of snapshot manifests, with columns assembly, snapshot, redshift and col. Every assembly mode gets at most about max_points particles, shared among its snapshots in proportion to their particle counts (see get_quotas()), each drawn from its hdf5 file in a single out-of-core pass (see reservoir_sample_file()).
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	col 			- column from hdf5 file datasets.
+	max_points 		- number of particles to keep per assembly mode. Defaults to max_layer_points.
+	seed 			- seed of random number generator.
+	workers 		- number of worker processes. Snapshots are sampled serially if 1.
 	'''
-	return fname["Coordinates"][:,0]
+	max_points 	= max_layer_points if max_points is None else max_points
+	subdf_list 	= list()
+	for manifest in manifest_list:
+		paths 		= list(manifest['path'])
+		quotas 		= get_quotas(manifest['counts'].to_numpy(), max_points)
+		if workers <= 1:
+			samples 	= [reservoir_sample_file(path, k, col, seed) for path, k in zip(paths, quotas)]
+		else:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				samples 	= list(executor.map(reservoir_sample_file, paths, quotas, *zip(*[(col, seed)]*len(paths))))
+		sizes 		= [len(sample) for sample in samples]
+		subdf 		= pd.DataFrame({'snapshot'	: np.repeat(manifest['snapshot'].to_numpy(), sizes),
+									'redshift'	: np.repeat(manifest['redshift'].to_numpy(), sizes),
+									col 		: np.concatenate(samples) if samples else np.empty(0)})
+		subdf.name 	= manifest.name
+		subdf_list.append(subdf)
+	add_assembly_column(subdf_list)
+	return pd.concat(subdf_list, ignore_index=True)
 
-def get_coords_y(fname):
+# ----------------------- Spatial index functions ------------------------
+
+spatial_indices = dict()						# Spatial indices already built, keyed by path, size and modification time of hdf5 file and cell size.
+
+def build_spatial_index(coords, cell_size=None, particles_per_cell=16):
 	'''
-	Returns y-coordinates from an hdf5 file.
+	Returns a uniform grid spatial index over particle coordinates, as a dictionary. Particles are sorted by grid cell, so that particles of a cell are contiguous; 'coords' holds sorted coordinates, 'order' maps sorted positions to rows of coords and 'starts' holds first sorted position of every cell (and total number of particles as last element).
+	Periodic boundaries are not handled, since snapshots hold particles of a single galaxy.
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	coords 				- array of shape (number of particles, 3).
+	cell_size 			- side of a cubic grid cell, in units of coords. If None, chosen so that cells hold particles_per_cell particles on average.
+	particles_per_cell	- average number of particles per cell, used if cell_size is None.
 	'''
-	return fname["Coordinates"][:,1]
+	coords 		= np.asarray(coords, dtype=np.float64)
+	n 			= len(coords)
+	lo 			= coords.min(axis=0) if n else np.zeros(3)
+	extent 		= coords.max(axis=0)-lo if n else np.zeros(3)
+	if cell_size is None:
+		extent_max 	= max(extent.max(), np.finfo(np.float64).tiny)
+		volume 		= np.prod(np.maximum(extent, extent_max*1e-3))		# Avoid zero volume for flat distributions of particles.
+		cell_size 	= (volume*particles_per_cell/max(n,1))**(1/3)
+	shape 		= tuple(int(cells) for cells in np.floor(extent/cell_size)+1)
+	cells 		= np.ravel_multi_index(get_cells(coords, lo, cell_size, shape).T, shape)
+	order 		= np.argsort(cells, kind='stable')
+	starts 		= np.searchsorted(cells[order], np.arange(np.prod(shape)+1))
+	return {'coords':coords[order], 'order':order, 'starts':starts, 'lo':lo, 'cell_size':cell_size, 'shape':shape}
 
-def get_coords_z(fname):
+def get_cells(points, lo, cell_size, shape):
 	'''
-	Returns z-coordinates from an hdf5 file.
+	Returns integer grid cell coordinates of points, clipped to the grid.
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	points 		- array of shape (number of points, 3).
+	lo 			- lower corner of the grid.
+	cell_size 	- side of a cubic grid cell.
+	shape 		- number of cells along each axis.
 	'''
-	return fname["Coordinates"][:,2]
+	return np.clip(np.floor((np.asarray(points)-lo)/cell_size).astype(np.intp), 0, np.array(shape)-1)
 
-def get_vel_x(fname):
+def get_block_candidates(index, cell_lo, cell_hi):
 	'''
-	Returns velocities along x-axis from an hdf5 file.
+	Returns sorted positions of all particles lying in a block of grid cells.
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	index 			- spatial index returned by build_spatial_index().
+	cell_lo, cell_hi- lowest and highest (inclusive) integer cell coordinates of the block, clipped to the grid.
 	'''
-	return fname["Velocity"][:,0]
+	shape 		= np.array(index['shape'])
+	cell_lo 	= np.clip(cell_lo, 0, shape-1)
+	cell_hi 	= np.clip(cell_hi, 0, shape-1)
+	cells 		= np.ravel_multi_index(np.meshgrid(*[np.arange(a, b+1) for a, b in zip(cell_lo, cell_hi)], indexing='ij'), index['shape']).ravel()
+	starts 		= index['starts'][cells]
+	lengths 	= index['starts'][cells+1]-starts
+	offsets 	= np.cumsum(lengths)-lengths			# Concatenate ranges [start, start+length) of all cells without a python loop.
+	return np.repeat(starts-offsets, lengths)+np.arange(lengths.sum())
 
-def get_vel_y(fname):
+def get_sphere_members(index, centre, radius):
 	'''
-	Returns velocities along y-axis from an hdf5 file.
+	Returns (sorted positions, distances) of particles lying within radius of centre, ordered by distance. Sorted positions index index['coords']; map them to rows of original coordinates using index['order'].
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	index 	- spatial index returned by build_spatial_index().
+	centre 	- a single point.
+	radius 	- radius of sphere.
 	'''
-	return fname["Velocity"][:,1]
+	candidates 	= get_block_candidates(index, get_cells(centre-radius, index['lo'], index['cell_size'], index['shape']),
+											  get_cells(centre+radius, index['lo'], index['cell_size'], index['shape']))
+	distances 	= np.sqrt(((index['coords'][candidates]-centre)**2).sum(axis=1))
+	inside 		= distances <= radius
+	nearest 	= np.argsort(distances[inside], kind='stable')
+	return candidates[inside][nearest], distances[inside][nearest]
 
-def get_vel_z(fname):
+def query_radius(index, centres, radii):
 	'''
-	Returns velocities along z-axis from an hdf5 file.
+	Returns a list with, for each centre, an array of indices (rows of coordinates passed to build_spatial_index()) of particles lying within the corresponding radius, sorted by distance.
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	index 	- spatial index returned by build_spatial_index().
+	centres - array of shape (number of queries, 3), or a single point.
+	radii 	- a single radius, or one radius per centre.
 	'''
-	return fname["Velocity"][:,2]
+	centres 	= np.atleast_2d(centres)
+	radii 		= np.broadcast_to(radii, len(centres))
+	result 		= list()
+	for centre, radius in zip(centres, radii):
+		result.append(index['order'][get_sphere_members(index, centre, radius)[0]])
+	return result
 
-def get_mass(fname):
+def query_box(index, lows, highs):
 	'''
-	Returns star particle masses from an hdf5 file.
+	Returns a list with, for each box, an array of indices of particles lying within the box (boundaries included).
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	index 	- spatial index returned by build_spatial_index().
+	lows 	- lower corners of boxes, array of shape (number of queries, 3), or a single point.
+	highs 	- upper corners of boxes, of same shape as lows.
 	'''
-	return fname["Mass"]
+	result 		= list()
+	for low, high in zip(np.atleast_2d(lows), np.atleast_2d(highs)):
+		candidates 	= get_block_candidates(index, get_cells(low, index['lo'], index['cell_size'], index['shape']),
+												  get_cells(high, index['lo'], index['cell_size'], index['shape']))
+		points 		= index['coords'][candidates]
+		inside 		= np.all((points >= low) & (points <= high), axis=1)
+		result.append(np.sort(index['order'][candidates[inside]]))
+	return result
 
-def get_redshift(fname):
+def query_knn(index, centres, k):
 	'''
-	Returns redshift value for an hdf5 file. Uses regex to find redshift value from filename.
+	Returns (indices, distances), arrays of shape (number of queries, k) holding indices of the k nearest particles of each centre and their distances, sorted by distance. If there are fewer than k particles, k is reduced to number of particles.
+	Blocks of cells around each centre are grown one shell at a time, until the k-th nearest candidate is closer than the smallest distance from the centre to outside the block, which guarantees an exact result.
 	Parameters	:
-	fname 	- Open handle for an hdf5 file.
+	index 	- spatial index returned by build_spatial_index().
+	centres - array of shape (number of queries, 3), or a single point.
+	k 		- number of neighbours.
 	'''
-	return float(re.compile(r'z\d+p\d+').findall(str(fname.file))[0].replace('z','').replace('p','.'))
+	centres 	= np.atleast_2d(centres)
+	k 			= min(k, len(index['order']))
+	shape 		= np.array(index['shape'])
+	indices 	= np.empty((len(centres), k), dtype=np.intp)
+	distances 	= np.empty((len(centres), k))
+	for i, centre in enumerate(centres):
+		cell 		= np.floor((centre-index['lo'])/index['cell_size']).astype(np.intp)
+		shell 		= 0
+		while True:
+			candidates 	= get_block_candidates(index, cell-shell, cell+shell)
+			dist 		= np.sqrt(((index['coords'][candidates]-centre)**2).sum(axis=1))
+			covered 	= np.all(cell-shell <= 0) and np.all(cell+shell >= shape-1)
+			if len(candidates) >= k:
+				nearest 	= np.argpartition(dist, k-1)[:k] if k else np.array([], dtype=np.intp)
+				reach 		= np.min(np.concatenate([centre-(index['lo']+(cell-shell)*index['cell_size']),
+													 index['lo']+(cell+shell+1)*index['cell_size']-centre]))
+				if covered or (k and dist[nearest].max() <= reach) or not k:
+					nearest 		= nearest[np.argsort(dist[nearest], kind='stable')]
+					indices[i] 		= index['order'][candidates[nearest]]
+					distances[i] 	= dist[nearest]
+					break
+			shell 		+= 1
+	return indices, distances
 
-# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def get_aperture_masses(index, masses, centre, radii):
+	'''
+	Returns total mass of particles within each of several apertures (spheres of given radii) around a centre, with a single radius query at the largest radius.
+	Parameters	:
+	index 	- spatial index returned by build_spatial_index().
+	masses 	- particle masses, in the order of coordinates passed to build_spatial_index().
+	centre 	- centre of apertures.
+	radii 	- array of aperture radii.
+	'''
+	radii 				= np.asarray(radii, dtype=np.float64)
+	inside, distances 	= get_sphere_members(index, np.asarray(centre, dtype=np.float64), radii.max())
+	cumulative 			= np.concatenate([[0], np.cumsum(np.asarray(masses, dtype=np.float64)[index['order'][inside]])])
+	return cumulative[np.searchsorted(distances, radii, side='right')]
 
-def get_subdf(fname,params_list):
+def get_spatial_index(fname, cell_size=None):
 	'''
-	Returns a sub-dataframe containing a subset of columns available in a single hdf5 file.
+	Returns spatial index over Coordinates of an hdf5 file (see build_spatial_index()). An index is built once per file and cell size, and rebuilt only if the file changes.
 	Parameters	:
 	fname 		- Open handle for an hdf5 file.
-	param_list 	- List of columns from hdf5 file to include in a dataframe.
+	cell_size 	- side of a cubic grid cell. Chosen automatically if None.
 	'''
-	subdf = pd.DataFrame()
-	params_dict		= {							# Dictionary of callable getter functions corresponding to each column
-		'coords_x'	:  get_coords_x,
-		'coords_y'	:  get_coords_y,
-		'coords_z'	:  get_coords_z,
-		'vel_x'		:  get_vel_x,
-		'vel_y'		:  get_vel_y,
-		'vel_z'		:  get_vel_z,
-		'mass'		:  get_mass,
-		'redshift'	:  get_redshift
-		}
-	for param in params_list:
-		subdf[param] = params_dict[param](fname)
-	return subdf
+	stat 		= os.stat(fname.filename)
+	key 		= (os.path.abspath(fname.filename), stat.st_size, stat.st_mtime_ns, cell_size)
+	if key not in spatial_indices:
+		spatial_indices[key] 	= build_spatial_index(get_dataset_array(fname,'Coordinates'), cell_size)
+	return spatial_indices[key]
+
+# ----------------------- Radial profile functions -----------------------
+
+# ------- Columns of halo catalogues (see May25-GalaxyCataloguesData), with one row per snapshot.
 
-def get_df(fname_list, params_list=['coords_x', 'coords_y', 'coords_z', 'vel_x', 'vel_y', 'vel_z', 'mass', 'redshift']):
+catalogue_cols = [
+	'index', 
+	'time', 
+	'a_exp', 
+	'redshift', 
+	'subhalo_centre_x',
+	'subhalo_centre_y',
+	'subhalo_centre_z', 
+	'subhalo_peculiar_velocity_x',
+	'subhalo_peculiar_velocity_y',
+	'subhalo_peculiar_velocity_z', 
+	'Halo_mass', 
+	'Stellar_mass', 
+	'BH_mass', 
+	'SFR', 
+	'sSFR'
+]
+
+# ------- Quantities along second axis of radial profile arrays.
+
+profile_fields = ['mass', 'density', 'velocity_dispersion']
+
+def get_catalogue(assembly):
 	'''
-	Returns a concatenated dataframe (of a single assembly type) of all sub-dataframes constructed using individual hdf5 files.
+	Returns halo catalogue of an assembly mode as a dataframe with columns catalogue_cols.
 	Parameters	:
-	fname_list	- list of several hdf5 file handles,
-	params_list	- list of columns to be extracted from hdf5 file datasets, defaults to complete dataset.
+	assembly 	- Identifier of assembly mode, eg. gm_early, organic, gm_late.
 	'''
-	df = pd.DataFrame()
-	if 'redshift' not in params_list:			# Compulsorily add redshift in list of columns.
-		params_list.append('redshift')
-	df = pd.concat([df]+[get_subdf(fname,params_list) for fname in fname_list], ignore_index=True)
-	return df
+	return pd.read_fwf(os.path.join(get_directory('catalogue_data'),'halo_catalogue_'+assembly+'.txt'),skiprows=1,names=catalogue_cols)
 
-def get_particle_distribution(df_list,col='redshift'):
+def match_catalogue(manifest, catalogue, tolerance=1e-3):
 	'''
-	Returns a single dataframe containing value counts of different values of column "col".
+	Returns catalogue rows matched to snapshots of a manifest by redshift, one row per snapshot in manifest order. Nearest catalogue redshift within tolerance is matched; snapshots without a match get NaN values.
 	Parameters	:
-	df_list	- a list of dataframes to be concatenated.
-	col 	- column which acts as index vor value counts.
+	manifest 	- snapshot manifest of an assembly mode (see get_manifest()).
+	catalogue 	- halo catalogue of same assembly mode (see get_catalogue()).
+	tolerance 	- largest accepted difference between redshifts.
 	'''
-	df 		= pd.DataFrame()
-	for subdf in df_list:
-		count				= subdf.value_counts(col).sort_index(ascending=True).to_frame(name='counts')
-		count['assembly']	= subdf.name
-		count[col]			= count.index
-		df 					= pd.concat([df,count])
-	return df
+	snapshots 	= manifest[['snapshot','redshift']].reset_index().sort_values('redshift')
+	matched 	= pd.merge_asof(snapshots, catalogue.sort_values('redshift'), on='redshift', direction='nearest', tolerance=tolerance)
+	return matched.sort_values('index_x').drop(columns=['index_x']).rename(columns={'index_y':'index'}).reset_index(drop=True)
 
-def get_total_mass_in_particles_with_redshift(df_list):
+def profile_file(path, centre, edges, centred='auto', chunk_rows=2**20):
 	'''
-	Returns a concatenated dataframe containing redshift, sum of particle masses at a given redshift and assembly mode.
+	Returns an array of shape (7, number of shells) holding, for each spherical shell around centre, sums of particle mass, of mass times each velocity component and of mass times each squared velocity component. The file is streamed in chunks and opened by path, so that this can run in a worker process.
 	Parameters	:
-	df_list 	- List of dataframes (presumably, with different assembly modes) for which distribution is to be plotted.
+	path 		- Path to an hdf5 file.
+	centre 		- subhalo centre, in coordinates of the box (as in halo catalogues).
+	edges 		- radii of shell boundaries (eg. log spaced, see get_bin_edges()), in units of Coordinates.
+	centred 	- True if particle coordinates are already relative to the subhalo centre, in which case centre is not subtracted. If 'auto', particles are taken to be centred when centre lies outside their bounding box.
+	chunk_rows	- Maximum number of rows held in memory at once.
 	'''
-	subdf_list 	= list()
-	for subdf in df_list:
-		grouped_df 			= subdf.groupby(['redshift'],as_index=False).agg({'mass':sum})
-		grouped_df.name 	= subdf.name
-		subdf_list.append(grouped_df)
-	add_assembly_column(subdf_list)
-	return pd.concat(subdf_list)
+	params_list 	= ['coords_x','coords_y','coords_z','vel_x','vel_y','vel_z','mass']
+	bins 			= len(edges)-1
+	sums 			= np.zeros((7, bins))
+	with open_file(path) as fname:
+		if centred == 'auto':
+			extent 	= reduce_file(fname, params_list[:3], chunk_rows)
+			centred = not np.all((extent['min'] <= centre) & (centre <= extent['max']))
+		origin 		= np.zeros(3) if centred else np.asarray(centre, dtype=np.float64)
+		for lo, block in iter_column_chunks(fname, params_list, chunk_rows):
+			radius 		= np.sqrt(((block[:3].T-origin)**2).sum(axis=1))
+			inside 		= (radius >= edges[0]) & (radius <= edges[-1])
+			shell 		= np.minimum(np.searchsorted(edges, radius[inside], side='right')-1, bins-1)
+			mass 		= block[6,inside]
+			velocity 	= block[3:6,inside]
+			sums[0] 	+= np.bincount(shell, weights=mass, minlength=bins)
+			for i in range(3):
+				sums[1+i] 	+= np.bincount(shell, weights=mass*velocity[i], minlength=bins)
+				sums[4+i] 	+= np.bincount(shell, weights=mass*velocity[i]**2, minlength=bins)
+	return sums
+
+@instrument
+def get_radial_profiles(manifest, catalogue, edges, centred='auto', workers=1, executor=None):
+	'''
+	Returns an array of shape (number of snapshots, len(profile_fields), number of shells) holding stellar mass, mass density and one-dimensional mass-weighted velocity dispersion in spherical shells around subhalo centre, for every snapshot of a manifest in manifest order. Snapshots are matched to catalogue rows by redshift (see match_catalogue()); profiles of unmatched snapshots are NaN.
+	Parameters	:
+	manifest 	- snapshot manifest of an assembly mode (see get_manifest()).
+	catalogue 	- halo catalogue of same assembly mode (see get_catalogue()).
+	edges 		- radii of shell boundaries, in units of Coordinates.
+	centred 	- passed to profile_file().
+	workers 	- number of worker processes over which snapshots are spread. Snapshots are processed serially if 1.
+	executor 	- an existing pool of worker processes to use instead of starting one (eg. shared by all assembly modes).
+	'''
+	matched 	= match_catalogue(manifest, catalogue)
+	centres 	= matched[['subhalo_centre_x','subhalo_centre_y','subhalo_centre_z']].to_numpy()
+	paths 		= list(manifest['path'])
+	if executor is not None:
+		sums 	= list(executor.map(profile_file, paths, centres, [edges]*len(paths), [centred]*len(paths)))
+	elif workers <= 1:
+		sums 	= [profile_file(path, centre, edges, centred) for path, centre in zip(paths, centres)]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			return get_radial_profiles(manifest, catalogue, edges, centred, executor=executor)
+	sums 		= np.array(sums).reshape(len(paths), 7, len(edges)-1)
+	sums[np.isnan(centres).any(axis=1)] 	= np.nan
+	mass 		= sums[:,0]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean 		= sums[:,1:4]/mass[:,None]
+		variance 	= sums[:,4:7]/mass[:,None]-mean**2
+	profiles 	= np.empty((len(paths), len(profile_fields), len(edges)-1))
+	profiles[:,0] 	= mass
+	profiles[:,1] 	= mass/(4/3*np.pi*(edges[1:]**3-edges[:-1]**3))
+	profiles[:,2] 	= np.sqrt(np.maximum(variance, 0).mean(axis=1))
+	return profiles
+
+def get_radial_profiles_list(manifest_list, catalogue_list, edges, centred='auto', workers=1):
+	'''
+	Returns a dictionary mapping name of each manifest (assembly mode) to its radial profiles array (see get_radial_profiles()). Snapshots of all assembly modes share a single pool of worker processes.
+	Parameters	:
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	catalogue_list	- list of halo catalogues, one for each manifest.
+	edges 			- radii of shell boundaries, in units of Coordinates.
+	centred 		- passed to profile_file().
+	workers 		- number of worker processes. Snapshots are processed serially if 1.
+	'''
+	if workers <= 1:
+		return {manifest.name : get_radial_profiles(manifest, catalogue, edges, centred) for manifest, catalogue in zip(manifest_list, catalogue_list)}
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		return {manifest.name : get_radial_profiles(manifest, catalogue, edges, centred, executor=executor) for manifest, catalogue in zip(manifest_list, catalogue_list)}
+
+# ----------------------- Projected map functions ------------------------
+
+# ------- Projection axes (line of sight) mapped to indices of coordinates along horizontal and vertical image axes and along line of sight. Images keep a right-handed frame.
+
+projection_axes = {
+	'x'	: (1, 2, 0),
+	'y'	: (2, 0, 1),
+	'z'	: (0, 1, 2)
+	}
+
+# ------- Quantities along second axis of projected map arrays.
+
+map_fields = ['density', 'velocity']
+
+def get_deposit_weights(u, v, pixels, method='cic'):
+	'''
+	Returns a list of (index, fraction) pairs depositing particles onto a square grid : flat pixel index of each particle and fraction of its weight given to that pixel, with out-of-grid deposits removed. Nearest grid point (ngp) gives a particle to one pixel, cloud in cell (cic) shares it among 4 pixels bilinearly.
+	Parameters	:
+	u, v 	- particle positions along horizontal and vertical image axes, in units of pixels from grid corner (0 to pixels).
+	pixels 	- number of pixels along each image axis.
+	method 	- 'ngp' or 'cic'.
+	'''
+	if method == 'ngp':
+		i, j 		= np.floor(u).astype(np.intp), np.floor(v).astype(np.intp)
+		inside 		= (i >= 0) & (i < pixels) & (j >= 0) & (j < pixels)
+		return [(np.flatnonzero(inside), j[inside]*pixels+i[inside], np.ones(inside.sum()))]
+	if method != 'cic':
+		raise ValueError("method must be 'ngp' or 'cic', not "+repr(method)+'.')
+	u, v 			= u-0.5, v-0.5			# Positions relative to pixel centres.
+	i0, j0 			= np.floor(u).astype(np.intp), np.floor(v).astype(np.intp)
+	fu, fv 			= u-i0, v-j0
+	deposits 		= list()
+	for di, dj, fraction in ((0, 0, (1-fu)*(1-fv)), (1, 0, fu*(1-fv)), (0, 1, (1-fu)*fv), (1, 1, fu*fv)):
+		i, j 		= i0+di, j0+dj
+		inside 		= np.flatnonzero((i >= 0) & (i < pixels) & (j >= 0) & (j < pixels))
+		deposits.append((inside, j[inside]*pixels+i[inside], fraction[inside]))
+	return deposits
+
+def map_file(path, centre, width, pixels=256, axis='z', method='cic', depth=None, centred='auto', chunk_rows=2**20):
+	'''
+	Returns (sums, centred) : an array of shape (2, pixels, pixels) holding, for each pixel of a square field of view around centre projected along axis, sums of particle mass and of mass times line-of-sight velocity, and whether particles were taken to be centred (see centred below). Rows of the array run along the vertical image axis. The file is streamed in chunks, deposited with np.bincount (see get_deposit_weights()) and opened by path, so that this can run in a worker process.
+	Parameters	:
+	path 		- Path to an hdf5 file.
+	centre 		- subhalo centre, in coordinates of the box (as in halo catalogues).
+	width 		- width of field of view, in units of Coordinates.
+	pixels 		- number of pixels along each image axis.
+	axis 		- projection axis (line of sight), 'x', 'y' or 'z' (see projection_axes).
+	method 		- deposit of particles, 'ngp' (nearest grid point) or 'cic' (cloud in cell).
+	depth 		- thickness of slab along line of sight around centre, in units of Coordinates. All particles are projected if None.
+	centred 	- True if particle coordinates are already relative to the subhalo centre, in which case centre is not subtracted. If 'auto', particles are taken to be centred when centre lies outside their bounding box.
+	chunk_rows	- Maximum number of rows held in memory at once.
+	'''
+	horizontal, vertical, los 	= projection_axes[axis]
+	params_list 	= ['coords_x','coords_y','coords_z','vel_'+axis,'mass']
+	sums 			= np.zeros((2, pixels*pixels))
+	with open_file(path) as fname:
+		if centred == 'auto':
+			extent 	= reduce_file(fname, params_list[:3], chunk_rows)
+			centred = not np.all((extent['min'] <= centre) & (centre <= extent['max']))
+		origin 		= np.zeros(3) if centred else np.asarray(centre, dtype=np.float64)
+		scale 		= pixels/width
+		for lo, block in iter_column_chunks(fname, params_list, chunk_rows):
+			u 			= (block[horizontal]-origin[horizontal])*scale+pixels/2
+			v 			= (block[vertical]-origin[vertical])*scale+pixels/2
+			mass 		= block[4]
+			momentum 	= block[4]*block[3]
+			if depth is not None:
+				inside 		= np.abs(block[los]-origin[los]) <= depth/2
+				u, v, mass, momentum 	= u[inside], v[inside], mass[inside], momentum[inside]
+			for index, pixel, fraction in get_deposit_weights(u, v, pixels, method):
+				sums[0] 	+= np.bincount(pixel, weights=mass[index]*fraction, minlength=pixels*pixels)
+				sums[1] 	+= np.bincount(pixel, weights=momentum[index]*fraction, minlength=pixels*pixels)
+	return sums.reshape(2, pixels, pixels), bool(centred)
+
+@instrument
+def get_projected_maps(manifest, catalogue, width, pixels=256, axis='z', method='cic', depth=None, rest_frame='mean', centred='auto', workers=1, executor=None):
+	'''
+	Returns an array of shape (number of snapshots, len(map_fields), pixels, pixels) holding projected stellar surface density (mass per unit area, in units of Mass and Coordinates) and mean mass-weighted line-of-sight velocity in each pixel, for every snapshot of a manifest in manifest order. Velocity is NaN in empty pixels. Fields of view are centred on subhalo centres of catalogue rows matched to snapshots by redshift (see match_catalogue()); maps of unmatched snapshots are NaN.
+	Parameters	:
+	manifest 	- snapshot manifest of an assembly mode (see get_manifest()).
+	catalogue 	- halo catalogue of same assembly mode (see get_catalogue()).
+	width 		- width of field of view, in units of Coordinates.
+	pixels 		- number of pixels along each image axis.
+	axis 		- projection axis, 'x', 'y' or 'z'.
+	method 		- 'ngp' or 'cic' (see get_deposit_weights()).
+	depth 		- thickness of projected slab, all particles if None (see map_file()).
+	rest_frame 	- line-of-sight velocity subtracted from velocities : 'mean' for mass-weighted mean velocity of particles in field of view, 'subhalo' for peculiar velocity of subhalo from catalogue, or None for none. Particles taken to be centred (see map_file()) are already in the frame of the subhalo, and their velocities are left as they are with 'subhalo'.
+	centred 	- passed to map_file().
+	workers 	- number of worker processes over which snapshots are spread. Snapshots are processed serially if 1.
+	executor 	- an existing pool of worker processes to use instead of starting one (eg. shared by all assembly modes).
+	'''
+	matched 	= match_catalogue(manifest, catalogue)
+	centres 	= matched[['subhalo_centre_x','subhalo_centre_y','subhalo_centre_z']].to_numpy()
+	paths 		= list(manifest['path'])
+	args 		= (width, pixels, axis, method, depth, centred)
+	if executor is not None:
+		results = list(executor.map(map_file, paths, centres, *zip(*[args]*len(paths))))
+	elif workers <= 1:
+		results = [map_file(path, centre, *args) for path, centre in zip(paths, centres)]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			return get_projected_maps(manifest, catalogue, width, pixels, axis, method, depth, rest_frame, centred, executor=executor)
+	sums 		= np.array([result[0] for result in results]).reshape(len(paths), 2, pixels, pixels)
+	centred 	= np.array([result[1] for result in results], dtype=bool)
+	sums[np.isnan(centres).any(axis=1)] 	= np.nan
+	mass 		= sums[:,0]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		velocity 	= np.where(mass > 0, sums[:,1]/mass, np.nan)
+		if rest_frame == 'mean':
+			velocity 	-= (sums[:,1].sum(axis=(1,2))/mass.sum(axis=(1,2)))[:,None,None]
+		elif rest_frame == 'subhalo':
+			velocity 	-= np.where(centred, 0., matched['subhalo_peculiar_velocity_'+axis].to_numpy())[:,None,None]		# Only particles in the frame of the box, as their positions (see map_file()).
+	maps 		= np.empty((len(paths), len(map_fields), pixels, pixels))
+	maps[:,0] 	= mass/(width/pixels)**2
+	maps[:,1] 	= velocity
+	return maps
+
+def get_projected_maps_list(manifest_list, catalogue_list, width, pixels=256, axis='z', method='cic', depth=None, rest_frame='mean', centred='auto', workers=1):
+	'''
+	Returns a dictionary mapping name of each manifest (assembly mode) to its projected maps array (see get_projected_maps()). Snapshots of all assembly modes share a single pool of worker processes.
+	Parameters	:
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	catalogue_list	- list of halo catalogues, one for each manifest.
+	width, pixels, axis, method, depth, rest_frame, centred 	- passed to get_projected_maps().
+	workers 		- number of worker processes. Snapshots are processed serially if 1.
+	'''
+	args 		= (width, pixels, axis, method, depth, rest_frame, centred)
+	if workers <= 1:
+		return {manifest.name : get_projected_maps(manifest, catalogue, *args) for manifest, catalogue in zip(manifest_list, catalogue_list)}
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		return {manifest.name : get_projected_maps(manifest, catalogue, *args, executor=executor) for manifest, catalogue in zip(manifest_list, catalogue_list)}
+
+def get_map_limits(images, field='density'):
+	'''
+	Returns (vmin, vmax) colour limits of a field shared by all images of a sequence, so that frames across redshift are comparable : 0.5th and 99.9th percentiles of non-empty pixels of surface density (shown log scaled), and symmetric 99th percentile of absolute velocity.
+	Parameters	:
+	images 	- array of images of a field (eg. maps[:,map_fields.index(field)] of projected maps, see get_projected_maps()), or a list of them.
+	field 	- one of map_fields.
+	'''
+	values 		= np.concatenate([np.ravel(array) for array in (images if isinstance(images, list) else [images])])
+	if field == 'density':
+		values 		= values[values > 0]
+		return tuple(np.percentile(values, [0.5, 99.9])) if len(values) else (1., 10.)
+	values 		= np.abs(values[np.isfinite(values)])
+	vmax 		= np.percentile(values, 99) if len(values) else 1.
+	return -vmax, vmax
 
 # ----------------------- Plotter functions --------------------------------
 
+# ------- Directory of saved figures, plots directory (see get_directory()) if None.
+
+figures_dir = None
+
+def get_figures_dir():
+	'''
+	Returns directory of saved figures : figures_dir if set, else plots directory.
+	'''
+	return get_directory('plots') if figures_dir is None else figures_dir
+
+@instrument
 def prepare_plot(context='paper',theme='dark',font_scale=1,rc_kwparams=dict()):
 	'''
 	Set seaborn styling for plots.
@@ -206,6 +2123,7 @@ def prepare_plot(context='paper',theme='dark',font_scale=1,rc_kwparams=dict()):
 	sns.set_context(context,font_scale)
 	sns.set_style(theme,rc_params)
 
+@instrument
 def plot_or_not(show,plot_name=None,dpi=480):
 	'''
 	Function to switch between show and save methods for plots.
@@ -218,17 +2136,163 @@ def plot_or_not(show,plot_name=None,dpi=480):
 	elif show == False :
 		if plot_name == None :
 			plot_name = np.random.randint(10000,99999)
-		plt.savefig(os.path.join(get_directory('plots'),plot_name+'.png'),
+		plt.savefig(os.path.join(get_figures_dir(),plot_name+'.png'),
 			dpi=dpi,bbox_inches='tight')
 	elif show == None :
 		pass 
 
+# ++++++++++++++++++++ Headless batch rendering
+
+def update_signature(digest, value):
+	'''
+	Updates a hashlib digest with contents of a plotting input. Dataframes are hashed by their values, columns and name; snapshot manifests also by size and modification time of their files, so that a changed snapshot changes the signature.
+	Parameters	:
+	digest 	- a hashlib digest.
+	value 	- a plotting input (dataframe, list or tuple of inputs, array, or any value with a stable repr).
+	'''
+	if isinstance(value, (list, tuple)):
+		digest.update(str(len(value)).encode())
+		for item in value:
+			update_signature(digest, item)
+	elif isinstance(value, pd.DataFrame):
+		df 		= value[['path','snapshot','redshift','counts']] if is_manifest(value) else value
+		digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+		digest.update(repr((list(df.columns), getattr(value,'name',None))).encode())
+		if is_manifest(value):
+			digest.update(repr([(os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in value['path']]).encode())
+	elif isinstance(value, np.ndarray):
+		digest.update(np.ascontiguousarray(value).tobytes())
+	else:
+		digest.update(repr(value).encode())
+
+def get_render_signature(function, args, kwargs):
+	'''
+	Returns a hex digest identifying a figure : source code of the plotting function and of functions of its module it calls (see get_function_sources()), and its inputs and parameters.
+	Parameters	:
+	function 	- plotting function.
+	args 		- positional arguments of function.
+	kwargs 		- keyword arguments of function.
+	'''
+	digest 		= hashlib.sha1()
+	for source in get_function_sources(function):
+		digest.update(source.encode())
+	update_signature(digest, (tuple(args), sorted(kwargs.items())))
+	return digest.hexdigest()
+
+def get_names(value):
+	'''
+	Returns name attributes of dataframes nested in lists or tuples, in the same nested structure (None for other values). Name attributes are lost when dataframes are pickled to a worker process; see set_names().
+	Parameters	:
+	value 	- a dataframe, or a list or tuple of values.
+	'''
+	if isinstance(value, (list, tuple)):
+		return [get_names(item) for item in value]
+	return getattr(value, 'name', None) if isinstance(value, pd.DataFrame) else None
+
+def set_names(value, names):
+	'''
+	Sets name attributes of dataframes nested in lists or tuples, from names returned by get_names().
+	Parameters	:
+	value 	- a dataframe, or a list or tuple of values.
+	names 	- names returned by get_names() for value.
+	'''
+	if isinstance(value, (list, tuple)):
+		for item, name in zip(value, names):
+			set_names(item, name)
+	elif isinstance(value, pd.DataFrame):
+		value.name 	= names
+
+def render_figure(function, args, kwargs, names=None, directory=None):
+	'''
+	Renders a figure with the non-interactive Agg backend and saves it through plot_or_not(). Runs in a worker process.
+	Parameters	:
+	function 	- plotting function, taking a show parameter.
+	args 		- positional arguments of function.
+	kwargs 		- keyword arguments of function.
+	names 		- name attributes of dataframes in args (see get_names()), restored before plotting.
+	directory 	- directory of saved figures, passed on since worker processes may not inherit figures_dir.
+	'''
+	global figures_dir
+	if directory is not None:
+		figures_dir 	= directory
+	plt.switch_backend('Agg')
+	if names is not None:
+		set_names(args, names)
+	function(*args, show=False, **kwargs)
+	plt.close('all')
+
+@instrument
+def render_figures(tasks, workers=None, force=False):
+	'''
+	Renders independent figures in parallel worker processes, without a display, and returns names of figures rendered. Figures whose plotting code and inputs are unchanged since they were last rendered, and whose files exist, are skipped. Signatures are kept in .render_hashes.json in directory of saved figures (see get_figures_dir()).
+	Parameters	:
+	tasks 	- list of (function, args, kwargs, plot_names) tuples, where plot_names are names of figures saved by function(*args, show=False, **kwargs).
+	workers - number of worker processes. Defaults to number of CPUs if None.
+	force 	- render all figures, even if unchanged.
+	'''
+	plots_dir 		= get_figures_dir()
+	os.makedirs(plots_dir, exist_ok=True)
+	hashes_fname 	= os.path.join(plots_dir, '.render_hashes.json')
+	hashes 			= dict()
+	if os.path.exists(hashes_fname):
+		with open(hashes_fname) as f:
+			hashes 	= json.load(f)
+	pending 		= list()
+	for function, args, kwargs, plot_names in tasks:
+		signature 	= get_render_signature(function, args, kwargs)
+		unchanged 	= all(hashes.get(plot_name) == signature and os.path.exists(os.path.join(plots_dir,plot_name+'.png')) for plot_name in plot_names)
+		if force or not unchanged:
+			pending.append((function, args, kwargs, plot_names, signature))
+	rendered 		= list()
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures 	= {executor.submit(render_figure, function, args, kwargs, get_names(args), plots_dir) : (plot_names, signature) for function, args, kwargs, plot_names, signature in pending}
+		for future in as_completed(futures):
+			future.result()
+			plot_names, signature 	= futures[future]
+			hashes.update(dict.fromkeys(plot_names, signature))
+			rendered 				+= plot_names
+	with open(hashes_fname+'.tmp','w') as f:
+		json.dump(hashes, f, indent=1, sort_keys=True)
+	os.replace(hashes_fname+'.tmp', hashes_fname)
+	return rendered
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# ++++++++++++++++++++ Per-particle layers
+
+def add_rug(ax, values, color, height=-0.025):
+	'''
+	Draws a rugplot of values below x axis of an axis, with one tick per value. Pass downsampled values for large particle sets (see subsample_stratified() and get_reservoir_samples()).
+	Parameters	:
+	ax 		- matplotlib axis.
+	values 	- array of values.
+	color 	- color of ticks.
+	height 	- height of ticks as a fraction of axis height, negative to draw them below axis.
+	'''
+	sns.rugplot(x=np.asarray(values), ax=ax, color=color, height=height, clip_on=False, alpha=0.5)
+
+def add_density_strip(ax, counts, edges, color, height=-0.025):
+	'''
+	Draws a rasterized strip below x axis of an axis, shaded by number of particles in each bin (log scaled, empty bins left transparent). Unlike a rugplot, its cost and file size do not grow with number of particles, and dense ranges stay distinguishable from sparse ones.
+	Parameters	:
+	ax 		- matplotlib axis.
+	counts 	- histogram counts, eg. from add_to_histogram() or get_histogram_df().
+	edges 	- bin edges of counts.
+	color 	- color of densest bin.
+	height 	- height of strip as a fraction of axis height, negative to draw it below axis.
+	'''
+	ax.pcolormesh(np.asarray(edges), [min(0,height), max(0,height)], np.ma.masked_equal(np.log1p(np.asarray(counts, dtype=float)), 0)[None,:],
+				  cmap=sns.light_palette(color, as_cmap=True), shading='flat', transform=ax.get_xaxis_transform(), clip_on=False, rasterized=True)
+
+# ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+@instrument
 def plot_particle_distribution(df_list, col='redshift',show=True):
 	'''
 	Plotter function to plot the distribution of star particles with respect to a variable (redshift, by default).
 	TODO : Test for other columns passed as parameter col.
 	Parameters :
-	df_list 	- List of dataframes (assembly modes) for which distribution is to be plotted using separate hues on the same plot.
+	df_list 	- List of dataframes (assembly modes) for which distribution is to be plotted using separate hues on the same plot. Snapshot manifests can be passed instead of particle dataframes.
 	col 		- column with respect to which distribution is to be plotted. Redshift is used by default.
 	show 		- passed to plot_or_not() function to evaluate whether to show the plot or save it.
 	'''
@@ -242,21 +2306,22 @@ def plot_particle_distribution(df_list, col='redshift',show=True):
 								  kind='scatter').set(xlabel=capitalize_first_letter(str(col)),
 								  ylabel='Counts')		# Plots a scatter plot. To plot histogram instead, use displot with kind='hist'. Counts are then computed automatically.
 	g.ax.invert_xaxis()
-	g_axis_level 	= sns.lineplot(data=dist_df,
-								   x=col,
-								   y='counts',
-								   hue= hue,
-								   ax=g.ax,
-								   legend=False)		# Plots a line plot above which scatter points will lie.
+	sns.lineplot(data=dist_df,
+				 x=col,
+				 y='counts',
+				 hue= hue,
+				 ax=g.ax,
+				 legend=False)		# Plots a line plot above which scatter points will lie.
 	g._legend.set_title(capitalize_first_letter(str(hue)))
 	plot_or_not(show,plot_name='particle_distribution_wrt_'+col)
 	return  							# No return value. Plot is either shown or saved, or nothing is done.
 
+@instrument
 def plot_total_mass_in_particles_with_redshift(df_list,show=True):
 	'''
 	Plotter function to plot the distribution of total mass of star particles at a given redshift with respect to redshift.
 	Parameters :
-	df_list 	- List of dataframes (presumably, with different assembly modes) for which distribution is to be plotted using separate hues on the same plot.
+	df_list 	- List of dataframes (presumably, with different assembly modes) for which distribution is to be plotted using separate hues on the same plot. Snapshot manifests or reductions can be passed instead of particle dataframes.
 	show 		- passed to plot_or_not() function to evaluate whether to show the plot or save it.
 	'''
 	prepare_plot(font_scale=1.25)
@@ -269,37 +2334,116 @@ def plot_total_mass_in_particles_with_redshift(df_list,show=True):
 								  kind='scatter').set(xlabel='Redshift',
 								  ylabel='Total Mass $M_{\odot}$')		# Plots a scatter plot. To plot histogram instead, use displot with kind='hist'. Counts are then computed automatically.
 	g.ax.invert_xaxis()
-	g_axis_level 	= sns.lineplot(data=dist_df,
-								   x='redshift',
-								   y='mass',
-								   hue= hue,
-								   ax=g.ax,
-								   legend=False)		# Plots a line plot above which scatter points will lie.
+	sns.lineplot(data=dist_df,
+				 x='redshift',
+				 y='mass',
+				 hue= hue,
+				 ax=g.ax,
+				 legend=False)		# Plots a line plot above which scatter points will lie.
 	g._legend.set_title(capitalize_first_letter(str(hue)))
 	plot_or_not(show,plot_name='total_mass_wrt_redshift')
 	return  							# No return value. Plot is either shown or saved, or nothing is done.
 
-def plot_mass_distribution(df_list,show=True):
+@instrument
+def plot_percentiles_with_redshift(manifest_list,col='mass',show=True,bands=[(0.16,0.84),(0.05,0.95)],k=None,workers=1):
 	'''
-	Plots mass distribution for different types of assembly modes. Number of particles at all redshifts are added. Rugplot is added to show range of masses involved.
+	Plots median of a column with respect to redshift for different types of assembly modes, with shaded percentile bands around it. Quantiles are estimated from quantile sketches of each snapshot (see get_quantile_df()), so particles are never held in memory.
 	Parameters	:
-	df_list	- List of dataframes (assembly modes) for which distribution is to be plotted using separate hues on different plots with shared y axes.
-	show 	- parameter defining whether to save or show the plot.
+	manifest_list	- List of snapshot manifests or summary dataframes (assembly modes) plotted using separate hues on the same plot.
+	col 			- column, raw or derived (see derived_columns).
+	show 			- passed to plot_or_not() function to evaluate whether to show the plot or save it.
+	bands 			- list of (lower, upper) quantiles of bands, shaded lighter from first to last.
+	k 				- accuracy parameter of sketches, sketch_k if None.
+	workers 		- number of worker processes.
+	'''
+	quantiles 		= sorted({0.5}.union(*bands))
+	quantile_df 	= get_quantile_df(manifest_list,[col],quantiles,k,workers).sort_values('redshift')
+	prepare_plot(font_scale=1.25)
+	hue 			= 'assembly'
+	palette 		= dict(zip(quantile_df[hue].cat.categories, sns.color_palette()))
+	g 				= sns.relplot(data=quantile_df,
+								  x='redshift',
+								  y='q0.5',
+								  hue= hue,
+								  palette=palette,
+								  kind='line',
+								  marker='o').set(xlabel='Redshift',
+								  ylabel='Median '+capitalize_first_letter(col))
+	for name, df in quantile_df.groupby(hue, observed=True):
+		for level, (lower, upper) in enumerate(bands):
+			g.ax.fill_between(df['redshift'], df['q'+format(lower,'g')], df['q'+format(upper,'g')], color=palette[name], alpha=0.3/(level+1), linewidth=0)
+	g.ax.invert_xaxis()
+	g._legend.set_title(capitalize_first_letter(str(hue)))
+	plot_or_not(show,plot_name='percentiles_wrt_redshift_'+col)
+	return
+
+@instrument
+def plot_mass_distribution(df_list,show=True,bins=150,rug='auto',max_points=None,seed=0):
+	'''
+	Plots mass distribution for different types of assembly modes. Number of particles at all redshifts are added. A rug layer is added below each histogram to show range of masses involved.
+	If snapshot manifests are passed instead of particle dataframes, particles are binned chunk by chunk into shared bin edges (see get_histogram_df()) and only pre-binned counts are plotted. Summary dataframes (see read_summary()) are plotted from their stored histograms in the same way.
+	Parameters	:
+	df_list		- List of dataframes (assembly modes) for which distribution is to be plotted using separate hues on different plots with shared y axes.
+	show 		- parameter defining whether to save or show the plot.
+	bins 		- number of bins, or array of bin edges (used for snapshot manifests only).
+	rug 		- rug layer drawn under each histogram :
+				  'all' 	- one tick per particle (particle dataframes only).
+				  'sample' 	- one tick per particle of a random subset of at most max_points particles per assembly mode, stratified by redshift (see subsample_stratified() and get_reservoir_samples()).
+				  'density'	- rasterized strip shaded by particle counts (see add_density_strip()).
+				  'auto' 	- 'all' for particle dataframes with at most max_points particles per assembly mode, 'sample' for larger ones and 'density' for snapshot manifests, whose counts are already binned.
+				  None 		- no rug layer.
+	max_points 	- number of particles above which rug ticks are downsampled. Defaults to max_layer_points.
+	seed 		- seed of random number generator used for downsampling.
 	'''
-	df_list 	= add_assembly_column(df_list)
-	df 			= pd.concat(df_list)
+	max_points 	= max_layer_points if max_points is None else max_points
+	manifests 	= all(is_manifest(df) or is_summary(df) for df in df_list)
+	if manifests:
+		edges 		= np.asarray(bins) if np.ndim(bins) else get_shared_bin_edges(df_list,'mass',bins)
+		df 			= merge_histogram_dfs([get_histogram_df(df_list,edges,'mass')],by=['assembly'])
+		df 			= df[df['counts'] > 0]
+		hist_kws 	= dict(weights='counts',bins=list(edges))	# Edges as list, seaborn compares bins to 'auto' when weights are used.
+		if rug == 'auto':
+			rug 	= 'density'
+		elif rug == 'all':
+			raise ValueError("rug='all' needs particle dataframes, use 'sample' or 'density' for snapshot manifests.")
+	else:
+		df_list 	= add_assembly_column(df_list)
+		df 			= pd.concat([df[['mass','assembly']] for df in df_list])
+		hist_kws 	= dict(bins=bins)
+		if rug == 'auto':
+			rug 	= 'sample' if max(len(df) for df in df_list) > max_points else 'all'
 	prepare_plot(theme='darkgrid',font_scale=1.25)
 	# print(sns.axes_style())
 	hue 		='assembly'
+	names 		= list(df[hue].cat.categories)
+	palette 	= dict(zip(names,sns.color_palette(n_colors=len(names))))
 	g 			= sns.displot(data=df,
 							  x='mass',
 							  col=hue,
 							  hue=hue,
-							  bins=150,
-							  kind='hist',
-							  rug=True,
-							  rug_kws={'height':-0.025,'clip_on':False,'alpha':0.5},).set(title='')
+							  palette=palette,
+							  **hist_kws,
+							  kind='hist',).set(title='')
 	g._legend.set_title(capitalize_first_letter(str(hue)))
+	if rug == 'density' and not manifests:
+		edges 		= get_bin_edges(df['mass'].min(), df['mass'].max(), 1024)
+	if rug == 'all':
+		rug_df 		= df
+	elif rug == 'sample' and manifests:
+		rug_df 		= get_reservoir_samples(df_list, 'mass', max_points, seed)
+	elif rug == 'sample':
+		rug_df 		= pd.concat([subsample_stratified(df, max_points, 'redshift' if 'redshift' in df else None, seed)[['mass','assembly']] for df in df_list])
+	for name, ax in g.axes_dict.items():
+		if rug in ('all','sample'):
+			add_rug(ax, rug_df.loc[rug_df[hue] == name, 'mass'], palette[name])
+		elif rug == 'density':
+			subdf 	= df[df[hue] == name]
+			counts 	= np.zeros(len(edges)-1, dtype=np.int64)
+			if manifests:
+				counts[np.searchsorted(edges, subdf['bin_left'].to_numpy())] 	= subdf['counts'].to_numpy()
+			else:
+				add_to_histogram(counts, subdf['mass'].to_numpy(), edges)
+			add_density_strip(ax, counts, edges, palette[name])
 	for axlist in g.axes:					# Access each axis of FacetGrid
 		for ax in axlist:
 			ax.tick_params(length=10,pad=10)
@@ -307,64 +2451,380 @@ def plot_mass_distribution(df_list,show=True):
 	plot_or_not(show,plot_name='particle_mass_distribution')
 	return
 
-def plot_mass_distribution_with_redshift(df_list,show=True):
+mass_distribution_range = (0, 1.5e6)			# Mass range shown by each facet of mass distributions with redshift.
+
+def get_mass_distribution_edges(df_list, bins=60):
+	'''
+	Returns bin edges of mass distributions with redshift (see plot_mass_distribution_with_redshift()), shared by all snapshots and assembly modes, so that bins bins fall in mass_distribution_range. Snapshots are binned directly into edges spanning mass_distribution_range. Stored histograms of summary dataframes cannot be rebinned finer, so stored edges covering mass_distribution_range are returned instead, coarsened as far as at least bins bins still fall in it (see get_summary_edges()).
+	Parameters	:
+	df_list	- list of snapshot manifests, or of summary dataframes of the same summary file.
+	bins 	- number of bins in mass_distribution_range.
+	'''
+	lo, hi 		= mass_distribution_range
+	if not (df_list and all(is_summary(df) for df in df_list)):
+		return get_bin_edges(lo, hi, bins)
+	edges 		= get_summary_edges(df_list[0], 'mass')
+	start 		= max(np.searchsorted(edges, lo, side='right')-1, 0)
+	visible 	= min(np.searchsorted(edges, hi, side='left'), len(edges)-1)-start
+	factor 		= max(visible//bins, 1)
+	stop 		= start+min(-(-visible//factor), (len(edges)-1-start)//factor)*factor	# Whole coarse bins, covering mass_distribution_range where stored edges do.
+	return edges[start:stop+1:factor]
+
+@instrument
+def plot_mass_distribution_with_redshift(df_list,show=True,bins=60,color=None):
 	'''
-	Plots mass distribution for a range of redshift for each individual type of assembly mode. 
+	Plots mass distribution for a range of redshift for each individual type of assembly mode, over mass_distribution_range. 
+	If snapshot manifests are passed instead of particle dataframes, each snapshot is binned chunk by chunk into bin edges shared by all snapshots and assembly modes (see get_mass_distribution_edges()), and only pre-binned counts are plotted. Summary dataframes (see read_summary()) are plotted from their stored histograms in the same way.
 	Parameters	:
 	df_list	- List of dataframes (assembly modes) for which distribution is to be plotted on a separate figure over a range of axes.
 	show 	- parameter defining whether to save or show the plot.
+	bins 	- number of bins in mass_distribution_range, or array of bin edges (eg. shared with figures rendered separately), used for snapshot manifests only. Bins of particle dataframes are chosen by seaborn for each facet.
+	color 	- color of all figures. Colors cycle through seaborn palette if None.
 	'''
-	palette 	= itertools.cycle(sns.color_palette())
+	palette 	= itertools.cycle(sns.color_palette() if color is None else [color])
+	if all(is_manifest(df) or is_summary(df) for df in df_list):
+		edges 		= np.asarray(bins) if np.ndim(bins) else get_mass_distribution_edges(df_list,bins)
+		hist_kws 	= dict(weights='counts',bins=list(edges))	# Edges as list, seaborn compares bins to 'auto' when weights are used.
+	else:
+		hist_kws 	= dict()
 	for df in df_list :
+		if is_manifest(df) or is_summary(df):
+			name 	= df.name
+			df 		= get_histogram_df([df],edges,'mass')
+			df.name = name
 		prepare_plot(font_scale=2)
-		g = sns.displot(data 	= df,
-						x 		= 'mass',
-						col  	= 'redshift',
-						col_wrap 	= 5,
-						col_order 	= sorted(df['redshift'].unique(), reverse=True),
-						color 	= next(palette),
-						facet_kws	=dict(sharey=False)).set(xlim=[0,1.5e6])
+		sns.displot(data 	= df,
+					x 		= 'mass',
+					col  	= 'redshift',
+					col_wrap 	= 5,
+					col_order 	= sorted(df['redshift'].unique(), reverse=True),
+					color 	= next(palette),
+					**hist_kws,
+					facet_kws	=dict(sharey=False)).set(xlim=list(mass_distribution_range))
 		plot_or_not(show,plot_name='mass_distribution_wrt_redshift_'+str(df.name),dpi=240)
 	return
 
+@instrument
+def plot_projected_map(image,width,field='density',limits=None,title=None,plot_name=None,show=True,dpi=240):
+	'''
+	Plots a single projected map (a frame of an image sequence across redshift, see plot_projected_maps()) : surface density on a log colour scale, or line-of-sight velocity on a diverging colour scale centred on zero, with axes in kpc relative to subhalo centre.
+	Parameters	:
+	image 		- 2D array of one field of a projected map (see get_projected_maps()), rows along vertical image axis.
+	width 		- width of field of view, in units of Coordinates.
+	field 		- one of map_fields.
+	limits 		- (vmin, vmax) colour limits, shared by frames of a sequence (see get_map_limits()). Limits of image if None.
+	title 		- title of figure, eg. redshift of snapshot.
+	plot_name	- name of saved figure (see plot_or_not()).
+	show 		- passed to plot_or_not() function to evaluate whether to show the plot or save it.
+	dpi 		- resolution of saved figure.
+	'''
+	prepare_plot(theme='white',font_scale=1.25)
+	limits 			= get_map_limits(image, field) if limits is None else limits
+	if field == 'density':
+		kwargs 		= dict(norm=matplotlib.colors.LogNorm(*limits), cmap='magma')
+		label 		= 'Surface density $[M_{\odot}\,\mathrm{Mpc}^{-2}]$'
+		image 		= np.where(image > 0, image, np.nan)
+	else:
+		kwargs 		= dict(vmin=limits[0], vmax=limits[1], cmap='RdBu_r')
+		label 		= 'Line-of-sight velocity $[\mathrm{km}\,\mathrm{s}^{-1}]$'
+	fig, ax 		= plt.subplots(figsize=(6,5))
+	ax.set_facecolor('black' if field == 'density' else 'white')
+	half_width 		= width/2*1e3			# Coordinates in Mpc, axes in kpc.
+	mappable 		= ax.imshow(image, origin='lower', extent=[-half_width, half_width, -half_width, half_width], interpolation='nearest', **kwargs)
+	fig.colorbar(mappable, ax=ax, label=label)
+	ax.set(xlabel='Offset [kpc]', ylabel='Offset [kpc]', title=title or '')
+	plot_or_not(show,plot_name=plot_name,dpi=dpi)
+	return
 
-# ============================================ Main program =============================================
+def get_map_tasks(maps_dict, manifest_list, width, axis='z', fields=map_fields):
+	'''
+	Returns plotting tasks (see render_figures()) drawing one frame per snapshot, field and assembly mode of projected maps, named map_<field>_<axis>_<assembly>_<snapshot>, eg. map_density_z_Organic_022. Colour limits are shared by all frames of a field, across snapshots and assembly modes.
+	Parameters	:
+	maps_dict 		- dictionary of projected maps arrays (see get_projected_maps_list()).
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	width 			- width of field of view, in units of Coordinates.
+	axis 			- projection axis of maps.
+	fields 			- list of fields from map_fields.
+	'''
+	tasks 		= list()
+	for field in fields:
+		limits 		= get_map_limits([maps[:,map_fields.index(field)] for maps in maps_dict.values()], field)
+		for manifest in manifest_list:
+			for maps, snapshot, redshift in zip(maps_dict[manifest.name], manifest['snapshot'], manifest['redshift']):
+				plot_name 	= 'map_{}_{}_{}_{:03d}'.format(field, axis, manifest.name, snapshot)
+				tasks.append((plot_projected_map, (maps[map_fields.index(field)], width), dict(field=field, limits=limits, title='{}, z = {:.3f}'.format(manifest.name, redshift), plot_name=plot_name), [plot_name]))
+	return tasks
 
+def plot_projected_maps(maps_dict, manifest_list, width, axis='z', fields=map_fields, show=True, workers=None, force=False):
+	'''
+	Plots projected maps of assembly modes as image sequences across redshift, one frame per snapshot (see get_map_tasks()). Frames are saved in parallel worker processes, skipping unchanged ones (see render_figures()), unless show is set.
+	Parameters	:
+	maps_dict 		- dictionary of projected maps arrays (see get_projected_maps_list()).
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	width 			- width of field of view, in units of Coordinates.
+	axis 			- projection axis of maps.
+	fields 			- list of fields from map_fields.
+	show 			- show frames one at a time if True, else save them.
+	workers 		- number of worker processes rendering frames.
+	force 			- render unchanged frames too.
+	'''
+	tasks 		= get_map_tasks(maps_dict, manifest_list, width, axis, fields)
+	if not show:
+		return render_figures(tasks, workers, force)
+	for function, args, kwargs, plot_names in tasks:
+		function(*args, show=show, **kwargs)
+	return
 
-if __name__ == '__main__' :
 
-	# ------- Get hdf5 file handles list for each type of assembly.
+# ----------------------- Command line functions ---------------------------
+
+# ------- Assembly modes, as identified on the command line, mapped to plot-friendly names. Data of each is in directory <assembly>_data (see get_directory()).
+
+assembly_names = {
+	'gm_early'	: 'GM-Early',
+	'organic'	: 'Organic',
+	'gm_late'	: 'GM-Late'
+	}
+
+# ------- Figures drawn by plot command.
+
+figure_names = ['mass_distribution', 'mass_distribution_with_redshift', 'particle_distribution', 'total_mass', 'percentiles']
+
+def get_manifest_list(assemblies, summary=None):
+	'''
+	Returns snapshot manifests of assembly modes, with their name attributes set, or summary dataframes of assembly modes read from a summary file (see read_summary()).
+	Parameters	:
+	assemblies 	- list of assembly modes (see assembly_names).
+	summary 	- path of summary file. Snapshot manifests are returned if None.
+	'''
+	if summary is not None:
+		return read_summary(summary, [assembly_names[assembly] for assembly in assemblies])
+	return [get_manifest(get_directory(assembly+'_data'), assembly_names[assembly]) for assembly in assemblies]
+
+def get_plot_summary(manifest_list, params_list, workers=1):
+	'''
+	Returns summary dataframes of snapshot manifests (see read_summary()), from a summary file in cache directory written by write_summary() if missing. The file is keyed by paths, sizes and modification times of snapshots and by columns, so a changed snapshot gets a new summary; summaries of earlier keys are removed.
+	Parameters	:
+	manifest_list	- list of snapshot manifests with their name attributes set.
+	params_list		- list of columns, raw or derived.
+	workers 		- number of worker processes of write_summary().
+	'''
+	digest 		= hashlib.sha1()
+	update_signature(digest, (manifest_list, [manifest.name for manifest in manifest_list], list(params_list), summary_bins, sketch_k))
+	cache_dir 	= get_directory('cache')
+	path 		= os.path.join(cache_dir, 'plot_summary_'+digest.hexdigest()+'.hdf5')
+	if not os.path.exists(path):
+		if os.path.isdir(cache_dir):
+			for stale in os.listdir(cache_dir):
+				if stale.startswith('plot_summary_'):
+					os.remove(os.path.join(cache_dir, stale))
+		write_summary(path, manifest_list, params_list, workers=workers)
+	return read_summary(path, [manifest.name for manifest in manifest_list])
+
+def concat_with_assembly(df_list):
+	'''
+	Returns dataframes of several assembly modes concatenated into one, with an assembly column leading (see add_assembly_column()).
+	Parameters	:
+	df_list	- a list of dataframes with their name attributes already set.
+	'''
+	df 	= pd.concat(add_assembly_column(df_list), ignore_index=True)
+	return df[['assembly']+[col for col in df.columns if col != 'assembly']]
+
+def run_manifest(options):
+	'''
+	Command listing snapshots of assembly modes from hdf5 metadata only : snapshot, redshift, number of particles and dataset shapes (see get_manifest()).
+	'''
+	write_table(concat_with_assembly(get_manifest_list(options.assembly)), options.output)
+
+def run_reduce(options):
+	'''
+	Command writing out-of-core reductions of columns for each snapshot of assembly modes : counts, sums, means, minima and maxima (see reduce_snapshots()).
+	'''
+	reductions 	= list()
+	for manifest in get_manifest_list(options.assembly):
+		reduction 		= reduce_snapshots(manifest, options.cols)
+		reduction.name 	= manifest.name
+		reductions.append(reduction)
+	write_table(concat_with_assembly(reductions), options.output)
 
-	gm_early_files		= get_files(get_directory('gm_early_data'))
-	organic_files		= get_files(get_directory('organic_data'))
-	gm_late_files		= get_files(get_directory('gm_late_data'))
+def run_histogram(options):
+	'''
+	Command writing histograms of a column for each snapshot of assembly modes, on bin edges shared by all of them (see get_histogram_df()), or summed over snapshots with --merge-snapshots.
+	'''
+	manifest_list 	= get_manifest_list(options.assembly)
+	edges 			= get_shared_bin_edges(manifest_list, options.col, options.bins, options.log)
+	df 				= get_histogram_df(manifest_list, edges, options.col, options.log, options.workers)
+	if options.merge_snapshots:
+		df 			= merge_histogram_dfs([df], by=['assembly'])
+	write_table(df, options.output)
 
-	# ------- Available fields for cols :
-	# ------- 'coords_x', 'coords_y', 'coords_z', 'vel_x', 'vel_y', 'vel_z', 'mass', 'redshift'
-	
-	cols				= ['mass', 'coords_x']
+def run_quantiles(options):
+	'''
+	Command writing quantiles of columns for each snapshot of assembly modes, estimated from mergeable quantile sketches filled chunk by chunk (see get_quantile_df()), or over all snapshots with --merge-snapshots.
+	'''
+	df 	= get_quantile_df(get_manifest_list(options.assembly, options.summary), options.cols, options.quantiles, options.k, options.workers, options.merge_snapshots)
+	write_table(df, options.output)
 
-	# ------- Get concatenated dataframe containing data for each type of assembly mode.
+def run_summary(options):
+	'''
+	Command writing reduced products of assembly modes (reductions, histograms and quantile sketches of columns of each snapshot) to a compressed hdf5 summary file (see write_summary()), summaries/summary.hdf5 unless --output is set.
+	'''
+	path 	= options.output or os.path.join(get_directory('summaries'), 'summary.hdf5')
+	write_summary(path, get_manifest_list(options.assembly), options.cols, options.bins, options.log, options.k, options.workers)
+	print(path, os.path.getsize(path), 'bytes')
 
-	gm_early_df 		= get_df(gm_early_files,cols)
-	organic_df 			= get_df(organic_files,cols)
-	gm_late_df 			= get_df(gm_late_files,cols)
+def run_plot(options):
+	'''
+	Command drawing figures of assembly modes from snapshot manifests (binned out of core), from a summary file with --summary, or from particle dataframes with --particles. Figures are saved without a display unless --show is set, in parallel with --batch. Snapshot manifests are then summarized once, in this process (see get_plot_summary()), and figures are rendered from summary dataframes, so that snapshots are not read again by every figure.
+	'''
+	global figures_dir
+	if not options.show:
+		matplotlib.use('Agg')
+	if options.output is not None:
+		figures_dir 	= options.output
+	os.makedirs(get_figures_dir(), exist_ok=True)
+	manifest_list 	= get_manifest_list(options.assembly, options.summary)
+	if options.batch and options.summary is None and not options.particles:
+		manifest_list 	= get_plot_summary(manifest_list, list(dict.fromkeys(['mass', options.percentile_col])), options.workers)
+	if options.particles:
+		df_list 	= get_dfs([list(manifest['path']) for manifest in manifest_list], ['mass', options.col] if options.col != 'mass' else ['mass'], options.workers, get_directory('cache'), memmap=options.memmap)
+		for df, manifest in zip(df_list, manifest_list):
+			df.name = manifest.name
+	else:
+		df_list 	= manifest_list
+	tasks 			= list()
+	if 'mass_distribution' in options.figures:
+		tasks.append((plot_mass_distribution, (df_list,), dict(bins=options.bins or 150), ['particle_mass_distribution']))
+	if 'mass_distribution_with_redshift' in options.figures:
+		bins 		= options.bins or 60
+		if not options.particles:
+			bins 	= get_mass_distribution_edges(manifest_list, bins)		# Precomputed bin edges, shared by figures of all assembly modes.
+		tasks 		+= [(plot_mass_distribution_with_redshift, ([df],), dict(bins=bins, color=color), ['mass_distribution_wrt_redshift_'+df.name])
+						for df, color in zip(df_list, sns.color_palette())]
+	if 'particle_distribution' in options.figures:
+		tasks.append((plot_particle_distribution, (df_list,), dict(col=options.col), ['particle_distribution_wrt_'+options.col]))
+	if 'total_mass' in options.figures:
+		tasks.append((plot_total_mass_in_particles_with_redshift, (df_list,), dict(), ['total_mass_wrt_redshift']))
+	if 'percentiles' in options.figures:
+		tasks.append((plot_percentiles_with_redshift, (manifest_list,), dict(col=options.percentile_col, workers=1 if options.batch else options.workers), ['percentiles_wrt_redshift_'+options.percentile_col]))
+	if options.batch:
+		print(render_figures(tasks, options.workers, options.force))
+	else:
+		for function, args, kwargs, plot_names in tasks:
+			function(*args, show=options.show, **kwargs)
+			if not options.show:
+				plt.close('all')
 
-	# ------- Provide plot-friendly names to dataframes for deffrent assembly modes.
-	
-	gm_early_df.name  	= 'GM-Early'
-	organic_df.name  	= 'Organic'
-	gm_late_df.name  	= 'GM-Late'
+def run_maps(options):
+	'''
+	Command drawing projected surface density and line-of-sight velocity maps of assembly modes around subhalo centres of halo catalogues, as image sequences across redshift (see plot_projected_maps()). Frames are saved in parallel without a display unless --show is set.
+	'''
+	global figures_dir
+	if not options.show:
+		matplotlib.use('Agg')
+	if options.output is not None:
+		figures_dir 	= options.output
+	os.makedirs(get_figures_dir(), exist_ok=True)
+	manifest_list 	= get_manifest_list(options.assembly)
+	catalogue_list 	= [get_catalogue(assembly) for assembly in options.assembly]
+	maps_dict 		= get_projected_maps_list(manifest_list, catalogue_list, options.width, options.pixels, options.axis, options.method, options.depth, None if options.rest_frame == 'none' else options.rest_frame, workers=options.workers)
+	rendered 		= plot_projected_maps(maps_dict, manifest_list, options.width, options.axis, options.fields, options.show, options.workers, options.force)
+	if rendered is not None:
+		print(len(rendered), 'frames rendered')
 
-	df_list 			= [gm_early_df,organic_df,gm_late_df]
-	# df_list 			= [organic_df]
+def get_parser():
+	'''
+	Returns command line parser, with subcommands manifest, reduce, histogram, quantiles, summary, plot and maps.
+	'''
+	parser 		= argparse.ArgumentParser(description='Reduces and plots star particle data of hdf5 snapshots of assembly modes.')
+	common 		= argparse.ArgumentParser(add_help=False)
+	common.add_argument('--assembly', nargs='+', choices=list(assembly_names), default=list(assembly_names), help='assembly modes (default: all)')
+	common.add_argument('--profile', action='store_true', help='record wall time, bytes read and peak memory of each pipeline stage')
+	common.add_argument('--profile-report', metavar='PATH', default=None, help='write profiling report to PATH, as json if PATH ends with .json, else as a table (printed if not set)')
+	table 		= argparse.ArgumentParser(add_help=False)
+	table.add_argument('--output', '-o', metavar='PATH', default=None, help="output file (.csv, or .json; '-' for csv on standard output; printed as a table if not set)")
+	parallel 	= argparse.ArgumentParser(add_help=False)
+	parallel.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes (default: number of CPUs)')
+	commands 	= parser.add_subparsers(dest='command', required=True)
+	command 	= commands.add_parser('manifest', parents=[common, table], help='list snapshots from hdf5 metadata only')
+	command.set_defaults(run=run_manifest)
+	command 	= commands.add_parser('reduce', parents=[common, table], help='reduce columns of each snapshot out of core')
+	command.add_argument('--cols', nargs='+', default=['mass'], help="columns, raw or derived, eg. mass speed radius (default: mass)")
+	command.set_defaults(run=run_reduce)
+	command 	= commands.add_parser('histogram', parents=[common, table, parallel], help='histogram a column of each snapshot out of core')
+	command.add_argument('--col', default='mass', help='column, raw or derived (default: mass)')
+	command.add_argument('--bins', type=int, default=150, help='number of bins (default: 150)')
+	command.add_argument('--log', action='store_true', help='log spaced bins')
+	command.add_argument('--merge-snapshots', action='store_true', help='sum histograms over snapshots')
+	command.set_defaults(run=run_histogram)
+	command 	= commands.add_parser('quantiles', parents=[common, table, parallel], help='estimate quantiles of columns of each snapshot out of core, from quantile sketches')
+	command.add_argument('--cols', nargs='+', default=['mass'], help='columns, raw or derived (default: mass)')
+	command.add_argument('--quantiles', nargs='+', type=float, default=[0.05,0.16,0.25,0.5,0.75,0.84,0.95], help='quantiles, between 0 and 1 (default: 0.05 0.16 0.25 0.5 0.75 0.84 0.95)')
+	command.add_argument('--k', type=int, default=sketch_k, help='accuracy parameter of sketches, rank error is about 1.7/k (default: %(default)s)')
+	command.add_argument('--merge-snapshots', action='store_true', help='merge sketches over snapshots')
+	command.add_argument('--summary', metavar='PATH', default=None, help='read quantile sketches from summary file PATH instead of snapshots')
+	command.set_defaults(run=run_quantiles)
+	command 	= commands.add_parser('summary', parents=[common, parallel], help='write reduced products of snapshots to a compressed hdf5 summary file')
+	command.add_argument('--output', '-o', metavar='PATH', default=None, help='path of summary file (default: summaries/summary.hdf5)')
+	command.add_argument('--cols', nargs='+', default=['mass'], help='columns, raw or derived (default: mass)')
+	command.add_argument('--bins', type=int, default=summary_bins, help='number of bins of histograms (default: %(default)s)')
+	command.add_argument('--log', action='store_true', help='log spaced bins')
+	command.add_argument('--k', type=int, default=sketch_k, help='accuracy parameter of quantile sketches (default: %(default)s)')
+	command.set_defaults(run=run_summary)
+	command 	= commands.add_parser('plot', parents=[common, parallel], help='draw figures')
+	command.add_argument('--output', '-o', metavar='DIR', default=None, help='directory of saved figures (default: plots)')
+	command.add_argument('--figures', nargs='+', choices=figure_names, default=figure_names, help='figures to draw (default: all)')
+	command.add_argument('--col', default='redshift', help='column of particle distribution figure (default: redshift)')
+	command.add_argument('--bins', type=int, default=None, help='number of bins of mass distributions')
+	command.add_argument('--percentile-col', default='mass', help='column of percentiles figure, raw or derived (default: mass)')
+	source 		= command.add_mutually_exclusive_group()
+	source.add_argument('--particles', action='store_true', help='plot from particle dataframes read into memory instead of snapshot manifests')
+	source.add_argument('--summary', metavar='PATH', default=None, help='plot from summary file PATH (see summary command) instead of snapshot manifests')
+	command.add_argument('--memmap', action='store_true', help='with --particles, read contiguous datasets through memory-mapped views instead of hdf5')
+	command.add_argument('--show', action='store_true', help='show figures interactively instead of saving them')
+	command.add_argument('--batch', action='store_true', help='render figures in parallel, skipping unchanged ones')
+	command.add_argument('--force', action='store_true', help='with --batch, render unchanged figures too')
+	command.set_defaults(run=run_plot)
+	command 	= commands.add_parser('maps', parents=[common, parallel], help='draw projected maps around subhalo centres as image sequences across redshift')
+	command.add_argument('--output', '-o', metavar='DIR', default=None, help='directory of saved frames (default: plots)')
+	command.add_argument('--axis', choices=list(projection_axes), default='z', help='projection axis (default: z)')
+	command.add_argument('--width', type=float, default=0.04, help='width of field of view, in units of Coordinates (default: 0.04)')
+	command.add_argument('--pixels', type=int, default=256, help='number of pixels along each image axis (default: 256)')
+	command.add_argument('--method', choices=['ngp','cic'], default='cic', help='deposit of particles, nearest grid point or cloud in cell (default: cic)')
+	command.add_argument('--depth', type=float, default=None, help='thickness of projected slab around subhalo centre (default: all particles)')
+	command.add_argument('--rest-frame', choices=['mean','subhalo','none'], default='mean', help='line-of-sight velocity subtracted from velocities (default: mean)')
+	command.add_argument('--fields', nargs='+', choices=map_fields, default=map_fields, help='fields to draw (default: all)')
+	command.add_argument('--show', action='store_true', help='show frames interactively instead of saving them')
+	command.add_argument('--force', action='store_true', help='render unchanged frames too')
+	command.set_defaults(run=run_maps)
+	return parser
 
-	# ------- Plot the particle number distribution for all assembly modes. All plotting functions are standalone.
+def main(argv=None):
+	'''
+	Runs a command given on the command line (see get_parser()).
+	Parameters	:
+	argv 	- list of command line arguments, sys.argv[1:] if None.
+	'''
+	options 	= get_parser().parse_args(argv)
+	if options.profile:
+		start_profiling()
+	options.run(options)
+	if options.profile:
+		write_profile_report(options.profile_report)
 
-	# plot_mass_distribution(df_list,show=True)
+# ============================================ Main program =============================================
 
-	plot_mass_distribution_with_redshift(df_list,show=False)
+if __name__ == '__main__' :
 
-	# plot_particle_distribution(df_list,show=True)
+	# ------- Eg. python plotter.py manifest --assembly organic
+	# -------     python plotter.py reduce --cols mass speed -o reductions.csv
+	# -------     python plotter.py histogram --col mass --bins 150 --merge-snapshots --workers 4 --profile -o -
+	# -------     python plotter.py quantiles --cols mass speed --quantiles 0.16 0.5 0.84
+	# -------     python plotter.py summary --cols mass speed -o summary.hdf5
+	# -------     python plotter.py plot --summary summary.hdf5 --figures mass_distribution total_mass percentiles
+	# -------     python plotter.py plot --figures mass_distribution total_mass --batch
+	# -------     python plotter.py maps --axis x --pixels 512 --method cic -o ../plots/maps
+	# ------- Radial stellar mass, density and velocity dispersion profiles around subhalo centres are computed by get_radial_profiles_list(), eg.
+	# ------- get_radial_profiles_list(manifest_list,[get_catalogue(assembly) for assembly in assembly_names],get_bin_edges(1e-4,3e-2,20,log=True))
 
-	# plot_total_mass_in_particles_with_redshift(df_list,show=True)
\ No newline at end of file
+	main()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import h5py
+
+from plotter import get_manifest, get_projected_maps, map_fields
+
+def write_snapshot(directory, coordinates, velocities, masses):
+	path 	= directory/'star_particles_005_z001p000.hdf5'
+	with h5py.File(path, 'w') as fname:
+		fname['Coordinates'] 	= coordinates
+		fname['Velocity'] 		= velocities
+		fname['Mass'] 			= masses
+		fname.create_group('Header').attrs['NumStars_30kpc'] = np.int32(len(masses))
+	return get_manifest(str(directory), 'Organic')
+
+def get_catalogue(centre, velocity):
+	row 	= {'index':0, 'redshift':1.}
+	row.update({'subhalo_centre_'+axis : value for axis, value in zip('xyz', centre)})
+	row.update({'subhalo_peculiar_velocity_'+axis : value for axis, value in zip('xyz', velocity)})
+	return pd.DataFrame([row])
+
+def get_velocity_map(manifest, catalogue):
+	maps 		= get_projected_maps(manifest, catalogue, width=0.04, pixels=8, method='ngp', rest_frame='subhalo')
+	velocity 	= maps[0, map_fields.index('velocity')]
+	return velocity[np.isfinite(velocity)]
+
+def test_get_projected_maps_subhalo_frame_of_centred_snapshot(tmp_path):
+	rng 		= np.random.default_rng(0)
+	coordinates = rng.uniform(-0.01, 0.01, (100,3))
+	velocities 	= np.tile([0., 0., 5.], (100,1))
+	manifest 	= write_snapshot(tmp_path, coordinates, velocities, np.ones(100))
+	velocity 	= get_velocity_map(manifest, get_catalogue([10., 10., 10.], [0., 0., 100.]))
+	assert len(velocity)
+	np.testing.assert_allclose(velocity, 5.)
+
+def test_get_projected_maps_subhalo_frame_of_box_snapshot(tmp_path):
+	rng 		= np.random.default_rng(0)
+	coordinates = 10.+rng.uniform(-0.01, 0.01, (100,3))
+	velocities 	= np.tile([0., 0., 105.], (100,1))
+	manifest 	= write_snapshot(tmp_path, coordinates, velocities, np.ones(100))
+	velocity 	= get_velocity_map(manifest, get_catalogue([10., 10., 10.], [0., 0., 100.]))
+	assert len(velocity)
+	np.testing.assert_allclose(velocity, 5.)
@@ -1,43 +1,34 @@
 import numpy as np 
 import pandas as pd 
-import matplotlib.pyplot as plt 
-import matplotlib as mpl 
-import seaborn as sns
-from astropy.cosmology import FlatLambdaCDM, z_at_value
-import astropy.units as u
+import os
+import sys
+import argparse
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))		# Repository root, holding pipeline_tools shared with the June7 plotter
+from pipeline_tools import lazy_import, write_table, get_function_sources, start_profiling, instrument, write_profile_report
 
-			# ------- Define a flat Lambda-CDM cosmology with parameters mentioned in Schaye et al. 2015
+			# ------- Plotting libraries and astropy are imported on first use, so that data-only runs start fast and do not need a display
 
-cosmology = FlatLambdaCDM(100.*0.6777,Om0=0.307,Ob0=0.04825)
+mpl 				= lazy_import('matplotlib')
+plt 				= lazy_import('matplotlib.pyplot')
+sns 				= lazy_import('seaborn')
+astropy_cosmology 	= lazy_import('astropy.cosmology')
 
-# ===================================== User-defined function definitions ===============================
-
-def redshift_x_axis(ax, ax_primary):
-	
-	'''
-	Function mapping of ticks for a secondary redshift axis corresponding to cosmological lookback time.
-	Parameters:
-	ax			= secondary redshift axis, probably defined using matplotlib's twinx/twiny function
-	ax_primary 	= primary lookback time axis
-	'''
-
-	zvals 		= np.array([0.0,0.125,0.25,0.5,1.0,2.5,5.0,7.0]) # Redshift tick values
-	time_in_Gyr = cosmology.age(zvals).value 					 # Lookback time corresponding to redshift tick values
-	ax.set_xticks(time_in_Gyr)									 # Position ticks at lookback times corresponding to redshift tick values
-	ax.set_xticklabels('{:g}'.format(z) for z in zvals)			 # Rename lookback time ticks to corresponding redshift values
-	ax.set_xlim(ax_primary.get_xlim())							 # Set equal axis limits for the two x-axes
-	return ax
+			# ------- Define a flat Lambda-CDM cosmology with parameters mentioned in Schaye et al. 2015 (H0, Om0, Ob0). Astropy is only needed to build lookup tables (see get_cosmology()).
 
+cosmology_parameters 	= (100.*0.6777, 0.307, 0.04825)
+cosmologies 			= dict()
 
-# ===================================== Main program ====================================================
+			# ------- Lookup tables of cosmic age and lookback time, persisted to disk and loaded once per run (see get_cosmology_tables())
 
-			# ------- Data directory and file names
+cosmology_tables_fname 	= os.path.join(os.path.dirname(os.path.abspath(__file__)),'cache','cosmology_tables.npz')
+cosmology_tables 		= dict()
 
-data_dir 		= './data_updated/'
-gm_early_fname 	= 'halo_catalogue_gm_early.txt'
-organic_fname	= 'halo_catalogue_organic.txt'
-gm_late_fname 	= 'halo_catalogue_gm_late.txt'
+# ===================================== Catalogue columns and plotting parameters ========================
 
 			# ------- Dataframe columns
 
@@ -82,6 +73,10 @@ units = {
 	'subhalo_peculiar_velocity':'$km s^{-1}$'
 }
 
+			# ------- Columns derived from catalogue columns
+
+derived_fields = ['subhalo_peculiar_velocity']
+
 			# ------- Dataframe columns to be plotted on log scale
 
 # Compute log10 values instead of using plt.scale("log") for correct axis ticks.
@@ -108,63 +103,254 @@ zero_values = {
 yaxes = ['Stellar_mass','Halo_mass','BH_mass','SFR','sSFR','subhalo_peculiar_velocity']
 # yaxes 	= ['SFR']
 
-			# ------- Read and categorise data on the basis of assembly mode - GM-early, organic and GM-late
-
-gm_early_data 	= pd.read_fwf(data_dir+gm_early_fname,skiprows=1,names=cols)
-organic_data 	= pd.read_fwf(data_dir+organic_fname,skiprows=1,names=cols)
-gm_late_data 	= pd.read_fwf(data_dir+gm_late_fname,skiprows=1,names=cols)
+# ===================================== User-defined function definitions ===============================
 
-gm_early_data['assembly'] 	= 'gm-early'
-gm_early_data['assembly'] 	= gm_early_data['assembly'].astype('category')
-organic_data['assembly'] 	= 'organic'
-organic_data['assembly'] 	= organic_data['assembly'].astype('category')
-gm_late_data['assembly'] 	= 'gm-late'
-gm_late_data['assembly'] 	= gm_late_data['assembly'].astype('category')
+def get_cosmology():
+	'''
+	Returns astropy flat Lambda-CDM cosmology with cosmology_parameters, built on first call.
+	'''
+	if cosmology_parameters not in cosmologies:
+		H0, Om0, Ob0 	= cosmology_parameters
+		cosmologies[cosmology_parameters] 	= astropy_cosmology.FlatLambdaCDM(H0,Om0=Om0,Ob0=Ob0)
+	return cosmologies[cosmology_parameters]
 
-			# ------- Calculate Euclid norm for subhalo peculiar velocity
+def build_cosmology_tables(z_max=20., points=4097):
+	'''
+	Returns dense lookup tables of cosmic age and lookback time (in Gyr) for the cosmology, on a grid uniform in ln(1+z) from z = 0 to z_max. Astropy is evaluated once on the grid, and once on midpoints of the grid to record the largest interpolation error (max_error, in Gyr).
+	Parameters:
+	z_max 		= highest redshift of the tables
+	points 		= number of grid points
+	'''
+	cosmology 	= get_cosmology()
+	x 			= np.linspace(0.,np.log1p(z_max),points)
+	redshift 	= np.expm1(x)
+	age 		= cosmology.age(redshift).value
+	midpoints 	= np.expm1((x[1:]+x[:-1])/2)
+	max_error 	= np.abs(cosmology.age(midpoints).value-(age[1:]+age[:-1])/2).max()
+	return {
+		'log1p_redshift'	: x,
+		'redshift'			: redshift,
+		'age'				: age,
+		'lookback_time'		: age[0]-age,
+		'max_error'			: max_error,
+		'parameters'		: np.array(cosmology_parameters+(z_max,points))
+	}
+
+def get_cosmology_tables(fname=cosmology_tables_fname, z_max=20., points=4097):
+	'''
+	Returns lookup tables of the cosmology (see build_cosmology_tables()). Tables are loaded from fname if it holds tables of the same cosmology and grid, else built (importing astropy) and saved to fname. They are kept in memory after the first call.
+	Parameters:
+	fname 		= path of .npz file persisting the tables
+	z_max 		= highest redshift of the tables
+	points 		= number of grid points
+	'''
+	parameters 	= np.array(cosmology_parameters+(z_max,points))
+	if cosmology_tables.get('fname') == fname and np.array_equal(cosmology_tables.get('parameters'),parameters):
+		return cosmology_tables
+	tables 		= None
+	if os.path.exists(fname):
+		with np.load(fname) as npz:
+			if np.array_equal(npz['parameters'],parameters):
+				tables 	= {key : npz[key] for key in npz.files}
+	if tables is None:
+		tables 	= build_cosmology_tables(z_max,points)
+		os.makedirs(os.path.dirname(fname),exist_ok=True)
+		np.savez(fname,**tables)
+	cosmology_tables.clear()
+	cosmology_tables.update(tables,fname=fname)
+	return cosmology_tables
+
+def age_at_redshift(z):
+	'''
+	Returns cosmic age (in Gyr) at redshifts z, interpolated from lookup tables. Vectorized; NaN outside range of the tables.
+	Parameters:
+	z 			= redshift values (scalar or array)
+	'''
+	tables 		= get_cosmology_tables()
+	x 			= np.log1p(np.asarray(z,dtype=float))
+	return np.interp(x,tables['log1p_redshift'],tables['age'],left=np.nan,right=np.nan)
 
-gm_early_data['subhalo_peculiar_velocity']	= np.sqrt(
-	(gm_early_data['subhalo_peculiar_velocity_x'])**2 + 
-	(gm_early_data['subhalo_peculiar_velocity_y'])**2 + 
-	(gm_early_data['subhalo_peculiar_velocity_z'])**2 )
-organic_data['subhalo_peculiar_velocity'] 	= np.sqrt(
-	(organic_data['subhalo_peculiar_velocity_x'])**2 + 
-	(organic_data['subhalo_peculiar_velocity_y'])**2 + 
-	(organic_data['subhalo_peculiar_velocity_z'])**2 )
-gm_late_data['subhalo_peculiar_velocity'] 	= np.sqrt(
-	(gm_late_data['subhalo_peculiar_velocity_x'])**2 + 
-	(gm_late_data['subhalo_peculiar_velocity_y'])**2 + 
-	(gm_late_data['subhalo_peculiar_velocity_z'])**2 )
+def lookback_time_at_redshift(z):
+	'''
+	Returns lookback time (in Gyr) at redshifts z, interpolated from lookup tables. Vectorized; NaN outside range of the tables.
+	Parameters:
+	z 			= redshift values (scalar or array)
+	'''
+	tables 		= get_cosmology_tables()
+	x 			= np.log1p(np.asarray(z,dtype=float))
+	return np.interp(x,tables['log1p_redshift'],tables['lookback_time'],left=np.nan,right=np.nan)
 
-			# ------- Replace zero values in columns
+def redshift_at_age(t):
+	'''
+	Returns redshifts at cosmic ages t (in Gyr), inverting the monotonic age table by interpolation (instead of root finding with z_at_value). Vectorized; NaN outside range of the tables.
+	Parameters:
+	t 			= cosmic age values (scalar or array)
+	'''
+	tables 		= get_cosmology_tables()
+	x 			= np.interp(np.asarray(t,dtype=float),tables['age'][::-1],tables['log1p_redshift'][::-1],left=np.nan,right=np.nan)
+	return np.expm1(x)
 
-for key in zero_values:
-	gm_early_data[key].replace(float(0),zero_values[key],inplace=True)
-	organic_data[key].replace(float(0),zero_values[key],inplace=True)
-	gm_late_data[key].replace(float(0),zero_values[key],inplace=True)
+def scale_factor(z):
+	'''
+	Returns expansion factor a = 1/(1+z) at redshifts z. Exact, so no lookup table is needed.
+	Parameters:
+	z 			= redshift values (scalar or array)
+	'''
+	return 1./(1.+np.asarray(z,dtype=float))
 
-			# ------- Convert to log10 values for each column in list log10_unit_variables
+def to_physical(values, z):
+	'''
+	Returns comoving values (eg. coordinates of particles or subhalo centres) converted to physical units, by multiplying with expansion factor at redshifts z. Vectorized; z broadcasts against values (eg. one redshift per row).
+	Parameters:
+	values 		= comoving values
+	z 			= redshift values
+	'''
+	return np.asarray(values)*scale_factor(z)
 
-for variable in log10_unit_variables :
-	gm_early_data[variable] = gm_early_data[variable].map(np.log10)
-	organic_data[variable]	= organic_data[variable].map(np.log10)
-	gm_late_data[variable]	= gm_late_data[variable].map(np.log10)
+def redshift_x_axis(ax, ax_primary):
+	
+	'''
+	Function mapping of ticks for a secondary redshift axis corresponding to cosmological lookback time.
+	Parameters:
+	ax			= secondary redshift axis, probably defined using matplotlib's twinx/twiny function
+	ax_primary 	= primary lookback time axis
+	'''
 
-			# ------- Concatenate all separate dataframes to one
-			# ------- Declare empty dataframe for tabulation deviations of GM cases from organic cases
+	zvals 		= np.array([0.0,0.125,0.25,0.5,1.0,2.5,5.0,7.0]) # Redshift tick values
+	time_in_Gyr = age_at_redshift(zvals) 						 # Lookback time corresponding to redshift tick values
+	ax.set_xticks(time_in_Gyr)									 # Position ticks at lookback times corresponding to redshift tick values
+	ax.set_xticklabels('{:g}'.format(z) for z in zvals)			 # Rename lookback time ticks to corresponding redshift values
+	ax.set_xlim(ax_primary.get_xlim())							 # Set equal axis limits for the two x-axes
+	return ax
 
-df 			= pd.concat([gm_early_data,organic_data,gm_late_data])
-dev_df 		= pd.DataFrame()
 
-			# ------- Loop for every dataframe column to be plotted
+def get_assembly_name(fname):
+	'''
+	Returns plot-friendly name of assembly mode of a halo catalogue file, eg. gm-early for halo_catalogue_gm_early.txt.
+	Parameters:
+	fname 		= path to halo catalogue file
+	'''
+	return os.path.splitext(os.path.basename(fname))[0].replace('halo_catalogue_','').replace('_','-')
 
-for y in yaxes:  
+@instrument
+def read_catalogues(fnames):
+	'''
+	Reads any number of halo catalogue files into a single array indexed by assembly x snapshot x field.
+	Returns (data, assemblies, snapshots, fields): data is an array of shape (len(fnames), number of snapshots, len(fields)), assemblies the names of assembly modes (see get_assembly_name()), snapshots the sorted union of snapshot indices of all files and fields the catalogue columns followed by derived columns (see derived_fields). Snapshots missing from a file, and derived fields, are NaN.
+	Parameters:
+	fnames 		= list of paths to halo catalogue files
+	'''
+	tables 		= [np.loadtxt(fname,skiprows=1,ndmin=2) for fname in fnames]
+	snapshots 	= np.unique(np.concatenate([table[:,0] for table in tables])).astype(int)
+	fields 		= cols+derived_fields
+	data 		= np.full((len(fnames),len(snapshots),len(fields)),np.nan)
+	for i, table in enumerate(tables):
+		data[i,np.searchsorted(snapshots,table[:,0].astype(int)),:len(cols)] = table
+	return data, [get_assembly_name(fname) for fname in fnames], snapshots, fields
+
+@instrument
+def transform_catalogues(data, fields):
+	'''
+	Applies transforms to catalogue array in place, each as a single vectorized operation over all assembly modes and snapshots, and returns it : Euclidean norm of subhalo peculiar velocity, replacement of zero values (see zero_values) and log10 of columns in log10_unit_variables.
+	Parameters:
+	data 		= array of shape (assembly modes, snapshots, fields), eg. returned by read_catalogues()
+	fields 		= names of fields along last axis of data
+	'''
+	velocity 	= [fields.index('subhalo_peculiar_velocity_'+axis) for axis in 'xyz']
+	data[...,fields.index('subhalo_peculiar_velocity')] = np.sqrt((data[...,velocity]**2).sum(axis=-1))
+	floors 		= np.array([zero_values.get(field,np.nan) for field in fields])
+	data[...] 	= np.where((data == 0) & ~np.isnan(floors), floors, data)
+	log10 		= [fields.index(field) for field in log10_unit_variables]
+	data[...,log10] = np.log10(data[...,log10])
+	return data
+
+@instrument
+def catalogues_to_df(data, assemblies, snapshots, fields):
+	'''
+	Returns a long dataframe of a catalogue array for plotting, with one row per assembly mode and snapshot, a column per field and a categorical assembly column. Rows of snapshots missing from a catalogue are dropped.
+	Parameters:
+	data 		= array of shape (assembly modes, snapshots, fields)
+	assemblies 	= names of assembly modes along first axis of data
+	snapshots 	= snapshot indices along second axis of data
+	fields 		= names of fields along last axis of data
+	'''
+	df 				= pd.DataFrame(data.reshape(-1,len(fields)),columns=fields)
+	df['assembly'] 	= pd.Categorical(np.repeat(assemblies,len(snapshots)),categories=assemblies)
+	return df[~np.isnan(data[...,fields.index('index')]).ravel()].reset_index(drop=True)
 
-			# ------- Calculate deviation and store in new dataframe column
-	gm_early_data_dev 	= gm_early_data[y] - organic_data[y]
-	gm_late_data_dev 	= gm_late_data[y] - organic_data[y]
-	organic_data_dev 	= organic_data[y] - organic_data[y]
-	dev_df[str(y)+'_deviation'] = pd.concat([gm_early_data_dev,organic_data_dev,gm_late_data_dev])
+def interpolate_onto_grid(x, values, grid):
+	'''
+	Returns values linearly interpolated onto grid, as an array of shape (len(grid), number of fields), vectorized over all fields. Grid points outside range of x are NaN (no extrapolation); points of grid equal to points of x get exact values. Values of repeated points of x (eg. repeated catalogue times) are averaged first, so that no interval has zero width.
+	Parameters:
+	x 			= coordinates of values (eg. snapshot index, redshift or time), without NaN
+	values 		= array of shape (len(x), number of fields)
+	grid 		= coordinates to interpolate onto
+	'''
+	x, inverse, counts 	= np.unique(x, return_inverse=True, return_counts=True)
+	if len(x) < len(inverse):
+		sums 	= np.zeros((len(x),values.shape[1]))
+		np.add.at(sums, inverse.ravel(), values)
+		values 	= sums/counts[:,None]
+	else:
+		values 	= values[np.argsort(inverse.ravel())]
+	grid 		= np.asarray(grid, dtype=float)
+	if len(x) < 2:
+		result 	= np.full((len(grid),values.shape[1]),np.nan)
+		if len(x):
+			result[grid == x[0]] = values[0]
+		return result
+	j 			= np.clip(np.searchsorted(x,grid,side='right')-1,0,len(x)-2)
+	weights 	= ((grid-x[j])/(x[j+1]-x[j]))[:,None]
+	result 		= values[j]*(1-weights)+values[j+1]*weights
+	result[(grid < x[0]) | (grid > x[-1])] = np.nan
+	return result
+
+@instrument
+def get_deviations(data, assemblies, fields, reference='organic', on='time', grid=None, deviation_fields=None, log_fields=log10_unit_variables):
+	'''
+	Returns a tidy long-format dataframe of deviations of all assembly modes from a reference assembly mode, with one row per assembly mode, grid point and field, and columns assembly, on, field, value, reference, deviation, absolute_deviation and log_deviation.
+	Every assembly mode is joined to the reference on column on (snapshot index, redshift or time), interpolated onto a common grid if their grids differ. Deviations are then computed for all fields in one vectorized pass : deviation is difference of values as stored (i.e. in dex for log fields, as plotted), absolute_deviation is difference in linear units and log_deviation is log10 of ratio of linear values.
+	Parameters:
+	data 				= array of shape (assembly modes, snapshots, fields), eg. transformed by transform_catalogues()
+	assemblies 			= names of assembly modes along first axis of data
+	fields 				= names of fields along last axis of data
+	reference 			= name of reference assembly mode
+	on 					= field on which assembly modes are aligned, eg. index, redshift or time
+	grid 				= common grid of values of on. Defaults to distinct values of on of reference assembly mode if None.
+	deviation_fields 	= fields for which deviations are computed. Defaults to all fields except on.
+	log_fields 			= fields stored as log10 values
+	'''
+	if deviation_fields is None:
+		deviation_fields 	= [field for field in fields if field != on]
+	columns 		= [fields.index(field) for field in deviation_fields]
+	x 				= data[...,fields.index(on)]
+	if grid is None:
+		grid 		= np.unique(x[assemblies.index(reference)][~np.isnan(x[assemblies.index(reference)])])
+	aligned 		= np.stack([interpolate_onto_grid(x[i][~np.isnan(x[i])], data[i][~np.isnan(x[i])][:,columns], grid) for i in range(len(assemblies))])
+	reference_values 	= aligned[assemblies.index(reference)]
+	is_log 			= np.isin(deviation_fields, log_fields)
+	linear 			= np.where(is_log, 10.**aligned, aligned)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		log_deviation 	= np.log10(linear/linear[assemblies.index(reference)])
+	shape 			= aligned.shape
+	return pd.DataFrame({
+		'assembly'				: pd.Categorical(np.repeat(assemblies,shape[1]*shape[2]),categories=assemblies),
+		on 						: np.tile(np.repeat(grid,shape[2]),shape[0]),
+		'field'					: np.tile(deviation_fields,shape[0]*shape[1]),
+		'value'					: aligned.ravel(),
+		'reference'				: np.broadcast_to(reference_values,shape).ravel(),
+		'deviation'				: (aligned-reference_values).ravel(),
+		'absolute_deviation'	: (linear-linear[assemblies.index(reference)]).ravel(),
+		'log_deviation'			: log_deviation.ravel()})
+
+def plot_field(df, dev_df, y):
+	'''
+	Plots a catalogue field against time for all assembly modes on a main axis, with deviations from the reference assembly mode on a smaller axis below and a secondary redshift axis on top. Returns the figure.
+	Parameters:
+	df 			= long dataframe (see catalogues_to_df())
+	dev_df 		= tidy deviations dataframe aligned on time (see get_deviations())
+	y 			= field to be plotted
+	'''
 
 			# ------- Set seaborn style parameters
 			# ------- use print(sns.axes_style()) for getting a complete list of style attributes
@@ -192,9 +378,9 @@ for y in yaxes:
 		fontsize=12.5, 
 		labelpad=5)
 
-	sns.lineplot(data=df, 
+	sns.lineplot(data=dev_df[dev_df['field'] == y], 
 		x='time', 
-		y=dev_df[str(y)+'_deviation'],
+		y='deviation',
 		hue='assembly',
 		ax=axes[1], 								# plot deviations from organic on second (smaller) axis
 		legend=False)								# remove legend, already shown for axis[0]
@@ -213,7 +399,230 @@ for y in yaxes:
 	redshift_x_axis(secondary_x,axes[0])			# function call to obtain correct mapping of time and redshift values
 
 	fig.subplots_adjust(hspace=0.05)				# reduce space between subplots for better viewing of ticks
-	
-	# plt.savefig('./plots/'+str(y)+'.png',dpi=480,bbox_inches='tight')
+	return fig
+
+
+def get_field_signature(df, dev_df, y, dpi):
+	'''
+	Returns a hex digest identifying the figure of a field : source code of save_field() and of the functions of this module it calls (see get_function_sources()), plotted data and resolution.
+	Parameters:
+	df 			= long dataframe holding columns time, assembly and y
+	dev_df 		= tidy deviations dataframe holding deviations of y only
+	y 			= field to be plotted
+	dpi 		= resolution of saved figure
+	'''
+	digest 		= hashlib.sha1()
+	for source in get_function_sources(save_field):
+		digest.update(source.encode())
+	for data in (df, dev_df):
+		digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+	digest.update(repr((y, dpi)).encode())
+	return digest.hexdigest()
+
+def save_field(df, dev_df, y, fname, dpi=480):
+	'''
+	Plots a field (see plot_field()) with the non-interactive Agg backend and saves it to fname. Runs in a worker process.
+	Parameters:
+	df 			= long dataframe (see catalogues_to_df())
+	dev_df 		= tidy deviations dataframe aligned on time (see get_deviations())
+	y 			= field to be plotted
+	fname 		= path of saved figure
+	dpi 		= resolution of saved figure
+	'''
+	plt.switch_backend('Agg')
+	fig 		= plot_field(df, dev_df, y)
+	fig.savefig(fname, dpi=dpi, bbox_inches='tight')
+	plt.close(fig)
+
+@instrument
+def render_fields(df, dev_df, yaxes, plots_dir='./plots/', workers=None, force=False, dpi=480):
+	'''
+	Renders figures of several fields in parallel worker processes without a display, saves them to plots_dir as <field>.png and returns fields rendered. Each worker receives only the columns of its own field. Figures whose data, plotting code (see get_field_signature()) and resolution are unchanged since last rendered, and whose files exist, are skipped; signatures are kept in .render_hashes.json in plots_dir.
+	Parameters:
+	df 			= long dataframe (see catalogues_to_df())
+	dev_df 		= tidy deviations dataframe aligned on time (see get_deviations())
+	yaxes 		= fields to be plotted
+	plots_dir 	= directory of saved figures
+	workers 	= number of worker processes, defaults to number of CPUs if None
+	force 		= render all figures, even if unchanged
+	dpi 		= resolution of saved figures
+	'''
+	os.makedirs(plots_dir,exist_ok=True)
+	hashes_fname 	= os.path.join(plots_dir,'.render_hashes.json')
+	hashes 			= dict()
+	if os.path.exists(hashes_fname):
+		with open(hashes_fname) as f:
+			hashes 	= json.load(f)
+	pending 		= dict()
+	for y in yaxes:
+		field_df 		= df[['time',y,'assembly']]
+		field_dev_df 	= dev_df[dev_df['field'] == y]
+		signature 		= get_field_signature(field_df, field_dev_df, y, dpi)
+		fname 			= os.path.join(plots_dir,str(y)+'.png')
+		if force or hashes.get(str(y)) != signature or not os.path.exists(fname):
+			pending[y] 	= (field_df, field_dev_df, fname, signature)
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures 		= {executor.submit(save_field, field_df, field_dev_df, y, fname, dpi) : y for y, (field_df, field_dev_df, fname, signature) in pending.items()}
+		for future in as_completed(futures):
+			future.result()
+			hashes[str(futures[future])] 	= pending[futures[future]][3]
+	with open(hashes_fname+'.tmp','w') as f:
+		json.dump(hashes,f,indent=1,sort_keys=True)
+	os.replace(hashes_fname+'.tmp',hashes_fname)
+	return [y for y in yaxes if y in pending]
+
+# ===================================== Command line functions ==========================================
+
+			# ------- Assembly modes, as identified on the command line. Catalogue of each is halo_catalogue_<assembly>.txt in data directory
+
+assembly_modes = ['gm_early', 'organic', 'gm_late']
+
+def load_catalogues(options, reference=None):
+	'''
+	Returns (data, assemblies, snapshots, fields) of catalogues of assembly modes selected on the command line, transformed for plotting (see read_catalogues() and transform_catalogues()). The catalogue of a reference assembly mode of deviations is read as well, after selected ones, if it is not selected (see select_assemblies()).
+	Parameters:
+	options 	= parsed command line options, with assembly and data_dir
+	reference 	= reference assembly mode of deviations (eg. organic), or None
+	'''
+	selected 	= list(options.assembly)+([reference] if reference is not None and reference not in options.assembly else [])
+	fnames 		= [os.path.join(options.data_dir,'halo_catalogue_'+assembly+'.txt') for assembly in selected]
+	data, assemblies, snapshots, fields = read_catalogues(fnames)
+	return transform_catalogues(data, fields), assemblies, snapshots, fields
+
+def select_assemblies(df, options):
+	'''
+	Returns rows of a dataframe with an assembly column for assembly modes selected on the command line only, dropping a reference assembly mode read only for deviations (see load_catalogues()).
+	Parameters:
+	df 			= dataframe with a categorical assembly column (eg. returned by catalogues_to_df() or get_deviations())
+	options 	= parsed command line options, with assembly
+	'''
+	df 				= df[df['assembly'].isin([assembly.replace('_','-') for assembly in options.assembly])].reset_index(drop=True)
+	df['assembly'] 	= df['assembly'].cat.remove_unused_categories()
+	return df
+
+def run_manifest(options):
+	'''
+	Command listing catalogues of assembly modes : number of snapshots, range of snapshot indices, redshifts and cosmic time.
+	'''
+	data, assemblies, snapshots, fields = load_catalogues(options)
+	rows 		= list()
+	for assembly, table in zip(assemblies, data):
+		table 	= table[~np.isnan(table[:,fields.index('index')])]
+		rows.append({'assembly'			: assembly,
+					 'snapshots'		: len(table),
+					 'first_snapshot'	: int(table[:,fields.index('index')].min()),
+					 'last_snapshot'	: int(table[:,fields.index('index')].max()),
+					 'redshift_min'		: table[:,fields.index('redshift')].min(),
+					 'redshift_max'		: table[:,fields.index('redshift')].max(),
+					 'time_min'			: table[:,fields.index('time')].min(),
+					 'time_max'			: table[:,fields.index('time')].max()})
+	write_table(pd.DataFrame(rows), options.output)
+
+def run_reduce(options):
+	'''
+	Command writing transformed catalogue values of columns, one row per assembly mode and snapshot, or their deviations from a reference assembly mode with --deviations (see get_deviations()).
+	'''
+	data, assemblies, snapshots, fields = load_catalogues(options, options.reference if options.deviations else None)
+	if options.deviations:
+		df 		= select_assemblies(get_deviations(data, assemblies, fields, reference=options.reference.replace('_','-'), on=options.on, deviation_fields=options.cols), options)
+	else:
+		df 		= catalogues_to_df(data, assemblies, snapshots, fields)
+		df 		= df[['assembly']+[col for col in ['index','redshift','time'] if col not in options.cols]+options.cols]
+	write_table(df, options.output)
+
+def run_histogram(options):
+	'''
+	Command writing histograms of values of a column over snapshots of each assembly mode, on bin edges shared by all of them.
+	'''
+	data, assemblies, snapshots, fields = load_catalogues(options)
+	values 		= data[...,fields.index(options.col)]
+	finite 		= values[np.isfinite(values)]
+	edges 		= np.histogram_bin_edges(finite, bins=options.bins)
+	df 			= pd.DataFrame({'assembly'		: np.repeat(assemblies, options.bins),
+								options.col 	: np.tile((edges[:-1]+edges[1:])/2, len(assemblies)),
+								'bin_left'		: np.tile(edges[:-1], len(assemblies)),
+								'bin_right'		: np.tile(edges[1:], len(assemblies)),
+								'counts'		: np.concatenate([np.histogram(row[np.isfinite(row)], bins=edges)[0] for row in values])})
+	write_table(df, options.output)
+
+def run_plot(options):
+	'''
+	Command plotting columns of all assembly modes against cosmic time, with deviations from the reference assembly mode. Figures are shown, as by the original script, unless --batch or --output is set : they are then saved to the output directory (plots directory by default with --batch) without a display, rendered in parallel with --batch.
+	'''
+	data, assemblies, snapshots, fields = load_catalogues(options, options.reference)
+	df 			= select_assemblies(catalogues_to_df(data, assemblies, snapshots, fields), options)
+	dev_df 		= select_assemblies(get_deviations(data, assemblies, fields, reference=options.reference.replace('_','-'), on='time', deviation_fields=options.cols), options)
+	plots_dir 	= os.path.join(os.path.dirname(os.path.abspath(__file__)),'plots') if options.output is None else options.output
+	if options.batch:
+		print(render_fields(df, dev_df, options.cols, plots_dir=plots_dir, workers=options.workers, force=options.force))
+	elif options.show or options.output is None:
+		for y in options.cols:
+			plot_field(df, dev_df, y)
+		plt.show()
+	else:
+		mpl.use('Agg')
+		os.makedirs(plots_dir,exist_ok=True)
+		for y in options.cols:
+			save_field(df, dev_df, y, os.path.join(plots_dir,str(y)+'.png'))
+
+def get_parser():
+	'''
+	Returns command line parser, with subcommands manifest, reduce, histogram and plot.
+	'''
+	script_dir 	= os.path.dirname(os.path.abspath(__file__))
+	fields 		= cols+derived_fields
+	parser 		= argparse.ArgumentParser(description='Reduces and plots halo catalogues of assembly modes.')
+	common 		= argparse.ArgumentParser(add_help=False)
+	common.add_argument('--assembly', nargs='+', choices=assembly_modes, default=assembly_modes, help='assembly modes (default: all)')
+	common.add_argument('--data-dir', default=os.path.join(script_dir,'data_updated'), help='directory of halo catalogue files (default: data_updated)')
+	common.add_argument('--profile', action='store_true', help='record wall time, bytes read and peak memory of each pipeline stage')
+	common.add_argument('--profile-report', metavar='PATH', default=None, help='write profiling report to PATH, as json if PATH ends with .json, else as a table (printed if not set)')
+	table 		= argparse.ArgumentParser(add_help=False)
+	table.add_argument('--output', '-o', metavar='PATH', default=None, help="output file (.csv, or .json; '-' for csv on standard output; printed as a table if not set)")
+	commands 	= parser.add_subparsers(dest='command', required=True)
+	command 	= commands.add_parser('manifest', parents=[common, table], help='list snapshots of catalogues')
+	command.set_defaults(run=run_manifest)
+	command 	= commands.add_parser('reduce', parents=[common, table], help='write transformed catalogue values, or deviations from a reference')
+	command.add_argument('--cols', nargs='+', choices=fields, default=yaxes, help='columns (default: plotted columns)')
+	command.add_argument('--deviations', action='store_true', help='write deviations from reference assembly mode')
+	command.add_argument('--reference', choices=assembly_modes, default='organic', help='reference assembly mode of deviations, read even if not selected by --assembly (default: organic)')
+	command.add_argument('--on', choices=['index','redshift','time'], default='time', help='column on which deviations are aligned (default: time)')
+	command.set_defaults(run=run_reduce)
+	command 	= commands.add_parser('histogram', parents=[common, table], help='histogram values of a column over snapshots')
+	command.add_argument('--col', choices=fields, default='Stellar_mass', help='column (default: Stellar_mass)')
+	command.add_argument('--bins', type=int, default=20, help='number of bins (default: 20)')
+	command.set_defaults(run=run_histogram)
+	command 	= commands.add_parser('plot', parents=[common], help='plot columns against cosmic time, shown unless --batch or --output is set')
+	command.add_argument('--output', '-o', metavar='DIR', default=None, help='directory of saved figures (default: plots)')
+	command.add_argument('--workers', type=int, default=None, help='number of worker processes of --batch (default: number of CPUs)')
+	command.add_argument('--cols', nargs='+', choices=fields, default=yaxes, help='columns (default: yaxes)')
+	command.add_argument('--reference', choices=assembly_modes, default='organic', help='reference assembly mode of deviations, read even if not selected by --assembly (default: organic)')
+	command.add_argument('--show', action='store_true', help='show figures interactively even if --output is set')
+	command.add_argument('--batch', action='store_true', help='render figures in parallel to --output (default: plots directory), skipping unchanged ones')
+	command.add_argument('--force', action='store_true', help='with --batch, render unchanged figures too')
+	command.set_defaults(run=run_plot)
+	return parser
+
+def main(argv=None):
+	'''
+	Runs a command given on the command line (see get_parser()).
+	Parameters:
+	argv 		= list of command line arguments, sys.argv[1:] if None
+	'''
+	options 	= get_parser().parse_args(argv)
+	if options.profile:
+		start_profiling()
+	options.run(options)
+	if options.profile:
+		write_profile_report(options.profile_report)
+
+# ===================================== Main program ====================================================
+
+if __name__ == '__main__' :
+
+			# ------- Eg. python plotter.py manifest
+			# -------     python plotter.py reduce --cols Stellar_mass SFR --deviations -o deviations.csv
+			# -------     python plotter.py histogram --col sSFR --assembly organic gm_late
+			# -------     python plotter.py plot --batch --workers 4 --profile
 
-plt.show()											# Comment out if using savefig to save plots instead of viewing
\ No newline at end of file
+	main()
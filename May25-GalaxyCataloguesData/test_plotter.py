@@ -0,0 +1,23 @@
+import numpy as np
+
+from plotter import interpolate_onto_grid, get_deviations
+
+def test_interpolate_onto_grid_averages_repeated_x():
+	x 			= np.array([2., 0., 1., 1.])
+	values 		= np.array([[20., 2.], [0., 0.], [8., 1.], [12., 3.]])
+	result 		= interpolate_onto_grid(x, values, [0., 0.5, 1., 1.5, 2., 3.])
+	expected 	= np.array([[0., 0.], [5., 1.], [10., 2.], [15., 2.], [20., 2.], [np.nan, np.nan]])
+	np.testing.assert_allclose(result, expected)
+
+def test_interpolate_onto_grid_single_distinct_x():
+	result 		= interpolate_onto_grid(np.array([1., 1.]), np.array([[2.], [4.]]), [0., 1.])
+	np.testing.assert_allclose(result, [[np.nan], [3.]])
+
+def test_get_deviations_with_repeated_times():
+	fields 		= ['time', 'Stellar_mass']
+	data 		= np.array([[[1., 8.], [2., 9.], [2., 9.], [3., 10.]],
+							[[1., 8.5], [2., 9.5], [2., 9.5], [3., 10.5]]])
+	df 			= get_deviations(data, ['organic', 'gm-early'], fields, reference='organic', on='time', log_fields=['Stellar_mass'])
+	assert list(df['time'].unique()) == [1., 2., 3.]
+	assert np.isfinite(df[['value', 'deviation', 'absolute_deviation', 'log_deviation']].to_numpy()).all()
+	np.testing.assert_allclose(df.loc[df['assembly'] == 'gm-early', 'deviation'], 0.5)
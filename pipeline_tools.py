@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+import sys
+import types
+import importlib
+import inspect
+import re
+import json
+import time
+import functools
+import tracemalloc
+import resource
+
+# ===================================== Helpers shared by the plotter scripts ===========================
+
+# ----------------------- General-purpose functions -----------------------
+
+def lazy_import(name):
+	'''
+	Returns a stand-in for a module, which imports the module on first access to any of its attributes and forwards all attribute accesses to it. Heavy modules needed only by some code paths (eg. plotting libraries) then cost nothing to runs that do not use them.
+	Parameters	:
+	name 	- full name of module, eg. matplotlib.pyplot.
+	'''
+	module 				= types.ModuleType(name)
+	module.__getattr__ 	= lambda attr : getattr(importlib.import_module(name), attr)
+	return module
+
+def write_table(df, output=None):
+	'''
+	Writes a dataframe as a table : printed if output is None, as csv to standard output if output is '-', else to file output, as json records if it ends with .json and as csv otherwise.
+	Parameters	:
+	df 		- a dataframe.
+	output 	- path of output file, '-' or None.
+	'''
+	if output is None:
+		print(df.to_string(index=False))
+	elif output == '-':
+		df.to_csv(sys.stdout, index=False)
+	elif output.endswith('.json'):
+		df.to_json(output, orient='records', indent=1)
+	else:
+		df.to_csv(output, index=False)
+
+def get_code_names(code):
+	'''
+	Returns global names referenced by a code object and by code objects nested in it (eg. comprehensions and lambdas).
+	Parameters	:
+	code 	- a code object.
+	'''
+	names 	= set(code.co_names)
+	for const in code.co_consts:
+		if inspect.iscode(const):
+			names 	|= get_code_names(const)
+	return names
+
+def get_function_sources(function):
+	'''
+	Returns source code of a function and of functions of its module it calls, directly or through other such functions, in a stable order. Edits elsewhere in the module (eg. to unrelated functions or docstrings) do not change it.
+	Parameters	:
+	function 	- a function, possibly wrapped by instrument().
+	'''
+	sources 	= dict()
+	pending 	= [inspect.unwrap(function)]
+	while pending:
+		function 	= inspect.unwrap(pending.pop())
+		if function.__qualname__ in sources:
+			continue
+		sources[function.__qualname__] 	= inspect.getsource(function)
+		for name in get_code_names(function.__code__):
+			value 	= function.__globals__.get(name)
+			if inspect.isfunction(value) and inspect.unwrap(value).__module__ == function.__module__:
+				pending.append(value)
+	return [sources[name] for name in sorted(sources)]
+
+# ----------------------- Instrumentation functions -----------------------
+
+# ------- Per-stage instrumentation (see instrument()), off by default. Switched on by start_profiling(), eg. with --profile on the command line.
+
+profiling = False
+
+stage_records = list()							# One record per instrumented call, in order of completion.
+stage_stack = list()							# Records of instrumented calls in progress, outermost first.
+
+def get_bytes_read():
+	'''
+	Returns (bytes read, bytes read from disk) by this process so far. Bytes read count all read system calls, including those served from page cache (rchar of /proc/self/io, Linux only, else NaN); bytes read from disk count block input operations of this process and of its terminated worker processes.
+	'''
+	try:
+		with open('/proc/self/io') as io:
+			rchar 	= int(re.search(r'^rchar:\s+(\d+)', io.read(), re.MULTILINE).group(1))
+	except (OSError, AttributeError):
+		rchar 	= np.nan
+	blocks 		= resource.getrusage(resource.RUSAGE_SELF).ru_inblock+resource.getrusage(resource.RUSAGE_CHILDREN).ru_inblock
+	return rchar, blocks*512
+
+def start_profiling():
+	'''
+	Switches on instrumentation of pipeline stages and clears records of earlier stages. Memory allocations are traced from now on (see tracemalloc), which slows allocation-heavy code.
+	'''
+	global profiling
+	profiling 	= True
+	stage_records.clear()
+	if not tracemalloc.is_tracing():
+		tracemalloc.start()
+
+def stop_profiling():
+	'''
+	Switches off instrumentation of pipeline stages, keeping records of stages run so far.
+	'''
+	global profiling
+	profiling 	= False
+	if tracemalloc.is_tracing():
+		tracemalloc.stop()
+
+def instrument(function):
+	'''
+	Decorator recording wall time, bytes read (see get_bytes_read()) and peak memory of every call of a pipeline stage in stage_records, while profiling is on; calls are passed through untouched otherwise. Peak memory is the highest memory allocated through Python (including numpy arrays) during the call, above memory allocated at its start, and includes nested instrumented calls, which are recorded with their depth. Work done in worker processes only counts towards wall time and bytes read from disk.
+	Parameters	:
+	function 	- a pipeline stage function.
+	'''
+	@functools.wraps(function)
+	def instrumented(*args, **kwargs):
+		if not profiling or not tracemalloc.is_tracing():
+			return function(*args, **kwargs)
+		current, peak 	= tracemalloc.get_traced_memory()
+		if stage_stack:							# Peak of enclosing stage so far, before its peak is reset for this stage.
+			stage_stack[-1]['peak'] = max(stage_stack[-1]['peak'], peak)
+		tracemalloc.reset_peak()
+		rchar, inbytes 	= get_bytes_read()
+		record 			= {'stage':function.__name__, 'depth':len(stage_stack), 'start':current, 'peak':current}
+		stage_stack.append(record)
+		start 			= time.perf_counter()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			wall_time 	= time.perf_counter()-start
+			stage_stack.pop()
+			rchar_end, inbytes_end 	= get_bytes_read()
+			record['peak'] 			= max(record['peak'], tracemalloc.get_traced_memory()[1])
+			if stage_stack:
+				stage_stack[-1]['peak'] = max(stage_stack[-1]['peak'], record['peak'])
+			stage_records.append({'stage'			: record['stage'],
+								  'depth'			: record['depth'],
+								  'wall_time'		: wall_time,
+								  'bytes_read'		: rchar_end-rchar,
+								  'disk_bytes_read'	: inbytes_end-inbytes,
+								  'peak_memory'		: record['peak']-record['start']})
+	return instrumented
+
+def get_profile_report(records=None):
+	'''
+	Returns a dataframe summarizing instrumented stages, one row per stage in order of first completion : number of calls, total and mean wall time (s), bytes read, bytes read from disk and largest peak memory of a call (bytes). Wall times of nested stages are also included in those of their enclosing stages.
+	Parameters	:
+	records 	- list of stage records, stage_records if None.
+	'''
+	df 		= pd.DataFrame(stage_records if records is None else records, columns=['stage','depth','wall_time','bytes_read','disk_bytes_read','peak_memory'])
+	return df.groupby('stage', sort=False).agg(depth=('depth','min'),
+											   calls=('wall_time','size'),
+											   wall_time=('wall_time','sum'),
+											   mean_wall_time=('wall_time','mean'),
+											   bytes_read=('bytes_read','sum'),
+											   disk_bytes_read=('disk_bytes_read','sum'),
+											   peak_memory=('peak_memory','max')).reset_index()
+
+def write_profile_report(fname=None):
+	'''
+	Writes a report of instrumented stages (see get_profile_report()). Reports written to a .json file hold the summary and every record, to be compared across runs; other files, or standard output if fname is None, get a plain text table.
+	Parameters	:
+	fname 	- path of report file, or None to print the report.
+	'''
+	report 	= get_profile_report()
+	if fname is not None and fname.endswith('.json'):
+		with open(fname, 'w') as f:
+			json.dump({'summary':report.to_dict(orient='records'), 'records':stage_records}, f, indent=1, default=float)
+		return
+	table 	= report.assign(stage=['  '*depth+stage for depth, stage in zip(report['depth'], report['stage'])]).drop(columns='depth').to_string(index=False)
+	if fname is None:
+		print(table)
+	else:
+		with open(fname, 'w') as f:
+			f.write(table+'\n')